@@ -1,20 +1,35 @@
+import hashlib
+import json
+import logging
 import os
+import tempfile
 # from noisyopt import minimizeCompass
 from copy import deepcopy
+from multiprocessing import Pool
 
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 from scipy.optimize import minimize, Bounds
 from scipy.optimize import shgo
+from scipy.stats import qmc
 
 from utils.OD import TripCollection, OriginDestination, TripGeneration, ModeSplit, TransitionMatrices
 from utils.choiceCharacteristics import CollectedChoiceCharacteristics
 from utils.demand import Demand, CollectedTotalUserCosts
+from utils.equilibrium import EquilibriumProblem, EquilibriumResult, SOLVERS
+from utils.evaluationCache import EvaluationCache, EVALUATION_CACHE_VERSION
+from utils.instrumentation import getInstrumentation
+from utils.log import getLogger, logEvent, enableLogging
 from utils.microtype import MicrotypeCollection, CollectedTotalOperatorCosts
 from utils.misc import TimePeriods, DistanceBins
+from utils.modelSnapshot import ModelSnapshot
 from utils.network import CollectedNetworkStateData
 from utils.population import Population
+from utils.scenarioCache import ScenarioCache
+from utils.warmStart import WarmStartStore, WARM_START_METHODS
+
+logger = getLogger(__name__)
 
 
 # from skopt import gp_minimize
@@ -35,22 +50,165 @@ class Optimizer:
         e.g. [('A', 'bus'), ('B','rail')]
     method : str
         Optimization method
+    nWorkers : int | None
+        Number of worker processes, each holding its own Model, used to evaluate decision vectors in parallel. None
+        or 1 evaluates everything serially in this process.
+    parallelJacobian : bool
+        Whether gradient-based methods get their gradient from jacobian() instead of scipy's serial finite differences
+    jacobianStep : float
+        Relative finite difference step, applied to max(1, |x|)
+    warmStart : WarmStartStore | None
+        Converged states of recent evaluations. If set, and the model's equilibriumMethod is one of
+        utils.warmStart.WARM_START_METHODS ("anderson" or "newton-krylov"), each evaluation starts from the state of
+        the nearest stored decision vector instead of from whatever the previous evaluation left. It has no effect
+        with the default "msa", which gains nothing from a warm start.
+    cache : EvaluationCache | None
+        Disk-backed store of earlier evaluations, consulted by evaluate before running the model
+    sampledValues : dict
+        Objective values of shgo's sampling points during a parallel minimize, keyed by the rounded point
+    snapshotPath : str | None
+        Model snapshot (see Model.save) to start from instead of initializing a Model from path. With workers, the
+        parent's freshly initialized model is otherwise snapshotted to a temporary file for them to load
+    equilibriumMethod, equilibriumTolerance, equilibriumMaxIterations : str, float, int | None
+        Equilibrium solver settings of the model, if not its defaults. Workers are started with the settings of this
+        process's model, so they solve (and key the evaluation cache) the same way
         
     Methods
     ---------
-    evaluate(reallocations):
-        Evaluate the objective funciton given a set of modifications to the transportation system
+    evaluate(reallocations, warmState=None, useCache=True):
+        Evaluate the objective funciton given a set of modifications to the transportation system, optionally
+        starting from an explicit equilibrium state with a fresh MSA damping schedule
+    fingerprint():
+        Hash of the scenario inputs and optimizer setup, used to key the evaluation cache
+    jacobian(reallocations):
+        Objective and forward-difference gradient, with every perturbed point warm-started from the base point's
+        equilibrium and evaluated concurrently if there are workers
+    evaluateBatch(allReallocations):
+        Evaluate the objective function for several sets of modifications, in parallel if there are workers
+    map(func, iterable):
+        Map-like interface to the worker pool
+    sample(n, d):
+        Halton sampling points for shgo in the unit hypercube, evaluated as one batch by the workers
+    evaluateSampled(reallocations):
+        Objective for shgo in parallel mode: the batch value of a sampled point, otherwise evaluate
     minimize():
         Minimize the objective function using the set method
+    close():
+        Shut down the worker pool
     """
 
-    def __init__(self, path: str, fromToSubNetworkIDs=None, modesAndMicrotypes=None, method="shgo"):
+    def __init__(self, path: str, fromToSubNetworkIDs=None, modesAndMicrotypes=None, method="shgo", nWorkers=None,
+                 cachePath=None, cacheResolution=None, cacheModeSplits=False, parallelJacobian=False,
+                 jacobianStep=1e-3, warmStartSize=None, warmStartScale=1.0, snapshotPath=None, equilibriumMethod=None,
+                 equilibriumTolerance=None, equilibriumMaxIterations=None):
         self.__path = path
         self.__fromToSubNetworkIDs = fromToSubNetworkIDs
         self.__modesAndMicrotypes = modesAndMicrotypes
         self.__method = method
-        self.model = Model(path)
-        print("Done")
+        self.nWorkers = nWorkers
+        self.__pool = None
+        self.sampledValues = dict()
+        self.__cacheModeSplits = cacheModeSplits
+        self.parallelJacobian = parallelJacobian
+        self.jacobianStep = jacobianStep
+        if warmStartSize:
+            self.warmStart = WarmStartStore(warmStartSize, warmStartScale)
+        else:
+            self.warmStart = None
+        if snapshotPath is not None:
+            self.model = Model.load(snapshotPath)
+        else:
+            self.model = Model(path)
+        if equilibriumMethod is not None:
+            self.model.equilibriumMethod = equilibriumMethod
+        if equilibriumTolerance is not None:
+            self.model.equilibriumTolerance = equilibriumTolerance
+        if equilibriumMaxIterations is not None:
+            self.model.equilibriumMaxIterations = equilibriumMaxIterations
+        self.__snapshotPath = snapshotPath
+        self.__ownsSnapshot = False
+        if self.parallel and (snapshotPath is None):
+            # Taken before any evaluation, so every worker starts from the same state as this process
+            handle, self.__snapshotPath = tempfile.mkstemp(suffix=".model.gz")
+            os.close(handle)
+            self.__ownsSnapshot = True
+            self.model.save(self.__snapshotPath)
+        if cachePath is not None:
+            self.cache = EvaluationCache(cachePath, self.fingerprint(), cacheResolution)
+        else:
+            self.cache = None
+        logger.info("Done")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def warmStarting(self) -> bool:
+        return (self.warmStart is not None) and (self.model.equilibriumMethod in WARM_START_METHODS)
+
+    @property
+    def parallel(self) -> bool:
+        return (self.nWorkers is not None) and (self.nWorkers > 1)
+
+    def pool(self) -> Pool:
+        if self.__pool is None:
+            workerSetup = {"fromToSubNetworkIDs": self.__fromToSubNetworkIDs,
+                           "modesAndMicrotypes": self.__modesAndMicrotypes, "cacheModeSplits": self.__cacheModeSplits,
+                           "snapshotPath": self.__snapshotPath, "equilibriumMethod": self.model.equilibriumMethod,
+                           "equilibriumTolerance": self.model.equilibriumTolerance,
+                           "equilibriumMaxIterations": self.model.equilibriumMaxIterations}
+            if self.cache is not None:
+                workerSetup.update(cachePath=self.cache.path, cacheResolution=self.cache.resolution)
+            if self.warmStart is not None:
+                workerSetup.update(warmStartSize=self.warmStart.capacity, warmStartScale=self.warmStart.scale)
+            self.__pool = Pool(self.nWorkers, initializer=_initializeWorker, initargs=(self.__path, workerSetup))
+        return self.__pool
+
+    def close(self):
+        if self.cache is not None:
+            self.cache.close()
+        if self.__pool is not None:
+            self.__pool.close()
+            self.__pool.join()
+            self.__pool = None
+        if self.__ownsSnapshot and os.path.exists(self.__snapshotPath):
+            os.remove(self.__snapshotPath)
+            self.__snapshotPath = None
+            self.__ownsSnapshot = False
+
+    def map(self, func, iterable) -> list:
+        # The objective passed in by shgo wraps _evaluateInWorker, so it is cheap to send to the workers
+        if self.parallel:
+            return self.pool().map(func, iterable)
+        return list(map(func, iterable))
+
+    def evaluateBatch(self, allReallocations) -> np.ndarray:
+        if self.parallel:
+            return np.array(self.pool().map(_evaluateInWorker, [np.asarray(x) for x in allReallocations]))
+        return np.array([self.evaluate(np.asarray(x)) for x in allReallocations])
+
+    def sample(self, n: int, d: int) -> np.ndarray:
+        unit = qmc.Halton(d, scramble=False).random(n)
+        lower, upper = np.array(self.getBounds(), dtype=float).T[:2]
+        points = unit * (upper - lower) + lower
+        new = [x for x in points if self.__sampleKey(x) not in self.sampledValues]
+        for x, value in zip(new, self.evaluateBatch(new)):
+            self.sampledValues[self.__sampleKey(x)] = value
+        return unit
+
+    def evaluateSampled(self, reallocations: np.ndarray) -> float:
+        key = self.__sampleKey(reallocations)
+        if key in self.sampledValues:
+            return self.sampledValues[key]
+        return self.evaluate(reallocations)
+
+    @staticmethod
+    def __sampleKey(reallocations: np.ndarray) -> bytes:
+        # shgo rescales the unit sample itself, so allow for rounding in the last digits
+        return np.round(np.asarray(reallocations, dtype=float), 6).tobytes()
 
     def nSubNetworks(self):
         if self.__fromToSubNetworkIDs is not None:
@@ -86,7 +244,19 @@ class Optimizer:
         else:
             return 0.0
 
-    def evaluate(self, reallocations: np.ndarray) -> float:
+    def fingerprint(self) -> str:
+        setup = {"version": EVALUATION_CACHE_VERSION, "scenario": ScenarioCache(self.__path).scenarioHash(),
+                 "fromToSubNetworkIDs": self.__fromToSubNetworkIDs, "modesAndMicrotypes": self.__modesAndMicrotypes,
+                 "equilibrium": (self.model.equilibriumMethod, self.model.equilibriumTolerance,
+                                 self.model.equilibriumMaxIterations)}
+        return hashlib.sha1(json.dumps(setup, default=str).encode()).hexdigest()
+
+    def evaluate(self, reallocations: np.ndarray, warmState=None, useCache=True) -> float:
+        if (self.cache is not None) and useCache:
+            cached = self.cache.get(reallocations)
+            if cached is not None:
+                logger.info("|  Using cached evaluation of %s", reallocations)
+                return cached["userCosts"] + cached["operatorCosts"] + cached["dedicationCosts"]
         # self.model.resetNetworks()
         if self.__fromToSubNetworkIDs is not None:
             networkModification = NetworkModification(reallocations[:self.nSubNetworks()], self.__fromToSubNetworkIDs)
@@ -98,12 +268,49 @@ class Optimizer:
         else:
             transitModification = None
         self.model.modifyNetworks(networkModification, transitModification)
+        if warmState is not None:
+            # The base point's counter has grown so far that MSA would barely move off its splits
+            self.model.setEquilibriumState(warmState, freshCounter=True)
+        elif self.warmStarting:
+            distance, nearestState = self.warmStart.nearest(reallocations)
+            if nearestState is not None:
+                self.model.setEquilibriumState(nearestState, freshCounter=True)
         userCosts, operatorCosts = self.model.collectAllCosts()
+        if self.warmStarting:
+            self.warmStart.add(reallocations, self.model.getEquilibriumState())
         dedicationCosts = self.getDedicationCost(reallocations)
-        print(reallocations)
-        print(userCosts.total, operatorCosts.total, dedicationCosts)
+        logEvent(logger, logging.INFO, "evaluation", "%s\n%s %s %s", reallocations, userCosts.total, operatorCosts.total,
+                 dedicationCosts, reallocations=reallocations, userCosts=userCosts.total,
+                 operatorCosts=operatorCosts.total, dedicationCosts=dedicationCosts)
+        if self.cache is not None:
+            if self.__cacheModeSplits:
+                modeSplits = {str(timePeriod): self.model.getModeSplit(timePeriod)._mapping for timePeriod in
+                              self.model.scenarioData["timePeriods"].index}
+            else:
+                modeSplits = None
+            self.cache.put(reallocations, userCosts.total, operatorCosts.total, dedicationCosts, modeSplits)
         return userCosts.total + operatorCosts.total + dedicationCosts
 
+    def jacobian(self, reallocations: np.ndarray) -> (float, np.ndarray):
+        reallocations = np.asarray(reallocations, dtype=float)
+        # The base point must actually be solved here, since its equilibrium is the starting point for the others
+        base = self.evaluate(reallocations, useCache=False)
+        state = self.model.getEquilibriumState()
+        steps = self.jacobianStep * np.maximum(1.0, np.abs(reallocations))
+        if (self.cache is not None) and (self.cache.resolution is not None):
+            # A step within the cache resolution would just return the base evaluation
+            steps = np.maximum(steps, 2. * np.asarray(self.cache.resolution) * np.ones_like(steps))
+        bounds = self.getBounds()
+        upper = np.asarray(bounds.ub) if isinstance(bounds, Bounds) else np.array([ub for lb, ub in bounds])
+        steps = np.where(reallocations + steps > upper, -steps, steps)
+        perturbed = [reallocations + np.eye(len(reallocations))[i] * steps[i] for i in range(len(reallocations))]
+        if self.parallel:
+            values = np.array(self.pool().map(_evaluateFromState, [(x, state) for x in perturbed]))
+        else:
+            values = np.array([self.evaluate(x, state) for x in perturbed])
+        self.model.setEquilibriumState(state)
+        return base, (values - base) / steps
+
     def getBounds(self):
         if self.__fromToSubNetworkIDs is not None:
             upperBoundsROW = list(
@@ -132,6 +339,14 @@ class Optimizer:
 
     def minimize(self):
         if self.__method == "shgo":
+            if self.parallel:
+                # Sampling points are evaluated by the workers as a batch, and shgo's local minimizations in this
+                # process. shgo's own workers argument needs scipy >= 1.11
+                self.sampledValues = dict()
+                try:
+                    return shgo(self.evaluateSampled, self.getBounds(), sampling_method=self.sample)
+                finally:
+                    self.sampledValues = dict()
             return shgo(self.evaluate, self.getBounds(), sampling_method="simplicial")
         # elif self.__method == "sklearn":
         #    b = self.getBounds()
@@ -139,6 +354,8 @@ class Optimizer:
         # elif self.__method == "noisy":
         #     return minimizeCompass(self.evaluate, self.x0(), bounds=self.getBounds(), paired=False, deltainit=500000.0,
         #                            errorcontrol=False)
+        elif self.parallelJacobian:
+            return minimize(self.jacobian, self.x0(), jac=True, bounds=self.getBounds(), method=self.__method)
         else:
             return minimize(self.evaluate, self.x0(), bounds=self.getBounds(), method=self.__method)
         # return dual_annealing(self.evaluate, self.getBounds(), no_local_search=False, initial_temp=150.)
@@ -146,6 +363,27 @@ class Optimizer:
         #                 options={'verbose': 3, 'xtol': 10.0, 'gtol': 1e-4, 'maxiter': 15, 'initial_tr_radius': 10.})
 
 
+_workerOptimizer = None
+
+
+def _setWorkerOptimizer(optimizer):
+    global _workerOptimizer
+    _workerOptimizer = optimizer
+
+
+def _initializeWorker(path, workerSetup: dict):
+    _setWorkerOptimizer(Optimizer(path, **workerSetup))
+
+
+def _evaluateInWorker(reallocations: np.ndarray) -> float:
+    return _workerOptimizer.evaluate(reallocations)
+
+
+def _evaluateFromState(reallocationsAndState) -> float:
+    reallocations, state = reallocationsAndState
+    return _workerOptimizer.evaluate(reallocations, state)
+
+
 class TransitScheduleModification:
     def __init__(self, headways: np.ndarray, modesAndMicrotypes: list):
         self.headways = headways
@@ -178,18 +416,45 @@ class ScenarioData:
         File path to input data
     data : dict
         Dictionary containing input data from respective inputs
+    useCache : bool
+        Whether to read from (and write) a binary snapshot of the parsed inputs next to the input directory
+    base : ScenarioData | None
+        Read-only scenario this one is an overlay on. Tables not held in data are resolved from the base.
+    patches : dict
+        New values of the cells changed through patch(), keyed by (table key, row, column)
+    version : int
+        Number of patch() and revert() calls so far, so that values derived from the tables can be refreshed
+
+    Tables can be changed either through patch(), which can be reverted, or by writing to them directly. A Model
+    refreshes its networks and modes the next time it uses them after either kind of change: patches are detected
+    through version, and direct writes to the numeric columns of the PATCHABLE_KEYS tables through checksum().
+    Direct writes to other tables, or to non-numeric columns, are not picked up once the model is built.
 
     Methods
     -------
     loadMoreData():
         Loads more modes of transportation.
     loadData():
-        Read in data corresponding to various inputs.
+        Read in data corresponding to various inputs, from the scenario cache if it is valid.
+    readFiles():
+        Parse the input csv files.
     copy():
         Return a new ScenarioData copy containing data.
+    overlay(patchableKeys):
+        Return a copy-on-write overlay that shares all other tables with this one
+    patch(key, row, column, value):
+        Change a single cell of a table, copying it into an overlay first if it is not one of PATCHABLE_KEYS
+    original(key, row, column):
+        Return the value of a cell in the base scenario
+    revert():
+        Undo all patches
+    checksum(keys):
+        Return a hash of the numeric contents of the tables under keys
     """
 
-    def __init__(self, path: str, data=None):
+    PATCHABLE_KEYS = ("subNetworkData", "modeData")
+
+    def __init__(self, path: str, data=None, useCache=True, base=None):
         """
         Constructs and loads all relevant data of the scenario into the instance.
 
@@ -199,8 +464,17 @@ class ScenarioData:
                 File path to input data
             data : dict
                 Dictionary containing input data from respective inputs
+            useCache : bool
+                Load from and write to the scenario cache
+            base : ScenarioData
+                Scenario to resolve tables not contained in data from
         """
         self.__path = path
+        self.useCache = useCache
+        self.__base = base
+        self.patches = dict()
+        self.version = 0
+        self.__originals = dict()
         if data is None:
             self.data = dict()
             self.loadData()
@@ -211,7 +485,31 @@ class ScenarioData:
         self.data[key] = value
 
     def __getitem__(self, item: str):
-        return self.data[item]
+        if item in self.data:
+            return self.data[item]
+        elif self.__base is not None:
+            return self.__base[item]
+        else:
+            raise KeyError(item)
+
+    def __contains__(self, item):
+        return (item in self.data) or ((self.__base is not None) and (item in self.__base))
+
+    @property
+    def base(self):
+        return self.__base
+
+    def table(self, key) -> pd.DataFrame:
+        """
+        Returns the table stored under key, where key is either a data label or a tuple such as ("modeData", "bus")
+        """
+        if isinstance(key, tuple):
+            out = self[key[0]]
+            for subKey in key[1:]:
+                out = out[subKey]
+            return out
+        else:
+            return self[key]
 
     def loadModeData(self):
         """
@@ -231,7 +529,23 @@ class ScenarioData:
     def loadData(self):
         """
         Fills the data dict() with values, the dict() contains data pertaining to various data labels and given csv
-        data.
+        data. If the scenario cache is up to date with the csv files it is used instead of parsing them.
+        """
+        if self.useCache:
+            cache = ScenarioCache(self.__path)
+            data = cache.load()
+            if data is not None:
+                self.data = data
+                logger.info("|  Loaded scenario data from cache %s", cache.cachePath)
+                return
+            self.readFiles()
+            cache.save(self.data)
+        else:
+            self.readFiles()
+
+    def readFiles(self):
+        """
+        Parses the csv files of the scenario into the data dict().
         """
         self["subNetworkData"] = pd.read_csv(os.path.join(self.__path, "SubNetworks.csv"),
                                              index_col="SubnetworkID", dtype={"MicrotypeID": str})
@@ -261,13 +575,94 @@ class ScenarioData:
 
     def copy(self):
         """
-        Creates a deep copy of the data contained in this ScenarioData instance
+        Creates a deep copy of the data contained in this ScenarioData instance. Tables resolved from a base
+        scenario stay shared with it.
 
         Returns
         -------
         A complete copy of the self.data dict()
         """
-        return ScenarioData(self.__path, deepcopy(self.data))
+        out = ScenarioData(self.__path, deepcopy(self.data), self.useCache, self.__base)
+        for (key, row, column), value in self.patches.items():
+            out.patches[key, row, column] = value
+            out.__originals[key, row, column] = self.original(key, row, column)
+        return out
+
+    def overlay(self, patchableKeys=PATCHABLE_KEYS):
+        """
+        Creates a copy-on-write overlay on this ScenarioData. The (small) tables listed in patchableKeys are copied
+        up front, because networks and modes keep references to them and need to see later patches; every other
+        table, including origin/destination data and transition matrices, is shared with this instance.
+
+        Returns
+        -------
+        A ScenarioData that resolves unpatched tables through this one
+        """
+        data = {key: self.copyTables(key) for key in patchableKeys}
+        return ScenarioData(self.__path, data, self.useCache, base=self)
+
+    def copyTables(self, label: str):
+        """Copy of the table (or dict of tables) stored under a data label"""
+        if isinstance(self[label], dict):
+            return {subKey: table.copy() for subKey, table in self[label].items()}
+        else:
+            return self[label].copy()
+
+    def original(self, key, row, column):
+        """
+        Returns the value of a cell before any patches
+        """
+        if (key, row, column) in self.__originals:
+            return self.__originals[key, row, column]
+        elif self.__base is not None:
+            return self.__base.table(key).at[row, column]
+        else:
+            return self.table(key).at[row, column]
+
+    def patch(self, key, row, column, value):
+        """
+        Sets a single cell of a table, recording the change so it can be reverted. In an overlay, a table outside
+        PATCHABLE_KEYS is copied from the base on its first patch, so the base is never changed
+        """
+        label = key[0] if isinstance(key, tuple) else key
+        if (self.__base is not None) and (label not in self.data):
+            self.data[label] = self.__base.copyTables(label)
+        table = self.table(key)
+        if (self.__base is None) and ((key, row, column) not in self.__originals):
+            self.__originals[key, row, column] = table.at[row, column]
+        self.patches[key, row, column] = value
+        columnType = table[column].dtype
+        valueType = np.asarray(value).dtype
+        if (columnType.kind in "biu") and (valueType.kind in "biuf"):
+            # e.g. a float headway in an integer column, which pandas would otherwise upcast or warn about
+            newType = np.result_type(columnType, valueType)
+            if newType != columnType:
+                table[column] = table[column].astype(newType)
+        table.at[row, column] = value
+        self.version += 1
+
+    def revert(self):
+        """
+        Resets every patched cell to its original value
+        """
+        for (key, row, column) in self.patches.keys():
+            self.table(key).at[row, column] = self.original(key, row, column)
+        self.patches = dict()
+        self.__originals = dict()
+        self.version += 1
+
+    def checksum(self, keys=PATCHABLE_KEYS) -> str:
+        """
+        Hash of the numeric columns of the tables under keys, cheap enough to detect direct writes on every use
+        """
+        digest = hashlib.sha1()
+        for key in keys:
+            tables = self[key].values() if isinstance(self[key], dict) else [self[key]]
+            for table in tables:
+                numeric = table.select_dtypes("number")
+                digest.update(str(numeric.dtypes.tolist()).encode())
+                digest.update(np.ascontiguousarray(numeric.to_numpy()).tobytes())
+        return digest.hexdigest()
 
     # def reallocate(self, fromSubNetwork, toSubNetwork, dist):
 
@@ -283,9 +678,9 @@ class Model:
     path : str
         File path to input data
     scenarioData : ScenarioData
-        Class object to fetch and store mode and parameter data
+        Copy-on-write overlay on initialScenarioData holding the current (possibly modified) scenario
     initialScenarioData : ScenarioData
-        Initial state of the scenario
+        Initial state of the scenario, never modified
     currentTimePeriod : str
         Description of the current time period (e.g. 'AM-Peak')
     microtypes : dict(str, MicrotypeCollection)
@@ -306,6 +701,12 @@ class Model:
         Contains initialized trips with all the sets and classes
     originDestination : OriginDestination
         Stores origin/destination form of trips
+    equilibriumMethod : str
+        Default solver used by findEquilibrium
+    equilibriumTolerance : float
+        Default tolerance on the residual reported by the solver
+    equilibriumMaxIterations : int
+        Default limit on outer solver iterations
 
     Methods
     -------
@@ -319,10 +720,21 @@ class Model:
         Initializes the model with file data
     initializeTimePeriod:
         Initializes the model with time periods
-    findEquilibrium():
-        Finds the ideal mode splits for the model
+    findEquilibrium(method=None, tolerance=None, maxIterations=None):
+        Finds the equilibrium mode splits with one of the solvers in utils.equilibrium.SOLVERS ("msa", "anderson" or
+        "newton-krylov", by default equilibriumMethod) and returns an EquilibriumResult
     getModeSplit(timePeriod=None, userClass=None, microtypeID=None, distanceBin=None):
         Returns the optimal mode splits
+    getEquilibriumState():
+        Returns a copy of the disaggregate mode splits and MSA counter of every time period, along with the network
+        state carried from one evaluation into the next
+    setEquilibriumState(state, freshCounter=False):
+        Restores a state returned by getEquilibriumState, e.g. to warm-start a nearby evaluation, optionally
+        restarting the MSA damping schedule
+    save(snapshotPath):
+        Writes the initialized model, with any equilibria it has solved, to a compressed snapshot file
+    load(snapshotPath, checkScenario=True):
+        Class method restoring a model from a snapshot, by default checking that its input data has not changed
     getUserCosts(mode=None):
         Returns total user costs
     getModeUserCosts():
@@ -332,17 +744,20 @@ class Model:
     modifyNetworks(networkModification=None, scheduleModification=None):
         Used in the optimizer class to edit network after initialization
     resetNetworks():
-        Reset network to original initialization
+        Reset network lengths and headways to original initialization
+    refreshParams():
+        Propagate changes to the subnetwork and mode tables in scenarioData to the networks. Changes made through
+        scenarioData.patch() and revert() are picked up by this automatically the next time the microtypes are used
     setTimePeriod(timePeriod: str):
 
     getModeSpeeds(timePeriod=None):
         Returns speeds for each mode in each microtype
     """
 
-    def __init__(self, path: str):
+    def __init__(self, path: str, equilibriumMethod="msa", equilibriumTolerance=1e-4, equilibriumMaxIterations=20):
         self.__path = path
-        self.scenarioData = ScenarioData(path)
         self.__initialScenarioData = ScenarioData(path)
+        self.scenarioData = self.__initialScenarioData.overlay()
         self.__currentTimePeriod = None
         self.__microtypes = dict()  # MicrotypeCollection(self.modeData.data)
         self.__demand = dict()  # Demand()
@@ -355,6 +770,11 @@ class Model:
         self.__originDestination = OriginDestination()
         self.__transitionMatrices = TransitionMatrices()
         self.__networkStateData = dict()
+        self.__paramsVersion = self.scenarioData.version
+        self.__paramsChecksum = None
+        self.equilibriumMethod = equilibriumMethod
+        self.equilibriumTolerance = equilibriumTolerance
+        self.equilibriumMaxIterations = equilibriumMaxIterations
         self.readFiles()
         self.initializeAllTimePeriods()
 
@@ -364,11 +784,13 @@ class Model:
 
     @property
     def microtypes(self):
+        self.__refreshIfPatched()
         if self.__currentTimePeriod not in self.__microtypes:
             self.__microtypes[self.__currentTimePeriod] = MicrotypeCollection(self.scenarioData["modeData"])
         return self.__microtypes[self.__currentTimePeriod]
 
     def getMicrotypeCollection(self, timePeriod) -> MicrotypeCollection:
+        self.__refreshIfPatched()
         return self.__microtypes[timePeriod]
 
     @property
@@ -408,8 +830,8 @@ class Model:
     def initializeTimePeriod(self, timePeriod: str):
         self.__currentTimePeriod = timePeriod
         if timePeriod not in self.__microtypes:
-            print("-------------------------------")
-            print("|  Loading time period ", timePeriod, " ", self.__timePeriods.getTimePeriodName(timePeriod))
+            logger.info("-------------------------------")
+            logger.info("|  Loading time period %s %s", timePeriod, self.__timePeriods.getTimePeriodName(timePeriod))
         self.microtypes.importMicrotypes(self.scenarioData["subNetworkData"], self.scenarioData["modeToSubNetworkData"],
                                          self.scenarioData["microtypeIDs"])
         self.__originDestination.initializeTimePeriod(timePeriod, self.__timePeriods.getTimePeriodName(timePeriod))
@@ -423,19 +845,47 @@ class Model:
         self.__transitionMatrices.adoptMicrotypes(self.scenarioData["microtypeIDs"])
         for timePeriod, durationInHours in self.__timePeriods:
             self.initializeTimePeriod(timePeriod)
-            print('Done Initializing')
-
-    def findEquilibrium(self):
-        diff = 1000.
-        i = 0
-        while (diff > 0.0001) & (i < 20):
-            ms = self.getModeSplit(self.__currentTimePeriod)
-            # print(ms)
-            self.demand.updateMFD(self.microtypes)
-            self.choice.updateChoiceCharacteristics(self.microtypes, self.__trips)
-            diff = self.demand.updateModeSplit(self.choice, self.__originDestination, ms)
-            # print(diff)
-            i += 1
+            logger.info("Done Initializing")
+
+    def findEquilibrium(self, method=None, tolerance=None, maxIterations=None) -> EquilibriumResult:
+        if method is None:
+            method = self.equilibriumMethod
+        if tolerance is None:
+            tolerance = self.equilibriumTolerance
+        if maxIterations is None:
+            maxIterations = self.equilibriumMaxIterations
+        getInstrumentation().setContext(timePeriod=self.__currentTimePeriod, solver=method)
+        problem = EquilibriumProblem(self.demand, self.microtypes, self.choice, self.__trips,
+                                     self.__originDestination, lambda: self.getModeSplit(self.__currentTimePeriod))
+        return SOLVERS[method](problem, tolerance=tolerance, maxIterations=maxIterations)
+
+    def getEquilibriumState(self) -> dict:
+        modeSplits = {tp: (demand.modeSplits.splits.copy(), demand.modeSplits.counter) for tp, demand in
+                      self.__demand.items()}
+        return {"modeSplits": modeSplits, "currentTimePeriod": self.__currentTimePeriod,
+                "networkStateData": deepcopy(self.__networkStateData)}
+
+    def setEquilibriumState(self, state: dict, freshCounter=False):
+        for tp, (splits, counter) in state["modeSplits"].items():
+            modeSplits = self.__demand[tp].modeSplits
+            modeSplits.splits = splits.copy()
+            modeSplits.counter = 1.0 if freshCounter else counter
+        self.__currentTimePeriod = state["currentTimePeriod"]
+        self.__networkStateData = deepcopy(state["networkStateData"])
+
+    def save(self, snapshotPath: str):
+        ModelSnapshot(snapshotPath).save(self, os.path.abspath(self.__path), ScenarioCache(self.__path).scenarioHash())
+
+    @classmethod
+    def load(cls, snapshotPath: str, checkScenario=True):
+        snapshot = ModelSnapshot(snapshotPath)
+        path = snapshot.header()["path"]
+        if checkScenario and os.path.isdir(path):
+            model = snapshot.load(ScenarioCache(path).scenarioHash())
+        else:
+            model = snapshot.load()
+        logger.info("|  Loaded model snapshot %s", snapshotPath)
+        return model
 
     def getModeSplit(self, timePeriod=None, userClass=None, microtypeID=None, distanceBin=None):
         if timePeriod is None:
@@ -464,20 +914,31 @@ class Model:
 
     def modifyNetworks(self, networkModification=None,
                        scheduleModification=None):
-        originalScenarioData = self.__initialScenarioData.copy()
         if networkModification is not None:
             for ((fromNetwork, toNetwork), laneDistance) in networkModification:
-                oldFromLaneDistance = originalScenarioData["subNetworkData"].loc[fromNetwork, "Length"]
-                self.scenarioData["subNetworkData"].loc[fromNetwork, "Length"] = oldFromLaneDistance - laneDistance
-                oldToLaneDistance = originalScenarioData["subNetworkData"].loc[toNetwork, "Length"]
-                self.scenarioData["subNetworkData"].loc[toNetwork, "Length"] = oldToLaneDistance + laneDistance
+                oldFromLaneDistance = self.scenarioData.original("subNetworkData", fromNetwork, "Length")
+                self.scenarioData.patch("subNetworkData", fromNetwork, "Length", oldFromLaneDistance - laneDistance)
+                oldToLaneDistance = self.scenarioData.original("subNetworkData", toNetwork, "Length")
+                self.scenarioData.patch("subNetworkData", toNetwork, "Length", oldToLaneDistance + laneDistance)
 
         if scheduleModification is not None:
             for ((microtypeID, modeName), newHeadway) in scheduleModification:
-                self.scenarioData["modeData"][modeName].loc[microtypeID, "Headway"] = newHeadway
+                self.scenarioData.patch(("modeData", modeName), microtypeID, "Headway", newHeadway)
 
     def resetNetworks(self):
-        self.scenarioData = self.__initialScenarioData.copy()
+        self.scenarioData.revert()
+
+    def refreshParams(self):
+        """Propagate changes to the subnetwork and mode tables in scenarioData to the networks and modes"""
+        for microtypes in self.__microtypes.values():
+            microtypes.refreshParams()
+        self.__paramsVersion = self.scenarioData.version
+        self.__paramsChecksum = self.scenarioData.checksum()
+
+    def __refreshIfPatched(self):
+        if (self.scenarioData.version != self.__paramsVersion) or (
+                self.scenarioData.checksum() != self.__paramsChecksum):
+            self.refreshParams()
 
     def setTimePeriod(self, timePeriod: str):
         """Note: Are we always going to go through them in order? Should maybe just store time periods
@@ -499,8 +960,9 @@ class Model:
             userCosts += self.getUserCosts() * durationInHours
             operatorCosts += self.getOperatorCosts() * durationInHours
             self.__networkStateData[timePeriod] = self.microtypes.getStateData()
-            print(self.getModeSplit(self.__currentTimePeriod))
-            print(self.getModeSpeeds())
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("%s", self.getModeSplit(self.__currentTimePeriod))
+                logger.debug("%s", self.getModeSpeeds())
         return userCosts, operatorCosts
 
     def getModeSpeeds(self, timePeriod=None):
@@ -508,7 +970,7 @@ class Model:
             timePeriod = self.__currentTimePeriod
         return pd.DataFrame(self.__microtypes[timePeriod].getModeSpeeds())
 
-    def plotAllDynamicStats(self, type):
+    def plotAllDynamicStats(self, type, record=1):
         ts = []
         vs = []
         ns = []
@@ -517,7 +979,8 @@ class Model:
         for id, dur in self.__timePeriods:
             out = self.getMicrotypeCollection(id).transitionMatrixMFD(dur, self.getNetworkStateData(id),
                                                                       self.getMicrotypeCollection(
-                                                                          id).getModeStartRatePerSecond("auto"))
+                                                                          id).getModeStartRatePerSecond("auto"),
+                                                                      record=record)
 
             ts.append(out['t'] / 3600. + runningTotal)
             vs.append(out['v'])
@@ -540,11 +1003,11 @@ class Model:
             # plt.plot(x, y)
             return x, y
         else:
-            print('WTF')
-        print('AA')
+            logger.error("Unknown dynamic stat %s", type)
 
 
 if __name__ == "__main__":
+    enableLogging()
     a = Model("input-data-geotype-A")
     userCosts, operatorCosts = a.collectAllCosts()
     ms = a.getModeSplit()
@@ -0,0 +1,260 @@
+import itertools
+import os
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+
+from model import Model
+from utils.warmStart import WarmStartStore
+
+USER_COST_METRICS = ("totalCost", "demandForTripsPerHour", "demandForPMTPerHour", "inVehicleTime", "outOfVehicleTime")
+
+
+class Parameter:
+    """
+    One swept scenario input: a name, the values it takes, and the scenario cells to patch for each value.
+    Subclasses implement patches(); they are sent to worker processes, so they should only hold plain data.
+
+    Attributes
+    ----------
+    name : str
+        Column name of the parameter in the sweep results
+    values : list
+        Values the parameter takes
+
+    Methods
+    -------
+    patches(value, scenarioData):
+        Cells to patch for value, as a dict {(table key, row, column): new value}. Table keys are those of
+        ScenarioData.patch, e.g. "subNetworkData" or ("modeData", "bus").
+    """
+
+    def __init__(self, name: str, values):
+        self.name = name
+        self.values = list(values)
+
+    def patches(self, value, scenarioData) -> dict:
+        raise NotImplementedError
+
+
+class CellParameter(Parameter):
+    """Sets one column of several rows of a table to the value, e.g. the jam density or vMax of subnetworks"""
+
+    def __init__(self, name: str, values, key, rows, column: str):
+        super().__init__(name, values)
+        self.key = key
+        self.rows = list(rows)
+        self.column = column
+
+    def patches(self, value, scenarioData) -> dict:
+        return {(self.key, row, self.column): value for row in self.rows}
+
+
+class HeadwayParameter(CellParameter):
+    """Sets the headway of a transit mode in one microtype"""
+
+    def __init__(self, name: str, values, microtypeID: str, mode: str):
+        super().__init__(name, values, ("modeData", mode), [microtypeID], "Headway")
+
+
+class LaneReallocationParameter(Parameter):
+    """Moves a lane distance from one subnetwork to another, relative to their original lengths"""
+
+    def __init__(self, name: str, distances, fromSubNetworkID, toSubNetworkID):
+        super().__init__(name, distances)
+        self.fromSubNetworkID = fromSubNetworkID
+        self.toSubNetworkID = toSubNetworkID
+
+    def patches(self, distance, scenarioData) -> dict:
+        fromLength = scenarioData.original("subNetworkData", self.fromSubNetworkID, "Length")
+        toLength = scenarioData.original("subNetworkData", self.toSubNetworkID, "Length")
+        return {("subNetworkData", self.fromSubNetworkID, "Length"): fromLength - distance,
+                ("subNetworkData", self.toSubNetworkID, "Length"): toLength + distance}
+
+
+class Sweep:
+    """
+    Runs a scenario at every point of a grid (or list) of parameter values and collects the results in one tidy
+    table. The scenario is loaded once per process, and points are handed out one at a time in grid order. Each
+    process starts a point from the equilibrium of the nearest point it has already solved, with a fresh MSA damping
+    schedule.
+
+    Attributes
+    ----------
+    path : str
+        File path to input data
+    parameters : list
+        Parameter objects (CellParameter, HeadwayParameter, LaneReallocationParameter, ...) to sweep over
+    combine : str
+        "grid" for every combination of the parameter values, or "zip" to vary them together
+    nWorkers : int | None
+        Number of worker processes, or None to run in this process
+    equilibriumMethod : str | None
+        Equilibrium solver to use instead of the Model default
+    outputPath : str | None
+        If set, this csv is overwritten at the start of run() and the rows of each point are appended as it finishes
+    snapshotPath : str | None
+        Model snapshot (see Model.save) for each process to load instead of initializing the scenario from path
+    groupModeSplits : bool
+        Also report the mode splits of every population group, microtype, population group in a microtype and
+        distance bin in each time period
+
+    Methods
+    -------
+    points():
+        List of dicts of parameter values, one per point
+    run():
+        Evaluate every point and return the results as a DataFrame with columns point, the parameter names,
+        timePeriod, microtypeID, populationGroup, distanceBin, mode, metric and value
+    """
+
+    def __init__(self, path: str, parameters: list, combine="grid", nWorkers=None, equilibriumMethod=None,
+                 outputPath=None, snapshotPath=None, groupModeSplits=False):
+        self.path = path
+        self.parameters = parameters
+        self.combine = combine
+        self.nWorkers = nWorkers
+        self.equilibriumMethod = equilibriumMethod
+        self.outputPath = outputPath
+        self.snapshotPath = snapshotPath
+        self.groupModeSplits = groupModeSplits
+
+    def points(self) -> list:
+        names = [parameter.name for parameter in self.parameters]
+        if self.combine == "grid":
+            combinations = itertools.product(*[parameter.values for parameter in self.parameters])
+        elif self.combine == "zip":
+            combinations = zip(*[parameter.values for parameter in self.parameters])
+        else:
+            raise ValueError("Unknown way to combine parameters: " + str(self.combine))
+        return [dict(zip(names, values)) for values in combinations]
+
+    def run(self) -> pd.DataFrame:
+        points = list(enumerate(self.points()))
+        results = []
+        if (self.outputPath is not None) and os.path.isfile(self.outputPath):
+            os.remove(self.outputPath)
+        initargs = (self.path, self.parameters, self.equilibriumMethod, self.snapshotPath, self.groupModeSplits)
+        if (self.nWorkers is not None) and (self.nWorkers > 1) and (len(points) > 1):
+            with Pool(min(self.nWorkers, len(points)), initializer=_initializeSweepWorker, initargs=initargs) as pool:
+                for result in pool.imap_unordered(_runSweepPoint, points):
+                    self.collect(result, results)
+        else:
+            _initializeSweepWorker(*initargs)
+            for point in points:
+                self.collect(_runSweepPoint(point), results)
+        if not results:
+            return pd.DataFrame()
+        return pd.concat(results, ignore_index=True).sort_values(["point"], kind="stable", ignore_index=True)
+
+    def collect(self, result: pd.DataFrame, results: list):
+        results.append(result)
+        if self.outputPath is not None:
+            result.to_csv(self.outputPath, mode="a", index=False, header=not os.path.isfile(self.outputPath))
+
+
+def pointResults(model: Model, userCosts, operatorCosts, groupModeSplits=False) -> pd.DataFrame:
+    """Tidy rows of speeds, mode splits, user costs and operator costs of a solved model"""
+    rows = []
+    for timePeriod in model.scenarioData["timePeriods"].index:
+        for (mode, microtypeID), speed in model.getModeSpeeds(timePeriod).stack().items():
+            rows.append((timePeriod, microtypeID, None, None, mode, "speed", speed))
+        for mode, split in model.getModeSplit(timePeriod)._mapping.items():
+            rows.append((timePeriod, None, None, None, mode, "modeSplit", split))
+        if groupModeSplits:
+            rows += groupModeSplitRows(model, timePeriod)
+    for mode, split in model.getModeSplit()._mapping.items():
+        rows.append((None, None, None, None, mode, "modeSplit", split))
+    byModeAndMicrotype = userCosts.toDataFrame().groupby(level=["mode", "homeMicrotype"]).agg("sum")
+    for (mode, microtypeID), values in byModeAndMicrotype.iterrows():
+        for metric in USER_COST_METRICS:
+            rows.append((None, microtypeID, None, None, mode, metric, values[metric]))
+    for (microtypeID, mode), cost in operatorCosts.toDataFrame().stack().items():
+        rows.append((None, microtypeID, None, None, mode, "operatorCost", cost))
+    rows.append((None, None, None, None, None, "totalUserCost", userCosts.total))
+    rows.append((None, None, None, None, None, "totalOperatorCost", operatorCosts.total))
+    return pd.DataFrame(rows, columns=["timePeriod", "microtypeID", "populationGroup", "distanceBin", "mode", "metric",
+                                       "value"])
+
+
+def groupModeSplitRows(model: Model, timePeriod) -> list:
+    """Mode split rows of each population group, microtype, population group in a microtype and distance bin"""
+    populations = model.scenarioData["populations"]
+    populationGroups = populations["PopulationGroupTypeID"].unique()
+    microtypeIDs = populations["MicrotypeID"].unique()
+    groups = [(None, populationGroup, None) for populationGroup in populationGroups]
+    for microtypeID in microtypeIDs:
+        groups.append((microtypeID, None, None))
+        groups += [(microtypeID, populationGroup, None) for populationGroup in populationGroups]
+    groups += [(None, None, distanceBin) for distanceBin in model.scenarioData["distanceBins"]["DistanceBinID"].unique()]
+    rows = []
+    for microtypeID, populationGroup, distanceBin in groups:
+        modeSplit = model.getModeSplit(timePeriod, userClass=populationGroup, microtypeID=microtypeID,
+                                       distanceBin=distanceBin)
+        for mode, split in modeSplit._mapping.items():
+            rows.append((timePeriod, microtypeID, populationGroup, distanceBin, mode, "modeSplit", split))
+    return rows
+
+
+_sweepModel = None
+_sweepParameters = []
+_sweepGroupModeSplits = False
+_sweepWarmStates = None
+
+
+def _initializeSweepWorker(path: str, parameters: list, equilibriumMethod=None, snapshotPath=None,
+                           groupModeSplits=False):
+    global _sweepModel, _sweepParameters, _sweepGroupModeSplits, _sweepWarmStates
+    if snapshotPath is not None:
+        _sweepModel = Model.load(snapshotPath)
+    else:
+        _sweepModel = Model(path)
+    if equilibriumMethod is not None:
+        _sweepModel.equilibriumMethod = equilibriumMethod
+    _sweepParameters = parameters
+    _sweepGroupModeSplits = groupModeSplits
+    # Distances between points are measured relative to the range each parameter is swept over
+    scale = [np.ptp(np.asarray(parameter.values, dtype=float)) if _isNumeric(parameter.values) else 1.0 for
+             parameter in parameters]
+    _sweepWarmStates = WarmStartStore(scale=np.array([s if s > 0 else 1.0 for s in scale]))
+
+
+def _isNumeric(values) -> bool:
+    try:
+        np.asarray(values, dtype=float)
+        return True
+    except (TypeError, ValueError):
+        return False
+
+
+def _pointVector(values: dict):
+    """Parameter values of a point as a vector, or None if some of them are not numbers"""
+    pointValues = [values[parameter.name] for parameter in _sweepParameters]
+    return np.asarray(pointValues, dtype=float) if _isNumeric(pointValues) else None
+
+
+def _evaluateSweepPoint(pointIdx: int, values: dict, warmState=None) -> pd.DataFrame:
+    model = _sweepModel
+    model.scenarioData.revert()
+    for parameter in _sweepParameters:
+        for (key, row, column), value in parameter.patches(values[parameter.name], model.scenarioData).items():
+            model.scenarioData.patch(key, row, column, value)
+    if warmState is not None:
+        model.setEquilibriumState(warmState, freshCounter=True)
+    userCosts, operatorCosts = model.collectAllCosts()
+    out = pointResults(model, userCosts, operatorCosts, _sweepGroupModeSplits)
+    for name, value in reversed(list(values.items())):
+        out.insert(0, name, value)
+    out.insert(0, "point", pointIdx)
+    return out
+
+
+def _runSweepPoint(point: tuple) -> pd.DataFrame:
+    pointIdx, values = point
+    x = _pointVector(values)
+    warmState = None if x is None else _sweepWarmStates.nearest(x)[1]
+    result = _evaluateSweepPoint(pointIdx, values, warmState)
+    if x is not None:
+        _sweepWarmStates.add(x, _sweepModel.getEquilibriumState())
+    return result
@@ -0,0 +1,79 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.sparse import issparse
+
+from utils.OD import TransitionMatrices, TransitionMatrix, ODindex, CollectedModeSplits, DemandIndex, ModeSplit
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+@pytest.fixture
+def transitionMatrices():
+    df = pd.read_csv(ROOT_DIR + "/../input-data/TransitionMatrices.csv",
+                     dtype={"OriginMicrotypeID": str, "DestinationMicrotypeID": str, "From": str}).set_index(
+        ["OriginMicrotypeID", "DestinationMicrotypeID", "DistanceBinID", "From"])
+    microtypes = pd.read_csv(ROOT_DIR + "/../input-data/Microtypes.csv", dtype={"MicrotypeID": str})
+    out = TransitionMatrices()
+    out.importTransitionMatrices(df)
+    out.adoptMicrotypes(microtypes)
+    return out
+
+
+def test_transition_matrix_tensor(transitionMatrices):
+    odi = ODindex("A", "B", "short")
+    assert odi in transitionMatrices
+    np.testing.assert_allclose(transitionMatrices.getArray(odi), transitionMatrices[odi].matrix.to_numpy())
+
+    missing = ODindex("A", "B", "nowhere")
+    assert transitionMatrices.slot(missing) == -1
+    np.testing.assert_allclose(transitionMatrices.getArray(missing), transitionMatrices[missing].matrix.to_numpy())
+    default = transitionMatrices[missing]
+    assert transitionMatrices[ODindex("B", "A", "nowhere")] is default
+    np.testing.assert_array_equal(default.diameters, transitionMatrices[odi].diameters)
+    with pytest.raises(ValueError):
+        default.addAndMultiply(default, 1.0)
+
+
+def test_transition_matrix_memmap(transitionMatrices, tmp_path):
+    path = str(tmp_path / "transitionMatrices.npy")
+    transitionMatrices.save(path)
+    loaded = TransitionMatrices().load(path)
+    assert isinstance(loaded.tensor, np.memmap)
+    assert loaded.names == transitionMatrices.names
+    odi = ODindex("C", "D", "long")
+    np.testing.assert_array_equal(loaded.getArray(odi), transitionMatrices.getArray(odi))
+
+
+def test_sparse_transition_operator(transitionMatrices):
+    names = ["M" + str(idx) for idx in range(200)]
+    banded = np.eye(200, k=1) * 0.3 + np.eye(200, k=-1) * 0.2
+    sparse = TransitionMatrix(names, banded).transitionOperator()
+    assert issparse(sparse)
+    np.testing.assert_array_equal(sparse.toarray(), banded.T)
+    assert not issparse(TransitionMatrix(names, banded).transitionOperator(sparse=False))
+
+    odi = next(iter(transitionMatrices._TransitionMatrices__slots))
+    dense = transitionMatrices[ODindex(*odi)]
+    assert dense.density() > 0.1
+    assert not issparse(dense.transitionOperator())
+
+
+def test_collected_mode_splits():
+    keys = [(DemandIndex("A", "Low", "work"), ODindex("A", "B", "short")),
+            (DemandIndex("A", "Low", "work"), ODindex("A", "A", "short"))]
+    store = CollectedModeSplits()
+    store.initialize(keys, [{"auto", "bus"}, {"auto", "walk"}],
+                     [{"auto": 1.0, "bus": 0.0}, {"auto": 1.0, "walk": 0.0}], np.array([2.0, 1.0]),
+                     np.array([4.0, 1.0]))
+    assert store.modes == ["auto", "bus", "walk"]
+    assert set(store[keys[0]].keys()) == {"auto", "bus"}
+    np.testing.assert_allclose(store.flows()[:, store.modeIdx("auto")], [2.0, 1.0])
+
+    newSplits = np.array([[0.5, 0.5, 0.0], [0.2, 0.0, 0.8]])
+    store.blend(newSplits, ModeSplit({"auto": 1.0, "bus": 0.0, "walk": 0.0}))
+    np.testing.assert_allclose(store.splits, newSplits)
+    store.blend(np.array([[1.0, 0.0, 0.0], [1.0, 0.0, 0.0]]), ModeSplit({"auto": 0.0, "bus": 1.0, "walk": 1.0}))
+    np.testing.assert_allclose(store.splits, [[0.5, 0.5, 0.0], [0.5, 0.0, 0.5]])
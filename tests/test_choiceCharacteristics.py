@@ -0,0 +1,62 @@
+import os
+
+import numpy as np
+
+from model import Model
+from utils.choiceCharacteristics import ChoiceCharacteristics, CHARACTERISTIC_FIELDS, filterAllocation
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def test_incremental_update_matches_full_rebuild():
+    a = Model(ROOT_DIR + "/../input-data")
+    a.initializeTimePeriod(1)
+    a.findEquilibrium()
+    trips = a._Model__trips
+    odIndices = [odi for odi, trip in trips]
+    modes = sorted(a.scenarioData["modeData"].keys())
+
+    a.modifyNetworks(scheduleModification=[(("A", "bus"), 120.)])
+    a.demand.updateMFD(a.microtypes)
+    changed = a.choice.changedInputs(a.microtypes)
+    assert ("A", "bus") in changed
+    assert a.choice.changedInputs(a.microtypes).keys() == changed.keys()  # Only committing the inputs stores them
+    a.choice.updateChoiceCharacteristics(a.microtypes, trips, incremental=True)
+    incremental = a.choice.toArray(odIndices, modes)
+    a.choice.updateChoiceCharacteristics(a.microtypes, trips, incremental=False)
+    full = a.choice.toArray(odIndices, modes)
+    np.testing.assert_array_equal(incremental, full)
+
+    # Nothing changed since the last update, so nothing is recalculated
+    assert not a.choice.changedInputs(a.microtypes)
+
+
+def test_sparse_assembly_matches_microtype_methods():
+    a = Model(ROOT_DIR + "/../input-data")
+    a.initializeTimePeriod(1)
+    a.findEquilibrium()
+    trips = a._Model__trips
+    distanceBins = a._Model__distanceBins
+    for odIndex, trip in trips:
+        mcc = a.choice[odIndex]
+        for mode in mcc.modes():
+            expected = ChoiceCharacteristics()
+            expected += a.microtypes[odIndex.o].getStartTimeCostWait(mode)
+            expected += a.microtypes[odIndex.d].getEndTimeCostWait(mode)
+            for microtypeID, allocation in filterAllocation(mode, trip.allocation, a.microtypes).items():
+                expected += a.microtypes[microtypeID].getThroughTimeCostWait(
+                    mode, distanceBins[odIndex.distBin] * allocation)
+            np.testing.assert_allclose([getattr(mcc[mode], field) for field in CHARACTERISTIC_FIELDS],
+                                       [getattr(expected, field) for field in CHARACTERISTIC_FIELDS], rtol=1e-12)
+
+    # Characteristics of an OD are a view on the collected array, so changes to them are kept
+    odIndex = next(iter(trips))[0]
+    mcc = a.choice[odIndex]
+    mode = mcc.modes()[0]
+    cost = mcc[mode].cost
+    mcc[mode].travel_time = 0.5
+    mcc[mode] += ChoiceCharacteristics(cost=1.0)
+    assert a.choice[odIndex][mode].travel_time == 0.5
+    assert a.choice[odIndex][mode].cost == cost + 1.0
+    mcc.reset()
+    assert not np.any(a.choice.fieldArray([odIndex], [mode]))
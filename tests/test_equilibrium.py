@@ -0,0 +1,23 @@
+import os
+
+import numpy as np
+
+from model import Model
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def test_accelerated_solvers_reach_fixed_point():
+    results = dict()
+    splits = dict()
+    for method in ["msa", "anderson", "newton-krylov"]:
+        a = Model(ROOT_DIR + "/../input-data")
+        a.initializeTimePeriod(1)
+        results[method] = a.findEquilibrium(method, tolerance=1e-6, maxIterations=30)
+        splits[method] = a.demand.modeSplits.splits.copy()
+        assert results[method].iterations <= 30
+
+    assert results["anderson"].converged
+    assert results["newton-krylov"].converged
+    assert results["anderson"].evaluations < results["msa"].evaluations
+    np.testing.assert_allclose(splits["anderson"], splits["newton-krylov"], atol=1e-5)
@@ -0,0 +1,78 @@
+import io
+import json
+import logging
+import os
+
+from model import Model
+from utils.instrumentation import Instrumentation, NullInstrumentation, getInstrumentation
+from utils.log import enableLogging, disableLogging
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def test_equilibrium_instrumentation():
+    a = Model(ROOT_DIR + "/../input-data")
+    a.initializeTimePeriod(1)
+    sink = io.StringIO()
+    with Instrumentation(sink) as recorder:
+        assert getInstrumentation() is recorder
+        result = a.findEquilibrium()
+    assert isinstance(getInstrumentation(), NullInstrumentation)
+
+    assert len(recorder.records) == result.iterations
+    lines = [json.loads(line) for line in sink.getvalue().splitlines()]
+    assert [line["iteration"] for line in lines] == list(range(result.iterations))
+    for line in lines:
+        assert line["timePeriod"] == 1
+        assert line["solver"] == "msa"
+        assert line["updateMFD"] > 0
+        assert line["mfdIterations"] > 0
+        assert line["nef"] > 0
+    assert lines[-1]["residual"] == result.residual
+    assert recorder.totals["nef"] == sum(line["nef"] for line in lines)
+
+
+def test_quiet_logging_and_events(capsys):
+    a = Model(ROOT_DIR + "/../input-data")
+    a.initializeTimePeriod(1)
+    a.findEquilibrium()
+    captured = capsys.readouterr()
+    assert captured.out == ""
+    assert captured.err == ""
+
+    with Instrumentation(eventLevel=logging.DEBUG) as recorder:
+        result = a.findEquilibrium()
+    modeSplits = [event for event in recorder.events if event["event"] == "modeSplit"]
+    assert len(modeSplits) == result.iterations
+    assert set(modeSplits[-1]["modeSplit"].toDict().keys()) == set(a.getModeSplit(1).toDict().keys())
+    assert all(event["timePeriod"] == 1 for event in modeSplits)
+    assert len([event for event in recorder.events if event["event"] == "mfdSpeeds"]) > 0
+    assert capsys.readouterr().out == ""
+
+    recorder = Instrumentation(eventLevel=logging.DEBUG)
+    a.findEquilibrium()
+    assert recorder.events == []
+
+    handler = enableLogging(logging.INFO, stream=io.StringIO())
+    try:
+        b = Model(ROOT_DIR + "/../input-data")
+        assert "Loaded" in handler.stream.getvalue()
+        b.findEquilibrium()
+        assert "auto: " not in handler.stream.getvalue()
+    finally:
+        disableLogging(handler)
+
+
+def test_event_level_does_not_change_console_level():
+    a = Model(ROOT_DIR + "/../input-data")
+    a.initializeTimePeriod(1)
+    console = enableLogging(logging.INFO, stream=io.StringIO())
+    try:
+        with Instrumentation(eventLevel=logging.DEBUG) as recorder:
+            a.findEquilibrium()
+        assert len(recorder.events) > 0
+        assert "auto: " not in console.stream.getvalue()
+        assert logging.getLogger("gesm").getEffectiveLevel() == logging.INFO
+    finally:
+        disableLogging(console)
+    assert logging.getLogger("gesm").level == logging.NOTSET
@@ -0,0 +1,90 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from utils.mfd import integrateEuler, integrateAdaptive, integrateSteadyState, solveSteadyState
+
+L = np.array([3000., 5000.])
+X = np.array([[0.0, 0.2], [0.3, 0.0]])
+V_0 = np.array([16., 18.])
+N_0 = np.array([2000., 3000.])
+n_other = np.array([10., 0.])
+
+
+def test_adaptive_matches_fine_euler():
+    demand = np.array([0.5, 0.8])
+    n_init = np.array([100., 50.])
+    fine = integrateEuler(n_init, demand, L, X, V_0, N_0, n_other, 3.0, dt=1.0)
+    adaptive = integrateAdaptive(n_init, demand, L, X, V_0, N_0, n_other, 3.0, rtol=1e-8, atol=1e-6)
+    np.testing.assert_allclose(adaptive["n_max"], fine["n_max"], rtol=1e-3)
+    np.testing.assert_allclose(adaptive["v_av"], fine["v_av"], rtol=1e-3)
+    np.testing.assert_allclose(adaptive["n_final"], fine["n_final"], rtol=1e-3)
+    assert adaptive["steps"] < fine["steps"] / 10
+
+
+def test_adaptive_stops_at_jam():
+    demand = np.array([5.0, 0.1])
+    adaptive = integrateAdaptive(np.zeros(2), demand, L, X, V_0, N_0, n_other, 7.0, record=1)
+    assert np.all(np.isfinite(adaptive["v_av"]))
+    assert np.all(adaptive["n"] <= (N_0 - n_other)[:, None] * (1 + 1e-9))
+    assert adaptive["n_final"][0] == (N_0 - n_other)[0]
+    assert adaptive["v_final"][0] == 0.1
+    assert adaptive["time_jammed"][0] > 0.0
+    assert adaptive["time_jammed"][1] == 0.0
+
+
+def test_streaming_aggregates_match_recorded_trajectory():
+    demand = np.array([0.3, 0.2])
+    n_init = np.array([100., 50.])
+    streamed = integrateEuler(n_init, demand, L, X, V_0, N_0, n_other, 2.0)
+    recorded = integrateEuler(n_init, demand, L, X, V_0, N_0, n_other, 2.0, record=1)
+    decimated = integrateEuler(n_init, demand, L, X, V_0, N_0, n_other, 2.0, record=7)
+    assert streamed["n"] is None
+    np.testing.assert_allclose(streamed["v_av"], np.mean(recorded["v"], axis=1), rtol=1e-12)
+    np.testing.assert_array_equal(streamed["n_max"], np.maximum(n_init, np.max(recorded["n"], axis=1)))
+    np.testing.assert_array_equal(streamed["n_final"], recorded["n"][:, -1])
+    np.testing.assert_array_equal(decimated["n"], recorded["n"][:, decimated["t"].astype(int) // 72])
+    assert decimated["n"].shape[1] == len(range(0, recorded["n"].shape[1], 7)) + 1
+
+
+def test_sparse_transition_matrix_matches_dense():
+    nMicrotypes = 300
+    X_large = (np.eye(nMicrotypes, k=1) * 0.3 + np.eye(nMicrotypes, k=-1) * 0.2).T
+    args = (np.full(nMicrotypes, 4000.), X_large, np.full(nMicrotypes, 15.), np.full(nMicrotypes, 2000.),
+            np.zeros(nMicrotypes))
+    demand = np.linspace(0.05, 0.5, nMicrotypes)
+    dense = integrateEuler(np.zeros(nMicrotypes), demand, args[0], args[1], *args[2:], 1.0)
+    sparse = integrateEuler(np.zeros(nMicrotypes), demand, args[0], csr_matrix(args[1]), *args[2:], 1.0)
+    np.testing.assert_allclose(sparse["v_av"], dense["v_av"], rtol=1e-12)
+    np.testing.assert_allclose(sparse["n_final"], dense["n_final"], rtol=1e-12)
+
+
+def test_steady_state_shortcut():
+    demand = np.array([0.3, 0.2])
+    n_init = np.array([100., 50.])
+    n_ss, J, iterations = solveSteadyState(n_init, demand, L, X, V_0, N_0, n_other)
+    outflow = V_0 * n_ss / L * (1. - (n_ss + n_other) / N_0)
+    np.testing.assert_allclose(demand + X @ outflow, outflow, rtol=1e-8)
+
+    fine = integrateEuler(n_init, demand, L, X, V_0, N_0, n_other, 3.0, dt=1.0)
+    shortcut = integrateSteadyState(n_init, demand, L, X, V_0, N_0, n_other, 3.0, record=1)
+    assert shortcut["steps"] < 10
+    np.testing.assert_allclose(shortcut["v_av"], fine["v_av"], rtol=1e-4)
+    np.testing.assert_allclose(shortcut["n_final"], fine["n_final"], rtol=1e-6)
+    np.testing.assert_allclose(shortcut["n"][:, 0], n_init)
+    np.testing.assert_allclose(shortcut["n"][:, -1], n_ss, rtol=1e-6)
+    np.testing.assert_allclose(integrateSteadyState(n_init, demand, L, X, V_0, N_0, n_other, 3.0)["n_max"],
+                               shortcut["n_max"], rtol=1e-6)
+    sparse = integrateSteadyState(n_init, demand, L, csr_matrix(X), V_0, N_0, n_other, 3.0)
+    np.testing.assert_allclose(sparse["v_av"], shortcut["v_av"], rtol=1e-10)
+
+    # Too short to settle, and oversaturated: both are integrated in time instead
+    short = integrateSteadyState(n_init, demand, L, X, V_0, N_0, n_other, 0.1)
+    assert short["steps"] == integrateEuler(n_init, demand, L, X, V_0, N_0, n_other, 0.1)["steps"]
+    jammed = integrateSteadyState(np.zeros(2), np.array([5.0, 0.1]), L, X, V_0, N_0, n_other, 7.0)
+    np.testing.assert_array_equal(jammed["v_av"],
+                                  integrateEuler(np.zeros(2), np.array([5.0, 0.1]), L, X, V_0, N_0, n_other, 7.0)["v_av"])
+    adaptive = integrateSteadyState(np.zeros(2), np.array([5.0, 0.1]), L, X, V_0, N_0, n_other, 7.0,
+                                    fallback=integrateAdaptive)
+    np.testing.assert_array_equal(adaptive["v_av"],
+                                  integrateAdaptive(np.zeros(2), np.array([5.0, 0.1]), L, X, V_0, N_0, n_other,
+                                                    7.0)["v_av"])
@@ -1,13 +1,16 @@
 import os
+import pathlib
+import tempfile
 
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
+import pytest
 
 from model import Model
 
 
-def test_find_equilibrium():
+def test_find_equilibrium(tmp_path):
     ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
     a = Model(ROOT_DIR + "/../input-data")
     a.initializeTimePeriod(1)
@@ -70,18 +73,14 @@ def test_find_equilibrium():
     plt.legend()
     # plt.xlabel("Bus Lane Distance In Microtype A")
     # plt.ylabel("Bus Speed In Microtype A")
-    if not os.path.exists(ROOT_DIR + "/../plots"):
-        os.mkdir(ROOT_DIR + "/../plots")
-    plt.savefig(ROOT_DIR + "/../plots/buslanevsspeed.png")
+    plt.savefig(tmp_path / "buslanevsspeed.png")
 
     plt.clf()
 
     plt.scatter(busLaneDistance, busModeShare)
     plt.xlabel("Bus Lane Distance In Microtype B")
     plt.ylabel("Bus Mode Share")
-    if not os.path.exists(ROOT_DIR + "/../plots"):
-        os.mkdir(ROOT_DIR + "/../plots")
-    plt.savefig(ROOT_DIR + "/../plots/buslanevsmodeshare.png")
+    plt.savefig(tmp_path / "buslanevsmodeshare.png")
 
     plt.clf()
     plt.scatter(busLaneDistance, allCosts)
@@ -91,9 +90,7 @@ def test_find_equilibrium():
     plt.xlabel("Bus Lane Distance In Microtype B")
     plt.ylabel("Costs")
     plt.legend()
-    if not os.path.exists(ROOT_DIR + "/../plots"):
-        os.mkdir(ROOT_DIR + "/../plots")
-    plt.savefig(ROOT_DIR + "/../plots/buslanevscost.png")
+    plt.savefig(tmp_path / "buslanevscost.png")
 
     #    assert busSpeed[-1] / busSpeed[0] > 1.005  # bus lanes speed up bus traffic by a real amount
 
@@ -139,27 +136,54 @@ def test_find_equilibrium():
     plt.legend()
     # plt.xlabel("Bus Lane Distance In Microtype A")
     # plt.ylabel("Bus Speed In Microtype A")
-    if not os.path.exists(ROOT_DIR + "/../plots"):
-        os.mkdir(ROOT_DIR + "/../plots")
-    plt.savefig(ROOT_DIR + "/../plots/headwayvsspeed.png")
+    plt.savefig(tmp_path / "headwayvsspeed.png")
 
     plt.clf()
 
     plt.scatter(headways, busModeShare)
     plt.xlabel("Bus Headway In Microtype A")
     plt.ylabel("Bus Mode Share")
-    if not os.path.exists(ROOT_DIR + "/../plots"):
-        os.mkdir(ROOT_DIR + "/../plots")
-    plt.savefig(ROOT_DIR + "/../plots/headwayvsmodeshare.png")
+    plt.savefig(tmp_path / "headwayvsmodeshare.png")
 
     plt.clf()
     plt.scatter(headways, userCosts)
     # plt.scatter(headways, operatorCosts)
     plt.xlabel("Bus Headway In Microtype A")
     plt.ylabel("User costs")
-    if not os.path.exists(ROOT_DIR + "/../plots"):
-        os.mkdir(ROOT_DIR + "/../plots")
-    plt.savefig(ROOT_DIR + "/../plots/headwayvscost.png")
+    plt.savefig(tmp_path / "headwayvscost.png")
 
 
-test_find_equilibrium()
+def test_snapshot(tmp_path):
+    ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+    snapshotPath = str(tmp_path / "input-data.model.gz")
+    a = Model(ROOT_DIR + "/../input-data")
+    a.modifyNetworks(scheduleModification=[(("A", "bus"), 600.)])
+    a.collectAllCosts()
+    a.save(snapshotPath)
+    b = Model.load(snapshotPath)
+    assert b.scenarioData["modeData"]["bus"].loc["A", "Headway"] == 600.
+    for timePeriod, (splits, counter) in a.getEquilibriumState()["modeSplits"].items():
+        np.testing.assert_array_equal(b.getEquilibriumState()["modeSplits"][timePeriod][0], splits)
+        assert b.getEquilibriumState()["modeSplits"][timePeriod][1] == counter
+    # Resuming from the snapshot continues exactly as the original model would
+    userCostsA, operatorCostsA = a.collectAllCosts()
+    userCostsB, operatorCostsB = b.collectAllCosts()
+    pd.testing.assert_frame_equal(userCostsB.toDataFrame(), userCostsA.toDataFrame())
+    assert operatorCostsB.total == operatorCostsA.total
+
+    with open(snapshotPath, "wb") as f:
+        f.write(b"not a snapshot")
+    with pytest.raises(ValueError):
+        Model.load(snapshotPath)
+
+
+def test_collected_user_costs_total():
+    ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+    a = Model(ROOT_DIR + "/../input-data")
+    userCosts, _ = a.collectAllCosts()
+    assert userCosts.total != 0
+    assert userCosts.total == pytest.approx(userCosts.toDataFrame()["totalCost"].sum())
+
+
+with tempfile.TemporaryDirectory() as plotDirectory:
+    test_find_equilibrium(pathlib.Path(plotDirectory))
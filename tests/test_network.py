@@ -1,8 +1,9 @@
+import numpy as np
 import pandas as pd
 import pandas as pd
 import pytest
 
-from utils.network import Network, AutoMode, BusMode
+from utils.network import Network, AutoMode, BusMode, mph2mps
 
 data = pd.DataFrame(
     {"SubnetworkID": 1, "MicrotypeID": "A", "ModesAllowed": "Auto-Bus", "Dedicated": False, "Length": 1000.0,
@@ -96,3 +97,86 @@ def test_mfd(net):
     # zi = interpolator(Xi, Yi)
     # plt.contourf(Xi, Yi, zi)
     # print("AH")
+
+
+def test_nef_closed_form():
+    from math import sqrt, cosh, sinh, cos, sin
+    from utils.network import nefClosedForm
+
+    def scalarNEF(Q, L, jamDensity, V_0, N_init, t=3 * 3600., L_0=10 * 1609.34):
+        N_0 = jamDensity * L
+        if N_0 ** 2. / 4. >= N_0 * Q / V_0:
+            A = sqrt(N_0 ** 2. / 4. - N_0 * Q / V_0)
+            var = A * V_0 * t / (N_0 * L_0)
+            return N_0 / 2 - A * ((N_0 / 2 - N_init) * cosh(var) + A * sinh(var)) / (
+                    (N_0 / 2 - N_init) * sinh(var) + A * cosh(var))
+        else:
+            Aprime = sqrt(N_0 * Q / V_0 - N_0 ** 2. / 4.)
+            var = Aprime * V_0 * t / (N_0 * L_0)
+            return N_0 / 2 - Aprime * ((N_0 / 2 - N_init) * cos(var) + Aprime * sin(var)) / (
+                    (N_0 / 2 - N_init) * sin(var) + Aprime * cos(var))
+
+    Q = np.array([1.0, 50.0, 800.0, 1500.0])  # The last two exceed capacity
+    L = np.array([1000., 2000., 1000., 1500.])
+    N_final, V_init, V_final, V_steadyState, V_mean = nefClosedForm(Q, L, 0.144, 16.0, 10.0)
+    expected = [scalarNEF(q, l, 0.144, 16.0, 10.0) for q, l in zip(Q, L)]
+    np.testing.assert_allclose(N_final, expected, rtol=1e-10)
+    assert np.all(V_steadyState[2:] == 0.0) & np.all(V_steadyState[:2] > 0.0)
+    np.testing.assert_allclose(V_mean, np.maximum(0.1, (V_init + V_final) / 2.))
+
+
+def test_equal_speed_allocation():
+    from utils.network import equalSpeedAllocation, nefClosedForm
+
+    L = np.array([10000., 4000., 20000.])
+    V_0 = np.array([16., 14., 18.])
+    capacities = 0.144 * L * V_0 / 4. * (1. - 1e-9)
+
+    def speeds(flows):
+        return nefClosedForm(flows + 1e-9, L, 0.144, V_0, 0.0)[4]
+
+    allocation = equalSpeedAllocation(speeds, 16000., 3, capacities)
+    assert np.sum(allocation) == pytest.approx(1.0)
+    assert np.sum(allocation > 0) == 2  # The slowest network isn't worth using
+    equilibriumSpeeds = speeds(allocation * 16000.)
+    assert np.ptp(equilibriumSpeeds[allocation > 0]) < 1e-6 * np.mean(equilibriumSpeeds)
+    assert np.all(equilibriumSpeeds[allocation == 0] <= equilibriumSpeeds[allocation > 0][0])
+
+    # Oversaturated networks are loaded in proportion to their capacity
+    np.testing.assert_allclose(equalSpeedAllocation(speeds, 30000., 3, capacities), capacities / np.sum(capacities))
+
+    # Flow-independent speeds leave the even split in place
+    np.testing.assert_allclose(equalSpeedAllocation(lambda flows: V_0, 1500., 3), 1. / 3.)
+
+
+def test_auto_vmt_allocation_across_networks():
+    from utils.instrumentation import Instrumentation
+
+    networkData = pd.DataFrame(
+        {"SubnetworkID": [1, 2, 3], "MicrotypeID": "A", "ModesAllowed": "Auto", "Dedicated": False,
+         "Length": [10000., 4000., 20000.], "Type": "Road", "vMax": [16., 14., 18.], "avgLinkLength": 50,
+         "densityMax": 0.144}, index=[1, 2, 3])
+    networks = [Network(networkData, idx) for idx in networkData.index]
+    auto = AutoMode(networks, pd.DataFrame({"VehicleSize": 1}, index=["A"]), "A")
+    auto.override = True
+    auto.travelDemand.rateOfPmtPerHour = 35000.0
+    auto.updateDemand()
+    with Instrumentation() as recorder:
+        auto.assignVmtToNetworks()
+    vmt = np.array([auto._VMT[n] for n in networks])
+    speeds = np.array([n.NEF(None, overrideMatrix=True) for n in networks])
+    assert np.sum(vmt) == pytest.approx(35000.0)
+    assert np.sum(vmt > 0) == 2  # The slow, short network isn't worth using yet
+    assert speeds[0] == pytest.approx(speeds[2], rel=1e-8)
+    assert speeds[1] <= speeds[0]
+    assert recorder.totals["nef"] <= 10 * len(networks)
+
+    # Once the long network is loaded to capacity, the others share the rest at a lower speed
+    auto.travelDemand.rateOfPmtPerHour = 40000.0
+    auto.updateDemand()
+    auto.assignVmtToNetworks()
+    vmt = np.array([auto._VMT[n] for n in networks])
+    speeds = np.array([n.NEF(None, overrideMatrix=True) for n in networks])
+    assert vmt[2] == pytest.approx(networks[2].getStableInflow("auto", True) / mph2mps, rel=1e-8)
+    assert speeds[0] == pytest.approx(speeds[1], rel=1e-8)
+    assert speeds[2] > speeds[0]
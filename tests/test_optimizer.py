@@ -0,0 +1,112 @@
+import os
+
+import numpy as np
+
+import model
+from model import Optimizer
+from utils.instrumentation import Instrumentation
+from utils.warmStart import WarmStartStore
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def test_parallel_evaluation_matches_serial():
+    headways = [np.array([300., 300.])]
+    modesAndMicrotypes = [("A", "bus"), ("B", "bus")]
+    serial = Optimizer(ROOT_DIR + "/../input-data", modesAndMicrotypes=modesAndMicrotypes).evaluateBatch(headways)
+    with Optimizer(ROOT_DIR + "/../input-data", modesAndMicrotypes=modesAndMicrotypes, nWorkers=2) as o:
+        parallel = o.evaluateBatch(headways)
+        assert o.map(abs, [-1, 2]) == [1, 2]
+    np.testing.assert_allclose(parallel, serial, rtol=1e-12)
+
+
+
+def workerFingerprint(_) -> str:
+    return model._workerOptimizer.fingerprint()
+
+
+def test_workers_use_parent_equilibrium_settings():
+    with Optimizer(ROOT_DIR + "/../input-data", modesAndMicrotypes=[("A", "bus")], nWorkers=2,
+                   equilibriumMethod="anderson", equilibriumMaxIterations=30) as o:
+        o.model.equilibriumTolerance = 1e-5
+        assert o.model.equilibriumMethod == "anderson"
+        assert set(o.map(workerFingerprint, range(2))) == {o.fingerprint()}
+
+
+def test_evaluation_cache(tmp_path):
+    cachePath = str(tmp_path / "evaluations.sqlite")
+    modesAndMicrotypes = [("A", "bus"), ("B", "bus")]
+    o = Optimizer(ROOT_DIR + "/../input-data", modesAndMicrotypes=modesAndMicrotypes, cachePath=cachePath,
+                  cacheResolution=10.0, cacheModeSplits=True)
+    first = o.evaluate(np.array([300., 300.]))
+    assert len(o.cache) == 1
+    assert o.cache.get(np.array([302., 298.]))["modeSplits"]["1"]["bus"] > 0
+
+    # A restarted optimization over the same scenario reuses the stored evaluation, even for a nearby vector
+    restarted = Optimizer(ROOT_DIR + "/../input-data", modesAndMicrotypes=modesAndMicrotypes, cachePath=cachePath,
+                          cacheResolution=10.0)
+    restarted.model.collectAllCosts = None
+    assert restarted.evaluate(np.array([303., 301.])) == first
+
+    # A different setup does not
+    other = Optimizer(ROOT_DIR + "/../input-data", modesAndMicrotypes=modesAndMicrotypes[:1], cachePath=cachePath)
+    assert other.cache.get(np.array([300., 300.])) is None
+
+    # By default keys are exact, so a finite-difference probe is never answered with its neighbour's value
+    exact = Optimizer(ROOT_DIR + "/../input-data", modesAndMicrotypes=modesAndMicrotypes, cachePath=cachePath)
+    assert exact.cache.get(np.array([300., 300.])) is None
+    exact.cache.put(np.array([300., 300.]), 1.0, 2.0, 0.0)
+    assert exact.cache.get(np.array([300., 300.]))["operatorCosts"] == 2.0
+    assert exact.cache.get(np.array([300., 300. + 1e-8])) is None
+
+
+def test_parallel_jacobian_matches_serial():
+    headways = np.array([300., 600.])
+    modesAndMicrotypes = [("A", "bus"), ("B", "bus")]
+    serial = Optimizer(ROOT_DIR + "/../input-data", modesAndMicrotypes=modesAndMicrotypes, method="L-BFGS-B",
+                       parallelJacobian=True)
+    serialValue, serialGradient = serial.jacobian(headways)
+    state = serial.model.getEquilibriumState()
+    serial.evaluate(headways + np.array([30., 0.]), state)
+    for timePeriod, (splits, counter) in serial.model.getEquilibriumState()["modeSplits"].items():
+        # Perturbed points restart MSA rather than continuing the base point's damping schedule
+        assert counter <= serial.model.equilibriumMaxIterations + 1
+    with Optimizer(ROOT_DIR + "/../input-data", modesAndMicrotypes=modesAndMicrotypes, method="L-BFGS-B",
+                   parallelJacobian=True, nWorkers=2) as o:
+        value, gradient = o.jacobian(headways)
+    assert value == serialValue
+    np.testing.assert_allclose(gradient, serialGradient, rtol=1e-5)
+    assert np.all(np.isfinite(gradient))
+
+
+def test_warm_start_store():
+    store = WarmStartStore(capacity=2, scale=np.array([1., 10.]))
+    assert store.nearest(np.zeros(2)) == (np.inf, None)
+    store.add(np.array([0., 0.]), "origin")
+    store.add(np.array([5., 0.]), "right")
+    assert store.nearest(np.array([1., 30.]))[1] == "origin"
+    store.add(np.array([0., 50.]), "up")  # Drops the least recently used, "right"
+    assert len(store) == 2
+    assert store.nearest(np.array([5., 0.]))[1] == "origin"
+
+    o = Optimizer(ROOT_DIR + "/../input-data", modesAndMicrotypes=[("A", "bus"), ("B", "bus")], warmStartSize=5)
+    o.evaluate(np.array([300., 300.]))
+    assert len(o.warmStart) == 0  # Not used with MSA
+    o.model.equilibriumMethod = "anderson"
+    o.evaluate(np.array([300., 300.]))
+    with Instrumentation() as recorder:
+        o.evaluate(np.array([300., 300.]))
+    # Starting from its own converged state, every period is already at equilibrium
+    assert recorder.toDataFrame().groupby("timePeriod").size().max() == 1
+
+
+def test_parallel_shgo_sampling():
+    modesAndMicrotypes = [("A", "bus"), ("B", "bus")]
+    with Optimizer(ROOT_DIR + "/../input-data", modesAndMicrotypes=modesAndMicrotypes, nWorkers=2) as o:
+        unit = o.sample(3, 2)
+        points = unit * (3600. - 120.) + 120.
+        assert unit.shape == (3, 2)
+        assert len(o.sampledValues) == 3
+        sampled = o.evaluateSampled(points[0])
+    serial = Optimizer(ROOT_DIR + "/../input-data", modesAndMicrotypes=modesAndMicrotypes).evaluate(points[0])
+    np.testing.assert_allclose(sampled, serial, rtol=1e-12)
@@ -1,10 +1,11 @@
 import os
 
+import numpy as np
 import pandas as pd
 import pytest
 
 from utils.choiceCharacteristics import ModalChoiceCharacteristics, ChoiceCharacteristics
-from utils.population import Population
+from utils.population import Population, logitProbabilities
 
 
 @pytest.fixture
@@ -36,3 +37,44 @@ def test_update_mode_split(pop):
         print("AAH")
 
     assert ms[0]["auto"] > ms[1]["auto"]  # Rich people are more likely to drive
+
+
+def test_batched_logit(pop):
+    pop = test_import_population(pop)
+    mcc = ModalChoiceCharacteristics([], 2.0)
+    mcc["auto"] = ChoiceCharacteristics(0.5, 10, 0)
+    mcc["bus"] = ChoiceCharacteristics(1.0, 0, 0.1)
+    mcc["bike"] = ChoiceCharacteristics(0.8, 0, 0, protected_distance=1.0)
+    modes = ["auto", "bike", "bus", "walk"]
+    demandClasses = [di for di, dc in pop]
+    params = pop.paramTensor(demandClasses, modes)
+    characteristics = np.stack([mcc.toArray(modes)] * len(demandClasses))
+    available = np.array([[True, True, True, False]] * len(demandClasses))
+    probabilities = logitProbabilities(characteristics, params, np.arange(len(demandClasses)), available)
+
+    np.testing.assert_allclose(np.sum(probabilities, axis=1), 1.0)
+    assert np.all(probabilities[:, 3] == 0.0)
+    for idx, di in enumerate(demandClasses):
+        ms = pop[di].updateModeSplit(mcc)
+        np.testing.assert_allclose(probabilities[idx, :3], [ms["auto"], ms["bike"], ms["bus"]])
+
+    # Large utilities must not overflow
+    extreme = logitProbabilities(characteristics * 1e3, params, np.arange(len(demandClasses)), available)
+    assert np.all(np.isfinite(extreme))
+
+
+def test_compiled_parameters(pop):
+    pop = test_import_population(pop)
+    demandClasses = [di for di, dc in pop]
+    sameClass = [di for di in demandClasses if (di.populationGroupType == demandClasses[0].populationGroupType) & (
+            di.tripPurpose == demandClasses[0].tripPurpose)]
+    assert len(sameClass) > 1
+    assert len({pop.classIndex(di) for di in sameClass}) == 1  # Homes share one parameter slice
+    assert pop.parameters.values.shape[:2] == (len(pop.parameters.groups), len(pop.parameters.purposes))
+
+    params = pd.read_csv(os.path.dirname(os.path.abspath(__file__)) + "/../input-data/PopulationGroups.csv")
+    for row in params.itertuples():
+        di = [di for di in demandClasses if (di.populationGroupType == row.PopulationGroupTypeID) & (
+                di.tripPurpose == row.TripPurposeID)][0]
+        assert pop[di][row.Mode, "BetaTravelTime"] == row.BetaTravelTime
+    assert pop[demandClasses[0]]["auto", "NotAParameter"] == 0.0
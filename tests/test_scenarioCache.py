@@ -0,0 +1,44 @@
+import os
+import pickle
+import shutil
+
+import pytest
+
+from model import ScenarioData
+from utils.scenarioCache import ScenarioCache
+
+
+@pytest.fixture
+def scenarioPath(tmp_path):
+    ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+    path = str(tmp_path / "input-data")
+    shutil.copytree(ROOT_DIR + "/../input-data", path)
+    return path
+
+
+def test_cache_round_trip(scenarioPath):
+    parsed = ScenarioData(scenarioPath)
+    assert os.path.isfile(scenarioPath + "-cache.pkl")
+    cached = ScenarioCache(scenarioPath).load()
+    assert cached is not None
+    assert set(cached.keys()) == set(parsed.data.keys())
+    assert cached["subNetworkData"].equals(parsed["subNetworkData"])
+    assert cached["transitionMatrices"].equals(parsed["transitionMatrices"])
+    assert cached["modeData"]["bus"].equals(parsed["modeData"]["bus"])
+
+
+def test_cache_invalidation(scenarioPath):
+    ScenarioData(scenarioPath)
+    cache = ScenarioCache(scenarioPath)
+    subNetworks = os.path.join(scenarioPath, "SubNetworks.csv")
+
+    os.utime(subNetworks, ns=(0, 0))  # touched but unchanged
+    assert cache.load() is not None
+    with open(cache.cachePath, "rb") as f:
+        assert not cache.signatureChanged(pickle.load(f))  # the header was refreshed, so no more re-hashing
+
+    with open(subNetworks, "a") as f:
+        f.write("\n19,A,Bike,5,5,,BikePath,True,")
+    assert cache.load() is None
+    assert 19 in ScenarioData(scenarioPath)["subNetworkData"].index
+    assert 19 in cache.load()["subNetworkData"].index
@@ -0,0 +1,79 @@
+import os
+import shutil
+import warnings
+
+import pytest
+
+from model import ScenarioData, Model
+
+
+@pytest.fixture
+def scenarioPath(tmp_path):
+    ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+    path = str(tmp_path / "input-data")
+    shutil.copytree(ROOT_DIR + "/../input-data", path)
+    return path
+
+
+def test_overlay_patch_and_revert(scenarioPath):
+    base = ScenarioData(scenarioPath, useCache=False)
+    overlay = base.overlay()
+    assert overlay["originDestinations"] is base["originDestinations"]
+    assert overlay["subNetworkData"] is not base["subNetworkData"]
+
+    overlay.patch("subNetworkData", 1, "Length", 14000.0)
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        overlay.patch(("modeData", "bus"), "A", "Headway", 250.5)  # into an integer column
+    assert overlay["subNetworkData"].at[1, "Length"] == 14000.0
+    assert overlay["modeData"]["bus"].at["A", "Headway"] == 250.5
+    assert base["subNetworkData"].at[1, "Length"] == 15000.0
+    assert overlay.original(("modeData", "bus"), "A", "Headway") == 300
+
+    overlay.revert()
+    assert overlay["subNetworkData"].at[1, "Length"] == 15000.0
+    assert overlay["modeData"]["bus"].at["A", "Headway"] == 300
+    assert not overlay.patches
+
+
+def test_overlay_patch_leaves_base_unchanged(scenarioPath):
+    base = ScenarioData(scenarioPath, useCache=False)
+    overlay = base.overlay()
+    basePopulations = base["populations"]
+
+    overlay.patch("populations", 0, "Population", 6500.5)  # not patchable, so copied into the overlay
+    assert overlay["populations"] is not basePopulations
+    assert overlay["populations"].at[0, "Population"] == 6500.5
+    assert base["populations"] is basePopulations
+    assert base["populations"].at[0, "Population"] == 6000
+    assert base["populations"]["Population"].dtype.kind == "i"
+    assert overlay.original("populations", 0, "Population") == 6000
+
+    overlay.revert()
+    assert overlay["populations"].at[0, "Population"] == 6000
+    assert base["populations"].at[0, "Population"] == 6000
+    assert base["populations"]["Population"].dtype.kind == "i"
+
+
+def test_modify_networks_refreshes_params(scenarioPath):
+    a = Model(scenarioPath)
+    network = [n for modes, n in a.microtypes["A"].networks if n.L == 15000.0][0]
+    bus = [m for m in network.getModeValues() if m.name == "bus"][0]
+
+    a.modifyNetworks(scheduleModification=[(("A", "bus"), 600.)])
+    assert bus.headwayInSec == 300  # Patches are picked up the next time the model uses its microtypes
+    a.microtypes.getOperatorCosts()
+    assert bus.headwayInSec == 600.
+    a.resetNetworks()
+    a.microtypes.getOperatorCosts()
+    assert bus.headwayInSec == 300
+
+    a.scenarioData.patch("subNetworkData", 1, "Length", 12000.0)
+    a.findEquilibrium()
+    assert network.L == 12000.0
+
+    a.scenarioData["subNetworkData"].at[1, "Length"] = 13000.0  # direct writes are picked up too
+    a.scenarioData["modeData"]["bus"].loc["A", "Headway"] = 450
+    a.findEquilibrium()
+    assert network.L == 13000.0
+    assert bus.headwayInSec == 450
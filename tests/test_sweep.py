@@ -0,0 +1,39 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from sweep import Sweep, CellParameter, HeadwayParameter, LaneReallocationParameter
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def test_sweep_points():
+    headway = HeadwayParameter("headway", [300., 600., 900.], "A", "bus")
+    jamDensity = CellParameter("jamDensity", [0.12, 0.14, 0.16], "subNetworkData", [1, 2], "densityMax")
+    grid = Sweep(ROOT_DIR + "/../input-data", [headway, jamDensity], nWorkers=2)
+    assert len(grid.points()) == 9
+    assert grid.points()[5] == {"headway": 600., "jamDensity": 0.16}
+    assert len(Sweep(ROOT_DIR + "/../input-data", [headway, jamDensity], combine="zip").points()) == 3
+    assert jamDensity.patches(0.12, None) == {("subNetworkData", 1, "densityMax"): 0.12,
+                                              ("subNetworkData", 2, "densityMax"): 0.12}
+
+
+def test_sweep_run(tmp_path):
+    outputPath = str(tmp_path / "sweep.csv")
+    with open(outputPath, "w") as f:
+        f.write("rows,from,an,earlier,run\n")
+    lanes = LaneReallocationParameter("busLaneDistance", [0., 5000.], 2, 10)
+    results = Sweep(ROOT_DIR + "/../input-data", [lanes], outputPath=outputPath, groupModeSplits=True).run()
+    assert list(results.columns) == ["point", "busLaneDistance", "timePeriod", "microtypeID", "populationGroup",
+                                     "distanceBin", "mode", "metric", "value"]
+    assert set(results.point) == {0, 1}
+    assert len(pd.read_csv(outputPath)) == len(results)
+    groupSplits = results.loc[(results.metric == "modeSplit") & results.populationGroup.notna()]
+    assert set(groupSplits.populationGroup) == {"low-income", "high-income"}
+    assert {"short", "medium"} <= set(results.loc[results.metric == "modeSplit", "distanceBin"].dropna())
+    busSpeed = results.loc[(results.metric == "speed") & (results["mode"] == "bus") & (results.microtypeID == "B")]
+    baseline, dedicated = busSpeed.groupby("busLaneDistance")["value"].mean()
+    assert dedicated > baseline
+    totals = results.loc[results.metric == "totalUserCost", "value"]
+    assert np.all(np.isfinite(totals)) & (totals.nunique() == 2)
@@ -1,15 +1,20 @@
+import json
 import warnings
 from typing import Dict, List
 
 import numpy as np
 import pandas as pd
+from scipy.sparse import csr_matrix
 from scipy.sparse.linalg import eigs
 
 # from utils.microtype import Microtype
 from .choiceCharacteristics import ChoiceCharacteristics
+from .log import getLogger
 
 warnings.filterwarnings("ignore")
 
+logger = getLogger(__name__)
+
 
 class Allocation:
     def __init__(self, mapping=None):
@@ -61,7 +66,7 @@ class ModeSplit:
         if self._mapping.keys() == mapping.keys():
             self._mapping = mapping
         else:
-            print("OH NO BAD MAPPING")
+            logger.warning("Mode split mapping for %s does not match %s", mapping.keys(), self._mapping.keys())
 
     def copy(self):
         return ModeSplit(self._mapping.copy(), self.demandForTripsPerHour, self.demandForPmtPerHour)
@@ -138,12 +143,12 @@ class ModeSplit:
     def demandForPmtPerHour(self, demandForPMT):
         if demandForPMT < 0:
             self.__demandForPmtPerHour = 0
-            print("OH NO NEGATIVE PMT ")
+            logger.warning("Negative demand for PMT %s set to zero", demandForPMT)
         elif demandForPMT >= 0:
             self.__demandForPmtPerHour = demandForPMT
         else:
             self.__demandForPmtPerHour = 0
-            print("OH NO BAD PMT ")
+            logger.warning("Invalid demand for PMT %s set to zero", demandForPMT)
 
     @property
     def demandForTripsPerHour(self):
@@ -153,12 +158,12 @@ class ModeSplit:
     def demandForTripsPerHour(self, demandForTrips):
         if demandForTrips < 0:
             self.__demandForTripsPerHour = 0
-            print("OH NO NEGATIVE DEMAND FOR TRIPS")
+            logger.warning("Negative demand for trips %s set to zero", demandForTrips)
         elif demandForTrips >= 0:
             self.__demandForTripsPerHour = demandForTrips
         else:
             self.__demandForTripsPerHour = 0
-            print("OH NO BAD TRIP")
+            logger.warning("Invalid demand for trips %s set to zero", demandForTrips)
 
     def __setitem__(self, key, value):
         self._mapping[key] = value
@@ -179,6 +184,91 @@ class ModeSplit:
         return iter(self._mapping.items())
 
 
+class CollectedModeSplits:
+    """
+    Struct-of-arrays store for the mode splits of every (demand class, OD) pair: one (key x mode) matrix of splits
+    with a mask of the modes available to each key, plus vectors of trip and PMT demand. Rows are addressed by
+    integer index, and ModeSplit objects are only built as read-only views.
+    """
+
+    def __init__(self):
+        self.modes = []
+        self.demandIndices = []
+        self.odIndices = []
+        self.splits = np.zeros((0, 0))
+        self.available = np.zeros((0, 0), dtype=bool)
+        self.demandForTripsPerHour = np.zeros(0)
+        self.demandForPmtPerHour = np.zeros(0)
+        self.counter = 1.0
+        self.__keyToRow = dict()
+        self.__modeToIdx = dict()
+
+    def initialize(self, keys: list, modeSets: list, initialSplits: list, demandForTripsPerHour: np.ndarray,
+                   demandForPmtPerHour: np.ndarray):
+        self.modes = sorted(set().union(*modeSets)) if modeSets else []
+        self.__modeToIdx = {mode: idx for idx, mode in enumerate(self.modes)}
+        self.demandIndices = [di for di, odi in keys]
+        self.odIndices = [odi for di, odi in keys]
+        self.__keyToRow = {key: row for row, key in enumerate(keys)}
+        self.splits = np.zeros((len(keys), len(self.modes)))
+        self.available = np.zeros((len(keys), len(self.modes)), dtype=bool)
+        for row, (modes, initialSplit) in enumerate(zip(modeSets, initialSplits)):
+            for mode in modes:
+                self.available[row, self.__modeToIdx[mode]] = True
+                self.splits[row, self.__modeToIdx[mode]] = initialSplit[mode]
+        self.demandForTripsPerHour = np.asarray(demandForTripsPerHour, dtype=float)
+        self.demandForPmtPerHour = np.asarray(demandForPmtPerHour, dtype=float)
+        self.counter = 1.0
+
+    def __len__(self):
+        return len(self.odIndices)
+
+    def __contains__(self, item):
+        return item in self.__keyToRow
+
+    def row(self, item) -> int:
+        return self.__keyToRow[item]
+
+    def modeIdx(self, mode: str) -> int:
+        return self.__modeToIdx[mode]
+
+    def rowMask(self, userClass=None, microtypeID=None, distanceBin=None) -> np.ndarray:
+        mask = np.ones(len(self), dtype=bool)
+        if userClass is not None:
+            mask &= np.array([di.populationGroupType == userClass for di in self.demandIndices], dtype=bool)
+        if microtypeID is not None:
+            mask &= np.array([di.homeMicrotype == microtypeID for di in self.demandIndices], dtype=bool)
+        if distanceBin is not None:
+            mask &= np.array([odi.distBin == distanceBin for odi in self.odIndices], dtype=bool)
+        return mask
+
+    def __getitem__(self, item) -> ModeSplit:
+        row = self.__keyToRow[item]
+        return ModeSplit({mode: self.splits[row, idx] for idx, mode in enumerate(self.modes) if
+                          self.available[row, idx]}, self.demandForTripsPerHour[row], self.demandForPmtPerHour[row])
+
+    def __setitem__(self, key, value: ModeSplit):
+        row = self.__keyToRow[key]
+        for mode, split in value:
+            self.splits[row, self.__modeToIdx[mode]] = split
+        self.demandForTripsPerHour[row] = value.demandForTripsPerHour
+        self.demandForPmtPerHour[row] = value.demandForPmtPerHour
+
+    def flows(self) -> np.ndarray:
+        """Demand for trips per hour by key and mode"""
+        return self.splits * self.demandForTripsPerHour[:, None]
+
+    def blend(self, newSplits: np.ndarray, oldModeSplit: ModeSplit):
+        """
+        Blends newly calculated splits with the previous aggregate mode split, with weight 1/counter on the new
+        splits (the method of successive averages used by ModeSplit.__imul__)
+        """
+        portion = 1. / self.counter
+        old = np.array([oldModeSplit[mode] for mode in self.modes])
+        self.splits = np.where(self.available, newSplits * portion + old[None, :] * (1.0 - portion), 0.0)
+        self.counter += 1.0
+
+
 class ModeCharacteristics:
     def __init__(self, modes: List[str]):
         self._modes = modes
@@ -326,8 +416,8 @@ class TripCollection:
                     self[odi].allocation[row.ThroughMicrotypeID] = row.Portion
                 else:
                     self[odi] = Trip(odi, Allocation({row.ThroughMicrotypeID: row.Portion}))
-        print("-------------------------------")
-        print("|  Loaded ", len(df), " trips")
+        logger.info("-------------------------------")
+        logger.info("|  Loaded %s trips", len(df))
 
     def __iter__(self):
         return iter(self.__trips.items())
@@ -363,8 +453,8 @@ class TripGeneration:
 
     def importTripGeneration(self, df: pd.DataFrame):
         self.__data = df
-        print("|  Loaded ", len(df), " trip generation rates")
-        print("-------------------------------")
+        logger.info("|  Loaded %s trip generation rates", len(df))
+        logger.info("-------------------------------")
 
     def initializeTimePeriod(self, timePeriod, timePeriodID):
         # self.__tripClasses = dict()
@@ -373,7 +463,7 @@ class TripGeneration:
             relevantDemand = self.__data.loc[self.__data["TimePeriodID"] == timePeriodID]
             for row in relevantDemand.itertuples():
                 self[row.PopulationGroupTypeID, row.TripPurposeID] = row.TripGenerationRatePerHour
-            print("|  Loaded ", len(relevantDemand), " demand classes")
+            logger.info("|  Loaded %s demand classes", len(relevantDemand))
 
     def __iter__(self):
         return iter(self.tripClasses.items())
@@ -402,7 +492,7 @@ class OriginDestination:
     def importOriginDestination(self, ods: pd.DataFrame, distances: pd.DataFrame):
         self.__ods = ods
         self.__distances = distances
-        print("|  Loaded ", len(ods), " ODs and ", len(distances), "unique distance bins")
+        logger.info("|  Loaded %s ODs and %s unique distance bins", len(ods), len(distances))
 
     def __setitem__(self, key: DemandIndex, value: dict):
         self.originDestination[key] = value
@@ -427,8 +517,8 @@ class OriginDestination:
     def initializeTimePeriod(self, timePeriod, timePeriodID):
         self.__currentTimePeriod = timePeriod
         if timePeriod not in self.__originDestination:
-            print("|  Loaded ", len(self.__ods.loc[self.__ods["TimePeriodID"] == timePeriodID]), " distance bins")
             relevantODs = self.__ods.loc[self.__ods["TimePeriodID"] == timePeriodID]
+            logger.info("|  Loaded %s distance bins", len(relevantODs))
             merged = relevantODs.merge(self.__distances,
                                        on=["TripPurposeID", "OriginMicrotypeID", "DestinationMicrotypeID"],
                                        suffixes=("_OD", "_Dist"),
@@ -438,7 +528,7 @@ class OriginDestination:
                 tot = np.sum(grouped["tot"])
                 grouped["tot"] = grouped["tot"] / tot
                 if abs(tot - 1) > 0.0001:  # TODO: FIX
-                    print(f"Oops, totals for {tripClass} add up to {tot}")
+                    logger.warning("Totals for %s add up to %s", tripClass, tot)
                 distribution = dict()
                 for row in grouped.itertuples():
                     distribution[
@@ -448,9 +538,13 @@ class OriginDestination:
         #     self[row.PopulationGroupTypeID, row.TripPurposeID] = row.TripGenerationRatePerHour
 
 
+SPARSE_DENSITY_THRESHOLD = 0.1
+
+
 class TransitionMatrix:
-    def __init__(self, microtypes: list, matrix=None, diameters=None):
+    def __init__(self, microtypes: list, matrix=None, diameters=None, readOnly=False):
         self.__names = microtypes
+        self.readOnly = readOnly
         self.__nameToIdx = {val: idx for idx, val in enumerate(microtypes)}
         self.__averageSpeeds = np.zeros(len(microtypes))
         if isinstance(matrix, pd.DataFrame):
@@ -460,7 +554,7 @@ class TransitionMatrix:
         elif isinstance(matrix, np.ndarray):
             self.__matrix = pd.DataFrame(matrix, index=microtypes, columns=microtypes)
         else:
-            print("ERROR INITIALIZING TRANSITION MATRIX")
+            logger.error("Cannot initialize a transition matrix from %s", type(matrix))
         if diameters is None:
             diameters = np.ones(len(microtypes))
         self.__diameters = diameters
@@ -474,6 +568,7 @@ class TransitionMatrix:
         return self.__diameters
 
     def setAverageSpeeds(self, averageSpeeds: np.ndarray):
+        self.__checkWritable()
         self.__averageSpeeds = averageSpeeds
 
     @property
@@ -487,24 +582,33 @@ class TransitionMatrix:
     def __getitem__(self, item):
         return dict(zip(self.__names, self.__matrix[self.__nameToIdx[item], :].values))
 
+    def __checkWritable(self):
+        if self.readOnly:
+            raise ValueError("Cannot modify a read-only transition matrix, such as the shared default one")
+
     def __add__(self, other):
+        self.__checkWritable()
         if isinstance(other, TransitionMatrix):
             self.__matrix += other.__matrix
             return self  # TransitionMatrix(self.__names, self.matrix + other.matrix)
         else:
-            print("ERROR ADDING TRANSITION MATRIX")
+            logger.error("Cannot add %s to a transition matrix", type(other))
             return self
 
     def __radd__(self, other):
+        self.__checkWritable()
         if isinstance(other, TransitionMatrix):
             self.__matrix += other.__matrix
             return self  # TransitionMatrix(self.__names, self.matrix + other.matrix)
         else:
-            print("ERROR ADDING TRANSITION MATRIX")
+            logger.error("Cannot add %s to a transition matrix", type(other))
             return self
 
     def addAndMultiply(self, other, multiplier):
-        self.__matrix += other.__matrix.to_numpy() * multiplier
+        self.__checkWritable()
+        if isinstance(other, TransitionMatrix):
+            other = other.__matrix.to_numpy()
+        self.__matrix += other * multiplier
         return self
 
     def __mul__(self, other):
@@ -515,14 +619,32 @@ class TransitionMatrix:
         return self.__nameToIdx[idx]
 
     def fillZeros(self):
+        self.__checkWritable()
         self.__matrix += 1. / (len(self.__names) ** 2)
         return self
 
     def updateMatrix(self, other):
+        self.__checkWritable()
         self.__matrix = other.matrix
 
+    def density(self) -> float:
+        return np.count_nonzero(self.__matrix.to_numpy()) / max(self.__matrix.size, 1)
+
+    def transitionOperator(self, sparse=None):
+        """
+        Transposed transition matrix, mapping the vehicles leaving each microtype onto the microtypes they enter. It is
+        returned in CSR format if sparse is True, or if sparse is None and the share of nonzero entries is below
+        SPARSE_DENSITY_THRESHOLD, and as a dense array otherwise.
+        """
+        X = np.transpose(self.__matrix.to_numpy())
+        if sparse is None:
+            sparse = self.density() < SPARSE_DENSITY_THRESHOLD
+        if sparse:
+            return csr_matrix(X)
+        return X
+
     def getSteadyState(self) -> (float, np.ndarray):
-        X = np.transpose(self.matrix.to_numpy())
+        X = self.transitionOperator()
         val, vec = np.real_if_close(eigs(X, k=1, which='LM'))
         dists = self.diameters / (1 - np.real_if_close(val))
         weights = np.real_if_close(vec / np.sum(vec))
@@ -531,32 +653,128 @@ class TransitionMatrix:
 
 
 class TransitionMatrices:
+    """
+    Class to store the transition matrices of every (origin, destination, distance bin) as one dense array of shape
+    (nOD, nMicrotypes, nMicrotypes), with a single shared uniform matrix for ODs without data. The array can be saved
+    to and memory-mapped from a .npy file.
+    """
+
     def __init__(self):
         self.__names = []
         self.__diameters = np.ndarray(0)
-        self.__data = dict()
+        self.__data = pd.DataFrame()
+        self.__slots = dict()
+        self.__tensor = np.zeros((0, 0, 0))
+        self.__default = np.zeros((0, 0))
+        self.__defaultMatrix = TransitionMatrix([], readOnly=True)
         self.__transitionMatrices = dict()
 
     def __getitem__(self, item: ODindex):
         if (item.o, item.d, item.distBin) in self.__transitionMatrices:
             return self.__transitionMatrices[(item.o, item.d, item.distBin)]
         else:
-            if (item.o, item.d, item.distBin) in self.__data:
-                out = TransitionMatrix(self.__names, self.__data[(item.o, item.d, item.distBin)],
-                                       diameters=self.__diameters)
+            if (item.o, item.d, item.distBin) in self.__slots:
+                out = TransitionMatrix(self.__names, self.getArray(item).copy(), diameters=self.__diameters)
                 self.__transitionMatrices[(item.o, item.d, item.distBin)] = out
                 return out
             else:
-                # print(f"No transition matrix found for {(item.o, item.d, item.distBin)}")
-                out = TransitionMatrix(self.__names).fillZeros()
-                return out
+                return self.__defaultMatrix
+
+    def __contains__(self, item: ODindex):
+        return (item.o, item.d, item.distBin) in self.__slots
+
+    def __len__(self):
+        return len(self.__slots)
+
+    @property
+    def names(self) -> list:
+        return self.__names
+
+    @property
+    def tensor(self) -> np.ndarray:
+        return self.__tensor
+
+    def slot(self, item: ODindex) -> int:
+        """Index of the matrix for this OD in the tensor, or -1 if it uses the default matrix"""
+        return self.__slots.get((item.o, item.d, item.distBin), -1)
+
+    def getArray(self, item: ODindex) -> np.ndarray:
+        """Transition matrix for this OD as a (read only) array, without building a TransitionMatrix"""
+        slot = self.slot(item)
+        if slot >= 0:
+            return self.__tensor[slot]
+        else:
+            return self.__default
+
+    def weightedSum(self, slots: np.ndarray, weights: np.ndarray) -> np.ndarray:
+        """
+        Sum of the transition matrices in slots (as returned by slot(), -1 for the default matrix) weighted by weights,
+        computed as a single contraction over the tensor
+        """
+        known = slots >= 0
+        slotWeights = np.bincount(slots[known], weights=weights[known], minlength=len(self.__slots))
+        out = np.tensordot(slotWeights, self.__tensor, axes=1)
+        out += self.__default * np.sum(weights[~known])
+        return out
 
     def adoptMicrotypes(self, microtypes: pd.DataFrame):
         self.__names = microtypes["MicrotypeID"].to_list()
         self.__diameters = microtypes["DiameterInMiles"].to_numpy()
+        self.__transitionMatrices = dict()
+        self.buildTensor()
 
     def importTransitionMatrices(self, df: pd.DataFrame):
-        for key, val in df.groupby(level=[0, 1, 2]):
-            self.__data[key] = val.set_index(val.index.droplevel([0, 1, 2]))
-        print("|  Loaded ", len(df), " transition probabilities")
-        print("-------------------------------")
+        self.__data = df
+        self.buildTensor()
+        logger.info("|  Loaded %s transition probabilities", len(df))
+        logger.info("-------------------------------")
+
+    def buildDefault(self):
+        """Uniform matrix shared by every OD without data, as an array and as a read-only TransitionMatrix"""
+        nMicrotypes = len(self.__names)
+        self.__default = np.full((nMicrotypes, nMicrotypes), 1. / max(nMicrotypes, 1) ** 2)
+        self.__default.flags.writeable = False
+        self.__defaultMatrix = TransitionMatrix(self.__names, self.__default, diameters=self.__diameters,
+                                                readOnly=True)
+
+    def buildTensor(self):
+        nMicrotypes = len(self.__names)
+        self.buildDefault()
+        if self.__data.empty or (nMicrotypes == 0):
+            self.__slots = dict()
+            self.__tensor = np.zeros((0, nMicrotypes, nMicrotypes))
+            return
+        nameToIdx = {name: idx for idx, name in enumerate(self.__names)}
+        rows = self.__data.index.get_level_values(3).map(nameToIdx)
+        keep = ~pd.isna(rows)
+        df = self.__data.loc[keep]
+        slotOfRow, keys = pd.factorize(df.index.droplevel(3))
+        values = df.reindex(columns=self.__names).fillna(0.0).to_numpy(dtype=float)
+        self.__tensor = np.zeros((len(keys), nMicrotypes, nMicrotypes))
+        np.add.at(self.__tensor, (slotOfRow, rows[keep].to_numpy(dtype=int)), values)
+        self.__slots = {tuple(key): slot for slot, key in enumerate(keys)}
+
+    def save(self, path: str):
+        """
+        Writes the tensor to path (a .npy file) and its OD index next to it, in path + ".index.json"
+        """
+        np.save(path, np.ascontiguousarray(self.__tensor))
+        keys = [None] * len(self.__slots)
+        for key, slot in self.__slots.items():
+            keys[slot] = list(key)
+        with open(path + ".index.json", "w") as f:
+            json.dump({"names": self.__names, "diameters": [float(d) for d in self.__diameters], "keys": keys}, f)
+
+    def load(self, path: str, mmap_mode="r"):
+        """
+        Reads a tensor written by save(), memory-mapped by default so that processes can share it
+        """
+        with open(path + ".index.json") as f:
+            index = json.load(f)
+        self.__names = index["names"]
+        self.__diameters = np.array(index["diameters"])
+        self.__slots = {tuple(key): slot for slot, key in enumerate(index["keys"])}
+        self.__tensor = np.load(path, mmap_mode=mmap_mode)
+        self.buildDefault()
+        self.__transitionMatrices = dict()
+        return self
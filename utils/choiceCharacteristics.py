@@ -1,6 +1,17 @@
 # from .microtype import MicrotypeCollection
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from .log import getLogger
 from .misc import DistanceBins
 
+logger = getLogger(__name__)
+
+CHOICE_ATTRIBUTES = ("travel_time", "wait_time", "access_time", "cost", "protected_share")
+CHARACTERISTIC_FIELDS = ("travel_time", "cost", "wait_time", "access_time", "protected_distance", "distance")
+CHOICE_INPUTS = ("speed", "per_mile", "portion_dedicated", "per_start", "start_wait", "per_end", "end_wait",
+                 "access_time")
+
 
 class ChoiceCharacteristics:
     def __init__(self, travel_time=0., cost=0., wait_time=0., access_time=0, protected_distance=0, distance=0):
@@ -21,7 +32,7 @@ class ChoiceCharacteristics:
             self.distance += other.distance
             return self
         else:
-            print('TOUGH LUCK, BUDDY')
+            logger.error("Cannot add %s to ChoiceCharacteristics", type(other))
             return self
 
     def __iadd__(self, other):
@@ -34,7 +45,7 @@ class ChoiceCharacteristics:
             self.distance += other.distance
             return self
         else:
-            print('TOUGH LUCK, BUDDY')
+            logger.error("Cannot add %s to ChoiceCharacteristics", type(other))
             return self
 
 
@@ -61,47 +72,307 @@ class ModalChoiceCharacteristics:
     def __contains__(self, item):
         return item in self.__modalChoiceCharacteristics
 
+    def toArray(self, modes, out=None) -> np.ndarray:
+        """
+        (nModes x nAttributes) array of choice characteristics, ordered as CHOICE_ATTRIBUTES. Modes that are not
+        available for this trip are left at zero.
+        """
+        if out is None:
+            out = np.zeros((len(modes), len(CHOICE_ATTRIBUTES)))
+        for modeIdx, mode in enumerate(modes):
+            if mode in self:
+                cc = self[mode]
+                out[modeIdx, 0] = cc.travel_time
+                out[modeIdx, 1] = cc.wait_time
+                out[modeIdx, 2] = cc.access_time
+                out[modeIdx, 3] = cc.cost
+                if self.distanceInMiles > 0:
+                    out[modeIdx, 4] = cc.protected_distance / self.distanceInMiles
+        return out
+
+
+class ChoiceCharacteristicsView(ChoiceCharacteristics):
+    """ChoiceCharacteristics of one (OD, mode) that reads and writes its row of a CollectedChoiceCharacteristics"""
+
+    def __init__(self, row: np.ndarray):
+        self.__row = row
+
+    @property
+    def travel_time(self):
+        return self.__row[0]
+
+    @travel_time.setter
+    def travel_time(self, value):
+        self.__row[0] = value
+
+    @property
+    def cost(self):
+        return self.__row[1]
+
+    @cost.setter
+    def cost(self, value):
+        self.__row[1] = value
+
+    @property
+    def wait_time(self):
+        return self.__row[2]
+
+    @wait_time.setter
+    def wait_time(self, value):
+        self.__row[2] = value
+
+    @property
+    def access_time(self):
+        return self.__row[3]
+
+    @access_time.setter
+    def access_time(self, value):
+        self.__row[3] = value
+
+    @property
+    def protected_distance(self):
+        return self.__row[4]
+
+    @protected_distance.setter
+    def protected_distance(self, value):
+        self.__row[4] = value
+
+    @property
+    def distance(self):
+        return self.__row[5]
+
+    @distance.setter
+    def distance(self, value):
+        self.__row[5] = value
+
+
+class ModalChoiceCharacteristicsView(ModalChoiceCharacteristics):
+    """ModalChoiceCharacteristics of one OD whose changes are written back to a CollectedChoiceCharacteristics"""
+
+    def __init__(self, data: np.ndarray, modeToIdx: dict, distanceInMiles=0.0):
+        super().__init__([], distanceInMiles)
+        self.__data = data
+        self.__modeToIdx = modeToIdx
+        for mode, modeIdx in modeToIdx.items():
+            super().__setitem__(mode, ChoiceCharacteristicsView(data[modeIdx, :]))
+
+    def __setitem__(self, key: str, value: ChoiceCharacteristics):
+        self.__data[self.__modeToIdx[key], :] = [getattr(value, field) for field in CHARACTERISTIC_FIELDS]
+
 
 class CollectedChoiceCharacteristics:
-    def __init__(self):
-        self.__choiceCharacteristics = dict()
+    """
+    Choice characteristics of every OD, stored as one (OD x mode x field) array with fields ordered as
+    CHARACTERISTIC_FIELDS.
+
+    For each mode, sparse (OD x microtype) incidence matrices of trip origins, destinations and through distances
+    are built once from the trips and distance bins, so that updating the characteristics of every OD is a handful of
+    sparse products with per-microtype vectors of the CHOICE_INPUTS.
+
+    Updates can be incremental: the inputs of each (microtype, mode) used in the last update are stored, and only
+    the ODs starting in, ending in or passing through a microtype whose inputs moved by more than a relative
+    tolerance are recalculated.
+
+    Attributes
+    ----------
+    odIndices : list
+        ODs along the first axis of data
+    modes : list
+        Modes along the second axis of data
+    data : np.ndarray
+        (nOD x nModes x nFields) choice characteristics, zero for modes not available to an OD
+    available : np.ndarray
+        (nOD x nModes) boolean mask of the modes available to each OD
+    distanceInMiles : np.ndarray
+        Trip distance of each OD
+    tolerance : float
+        Relative change in an input below which ODs are not recalculated
+
+    Methods
+    -------
+    initializeChoiceCharacteristics(trips, microtypes, distanceBins):
+        Build the arrays and incidence matrices
+    updateChoiceCharacteristics(microtypes, trips, incremental=True):
+        Recalculate the characteristics of ODs whose inputs changed (or of all ODs)
+    toArray(odIndices, modes):
+        Return the (nOD x nModes x nAttributes) array of CHOICE_ATTRIBUTES used by the logit model
+    fieldArray(odIndices, modes):
+        Return the (nOD x nModes x nFields) array of CHARACTERISTIC_FIELDS
+    changedInputs(microtypes):
+        Return the inputs of the (microtype, mode) pairs that changed since they were last committed
+    commitInputs(changed):
+        Store inputs returned by changedInputs as the current ones
+    """
+
+    def __init__(self, tolerance=0.0):
+        self.odIndices = []
+        self.modes = []
+        self.data = np.zeros((0, 0, len(CHARACTERISTIC_FIELDS)))
+        self.available = np.zeros((0, 0), dtype=bool)
+        self.distanceInMiles = np.zeros(0)
+        self.tolerance = tolerance
+        self.__odToRow = dict()
+        self.__modeToIdx = dict()
+        self.__microtypeIDs = []
+        self.__incidence = dict()
+        self.__rowsByMicrotype = dict()
+        self.__lastInputs = dict()
         self.__distanceBins = DistanceBins()
 
     def __setitem__(self, key, value: ModalChoiceCharacteristics):
-        self.__choiceCharacteristics[key] = value
+        row = self.__odToRow[key]
+        for mode in value.modes():
+            cc = value[mode]
+            self.data[row, self.__modeToIdx[mode], :] = [getattr(cc, field) for field in CHARACTERISTIC_FIELDS]
 
     def __getitem__(self, item) -> ModalChoiceCharacteristics:
-        return self.__choiceCharacteristics[item]
+        """Characteristics of the available modes of one OD, as a view that writes changes back to data"""
+        row = self.__odToRow[item]
+        return ModalChoiceCharacteristicsView(self.data[row], {mode: modeIdx for modeIdx, mode in enumerate(self.modes)
+                                                               if self.available[row, modeIdx]},
+                                              self.distanceInMiles[row])
+
+    def __contains__(self, item):
+        return item in self.__odToRow
+
+    def toArray(self, odIndices, modes) -> np.ndarray:
+        """(nOD x nModes x nAttributes) array of choice characteristics for the given ODs"""
+        rows = np.array([self.__odToRow[odIndex] for odIndex in odIndices], dtype=int)
+        out = np.zeros((len(rows), len(modes), len(CHOICE_ATTRIBUTES)))
+        distances = self.distanceInMiles[rows]
+        for outIdx, mode in enumerate(modes):
+            if mode not in self.__modeToIdx:
+                continue
+            data = self.data[rows, self.__modeToIdx[mode], :]
+            out[:, outIdx, 0] = data[:, 0]
+            out[:, outIdx, 1] = data[:, 2]
+            out[:, outIdx, 2] = data[:, 3]
+            out[:, outIdx, 3] = data[:, 1]
+            np.divide(data[:, 4], distances, out=out[:, outIdx, 4], where=distances > 0)
+        return out
+
+    def fieldArray(self, odIndices, modes) -> np.ndarray:
+        """(nOD x nModes x nFields) array of CHARACTERISTIC_FIELDS for the given ODs, NaN for unavailable modes"""
+        rows = np.array([self.__odToRow[odIndex] for odIndex in odIndices], dtype=int)
+        out = np.full((len(rows), len(modes), len(CHARACTERISTIC_FIELDS)), np.nan)
+        for outIdx, mode in enumerate(modes):
+            if mode in self.__modeToIdx:
+                modeIdx = self.__modeToIdx[mode]
+                available = self.available[rows, modeIdx]
+                out[available, outIdx, :] = self.data[rows[available], modeIdx, :]
+        return out
 
     def initializeChoiceCharacteristics(self, trips,
                                         microtypes, distanceBins: DistanceBins):
         self.__distanceBins = distanceBins
-        for odIndex, trip in trips:
-            common_modes = [microtypes[odIndex.o].mode_names, microtypes[odIndex.d].mode_names]
-            # common_modes = []
-            # for microtypeID, allocation in trip.allocation:
-            #     if allocation > 0:
-            #         common_modes.append(microtypes[microtypeID].mode_names)
-            modes = set.intersection(*common_modes)
-            self[odIndex] = ModalChoiceCharacteristics(modes, distanceBins[odIndex.distBin])
+        self.__microtypeIDs = microtypes.microtypeNames()
+        microtypeToIdx = {microtypeID: idx for idx, microtypeID in enumerate(self.__microtypeIDs)}
+        self.odIndices = [odIndex for odIndex, trip in trips]
+        self.__odToRow = {odIndex: row for row, odIndex in enumerate(self.odIndices)}
+        modeSets = [set.intersection(microtypes[odIndex.o].mode_names, microtypes[odIndex.d].mode_names) for
+                    odIndex in self.odIndices]
+        self.modes = sorted(set().union(*modeSets))
+        self.__modeToIdx = {mode: idx for idx, mode in enumerate(self.modes)}
+        self.available = np.zeros((len(self.odIndices), len(self.modes)), dtype=bool)
+        for row, modes in enumerate(modeSets):
+            self.available[row, [self.__modeToIdx[mode] for mode in modes]] = True
+        self.distanceInMiles = np.array([distanceBins[odIndex.distBin] for odIndex in self.odIndices], dtype=float)
+        self.data = np.zeros((len(self.odIndices), len(self.modes), len(CHARACTERISTIC_FIELDS)))
+
+        shape = (len(self.odIndices), len(self.__microtypeIDs))
+        origins = np.array([microtypeToIdx[odIndex.o] for odIndex in self.odIndices], dtype=int)
+        destinations = np.array([microtypeToIdx[odIndex.d] for odIndex in self.odIndices], dtype=int)
+        self.__incidence = dict()
+        self.__rowsByMicrotype = {microtypeID: dict() for microtypeID in self.__microtypeIDs}
+        for modeIdx, mode in enumerate(self.modes):
+            rows = np.flatnonzero(self.available[:, modeIdx])
+            throughRows = []
+            throughMicrotypes = []
+            throughDistances = []
+            for row in rows:
+                odIndex = self.odIndices[row]
+                for microtypeID, allocation in filterAllocation(mode, trips[odIndex].allocation,
+                                                                microtypes).items():
+                    throughRows.append(row)
+                    throughMicrotypes.append(microtypeToIdx[microtypeID])
+                    throughDistances.append(self.distanceInMiles[row] * allocation)
+            ones = np.ones(len(rows))
+            originIncidence = csr_matrix((ones, (rows, origins[rows])), shape=shape)
+            destinationIncidence = csr_matrix((ones, (rows, destinations[rows])), shape=shape)
+            throughIncidence = csr_matrix((throughDistances, (throughRows, throughMicrotypes)), shape=shape)
+            self.__incidence[mode] = (originIncidence, destinationIncidence, throughIncidence)
+            touched = (originIncidence + destinationIncidence + throughIncidence).tocsc()
+            for idx, microtypeID in enumerate(self.__microtypeIDs):
+                self.__rowsByMicrotype[microtypeID][mode] = touched.indices[
+                                                            touched.indptr[idx]:touched.indptr[idx + 1]]
+        self.__lastInputs = dict()
 
     def resetChoiceCharacteristics(self):
-        for mcc in self.__choiceCharacteristics.values():
-            mcc.reset()
-
-    def updateChoiceCharacteristics(self, microtypes, trips):
-        self.resetChoiceCharacteristics()
-        for odIndex, trip in trips:
-            common_modes = [microtypes[odIndex.o].mode_names, microtypes[odIndex.d].mode_names]
-            modes = set.intersection(*common_modes)
-            for mode in modes:
-                self[odIndex][mode] += microtypes[odIndex.o].getStartTimeCostWait(mode)
-                self[odIndex][mode] += microtypes[odIndex.d].getEndTimeCostWait(mode)
-                newAllocation = filterAllocation(mode, trip.allocation, microtypes)
-                for microtypeID, allocation in newAllocation.items():
-                    self[odIndex][mode] += microtypes[microtypeID].getThroughTimeCostWait(mode, self.__distanceBins[
-                        odIndex.distBin] * allocation)
-                # assert self[odIndex][mode].distance == self[odIndex].distanceInMiles
+        self.data[:] = 0.0
+        self.__lastInputs = dict()
+
+    def changedInputs(self, microtypes) -> dict:
+        """New inputs of the (microtype, mode) pairs whose inputs moved by more than the tolerance since they were
+        last committed"""
+        changed = dict()
+        for microtypeID, microtype in microtypes:
+            for mode in microtype.mode_names:
+                inputs = microtype.getChoiceInputs(mode)
+                last = self.__lastInputs.get((microtypeID, mode))
+                if (last is None) or not np.all(np.isclose(inputs, last, rtol=self.tolerance, atol=0.0,
+                                                           equal_nan=True)):
+                    changed[microtypeID, mode] = inputs
+        return changed
+
+    def commitInputs(self, changed: dict):
+        """Store inputs from changedInputs as the ones the characteristics are calculated from"""
+        self.__lastInputs.update(changed)
+
+    def modeInputs(self, mode: str) -> np.ndarray:
+        """(nMicrotypes x nInputs) array of the last CHOICE_INPUTS of a mode, zero where it doesn't operate"""
+        out = np.zeros((len(self.__microtypeIDs), len(CHOICE_INPUTS)))
+        for idx, microtypeID in enumerate(self.__microtypeIDs):
+            if (microtypeID, mode) in self.__lastInputs:
+                out[idx, :] = self.__lastInputs[microtypeID, mode]
+        return out
+
+    def updateModeCharacteristics(self, mode: str, rows=None):
+        originIncidence, destinationIncidence, throughIncidence = self.__incidence[mode]
+        if rows is not None:
+            originIncidence = originIncidence[rows, :]
+            destinationIncidence = destinationIncidence[rows, :]
+            throughIncidence = throughIncidence[rows, :]
+        else:
+            rows = slice(None)
+        inputs = self.modeInputs(mode)
+        hoursPerMile = np.divide(1.0, inputs[:, 0], out=np.zeros(len(inputs)), where=inputs[:, 0] != 0)
+        starts = originIncidence @ inputs
+        ends = destinationIncidence @ inputs
+        through = throughIncidence @ np.column_stack([hoursPerMile, inputs[:, 1], inputs[:, 2],
+                                                      np.ones(len(inputs))])
+        modeIdx = self.__modeToIdx[mode]
+        self.data[rows, modeIdx, 0] = through[:, 0]
+        self.data[rows, modeIdx, 1] = starts[:, 3] + ends[:, 5] + through[:, 1]
+        self.data[rows, modeIdx, 2] = starts[:, 4] + ends[:, 6]
+        self.data[rows, modeIdx, 3] = starts[:, 7] + ends[:, 7]
+        self.data[rows, modeIdx, 4] = through[:, 2]
+        self.data[rows, modeIdx, 5] = through[:, 3]
+
+    def updateChoiceCharacteristics(self, microtypes, trips, incremental=True):
+        if not (incremental and self.__lastInputs):
+            self.resetChoiceCharacteristics()
+            self.commitInputs(self.changedInputs(microtypes))
+            for mode in self.modes:
+                self.updateModeCharacteristics(mode)
+            return
+        changed = self.changedInputs(microtypes)
+        self.commitInputs(changed)
+        affected = dict()
+        for microtypeID, mode in changed:
+            if mode in self.__modeToIdx:
+                affected.setdefault(mode, []).append(self.__rowsByMicrotype[microtypeID][mode])
+        for mode, rows in affected.items():
+            self.updateModeCharacteristics(mode, np.unique(np.concatenate(rows)))
 
 
 def filterAllocation(mode: str, inputAllocation, microtypes):
@@ -1,10 +1,20 @@
+import logging
+
+import numpy as np
 import pandas as pd
 
-from .OD import TripCollection, OriginDestination, TripGeneration, DemandIndex, ODindex, ModeSplit, TransitionMatrices
+from scipy.sparse import csr_matrix
+
+from .OD import TripCollection, OriginDestination, TripGeneration, DemandIndex, ODindex, ModeSplit, TransitionMatrices, \
+    CollectedModeSplits
 from .choiceCharacteristics import CollectedChoiceCharacteristics, filterAllocation
+from .instrumentation import getInstrumentation
+from .log import getLogger, logEvent
 from .microtype import MicrotypeCollection
 from .misc import DistanceBins
-from .population import Population
+from .population import Population, logitProbabilities
+
+logger = getLogger(__name__)
 
 
 class TotalUserCosts:
@@ -92,13 +102,13 @@ class CollectedTotalUserCosts:
         elif isinstance(item, tuple):
             return self.__costsByPopulationAndMode[item]
         else:
-            print("BADDDDD")
+            logger.error("Cannot index user costs by %s", type(item))
             return TotalUserCosts()
 
     def __iter__(self):
         return iter(self.__costsByPopulationAndMode.items())
 
-    def updateTotals(self, value: TotalUserCosts):
+    def updateTotals(self, value: TotalUserCosts = None):
         self.total = sum([c.total for c in self.__costsByPopulation.values()])
         self.totalEqualVOT = sum([c.totalEqualVOT for c in self.__costsByPopulation.values()])
         self.demandForTripsPerHour = sum([c.demandForTripsPerHour for c in self.__costsByPopulation.values()])
@@ -122,6 +132,7 @@ class CollectedTotalUserCosts:
             self.__costsByMode[mode] = self.__costsByMode[mode] * other
         for item in self.__costsByPopulationAndMode.keys():
             self.__costsByPopulationAndMode[item] = self.__costsByPopulationAndMode[item] * other
+        self.updateTotals()
         return self
 
     def __mul__(self, other):
@@ -132,6 +143,7 @@ class CollectedTotalUserCosts:
             out.__costsByMode[mode] = out.__costsByMode[mode] * other
         for item in out.__costsByPopulationAndMode.keys():
             out.__costsByPopulationAndMode[item] = out.__costsByPopulationAndMode[item] * other
+        out.updateTotals()
         return out
 
     def __rmul__(self, other):
@@ -143,6 +155,7 @@ class CollectedTotalUserCosts:
             self.__costsByMode[item[1]] = self.__costsByMode.setdefault(item[1], TotalUserCosts()) + cost
             self.__costsByPopulationAndMode[item] = self.__costsByPopulationAndMode.setdefault(item,
                                                                                                TotalUserCosts()) + cost
+        self.updateTotals(other)
         return self
 
     def toDataFrame(self, index=None) -> pd.DataFrame:
@@ -159,7 +172,7 @@ class CollectedTotalUserCosts:
 
 class Demand:
     def __init__(self):
-        self.__modeSplit = dict()
+        self.__modeSplit = CollectedModeSplits()
         self.tripRate = 0.0
         self.demandForPMT = 0.0
         self.pop = 0.0
@@ -168,6 +181,15 @@ class Demand:
         self.__trips = TripCollection()
         self.__distanceBins = DistanceBins()
         self.__transitionMatrices = TransitionMatrices()
+        self.__microtypeIDs = []
+        self.__originIdx = np.zeros(0, dtype=int)
+        self.__destinationIdx = np.zeros(0, dtype=int)
+        self.__slots = np.zeros(0, dtype=int)
+        self.__throughIncidence = dict()
+        self.__odIndices = []
+        self.__odPosition = np.zeros(0, dtype=int)
+        self.__classIdx = np.zeros(0, dtype=int)
+        self.__choiceParams = np.zeros((0, 0, 0))
 
     def __setitem__(self, key: (DemandIndex, ODindex), value: ModeSplit):
         self.__modeSplit[key] = value
@@ -177,7 +199,7 @@ class Demand:
             return self.__modeSplit[item]
         else:  # else return empty mode split
             (demandIndex, odi) = item
-            print("WTF")
+            logger.warning("No mode split for %s, %s", demandIndex, odi)
 
     def __contains__(self, item):
         """ Return true if the correct value"""
@@ -186,6 +208,10 @@ class Demand:
         else:
             return False
 
+    @property
+    def modeSplits(self) -> CollectedModeSplits:
+        return self.__modeSplit
+
     def initializeDemand(self, population: Population, originDestination: OriginDestination,
                          tripGeneration: TripGeneration, trips: TripCollection, microtypes: MicrotypeCollection,
                          distanceBins: DistanceBins, transitionMatrices: TransitionMatrices, timePeriodDuration: float,
@@ -195,139 +221,169 @@ class Demand:
         self.__distanceBins = distanceBins
         self.__transitionMatrices = transitionMatrices
         self.timePeriodDuration = timePeriodDuration
-        newTransitionMatrix = microtypes.emptyTransitionMatrix()
+        rows = []
+        portions = []
+        ratesPerHour = []
+        pops = []
+        rowsPerClass = []
         for demandIndex, utilityParams in population:
             od = originDestination[demandIndex]
-            ratePerHourPerCapita = tripGeneration[demandIndex.populationGroupType, demandIndex.tripPurpose] * multiplier
-            pop = population.getPopulation(demandIndex.homeMicrotype, demandIndex.populationGroupType)
-            for odi, portion in od.items():
-                trip = trips[odi]
-                common_modes = [microtypes[trip.odIndex.o].mode_names, microtypes[trip.odIndex.d].mode_names]
-                # # Now we're switching over to only looking at origin and destination modes
-                # common_modes = []
-                # for microtypeID, allocation in trip.allocation:
-                #     if allocation > 0:
-                #         common_modes.append(microtypes[microtypeID].mode_names)
-                modes = set.intersection(*common_modes)
-                tripRatePerHour = ratePerHourPerCapita * pop * portion
-                self.tripRate += tripRatePerHour
-                demandForPMT = ratePerHourPerCapita * pop * portion * distanceBins[odi.distBin]
-                newTransitionMatrix.addAndMultiply(transitionMatrices[odi],
-                                                   tripRatePerHour)  # += transitionMatrices[odi] * tripRatePerHour
-                self.demandForPMT += demandForPMT
-                self.pop += pop
-                modeSplit = dict()
-                for mode in modes:
-                    if mode == "auto":
-                        modeSplit[mode] = 1.0
-                    else:
-                        modeSplit[mode] = 0.0
-                self[demandIndex, odi] = ModeSplit(modeSplit, tripRatePerHour, demandForPMT)
-                # dist, alloc = transitionMatrices[odi].getSteadyState()
-                # distReal = self.__distanceBins[odi.distBin] * 1609.34
-                # allocReal = trip.allocation.sortedValueArray()
-                # diff = alloc - allocReal
-                # print("WHAT")
+            ratesPerHour.append(
+                tripGeneration[demandIndex.populationGroupType, demandIndex.tripPurpose] * multiplier)
+            pops.append(population.getPopulation(demandIndex.homeMicrotype, demandIndex.populationGroupType))
+            rowsPerClass.append(len(od))
+            rows.extend((demandIndex, odi) for odi in od.keys())
+            portions.extend(od.values())
+        distances = {distBin: distanceBins[distBin] for distBin in set(odi.distBin for _, odi in rows)}
+        tripRatesPerHour = np.repeat(np.array(ratesPerHour, dtype=float) * np.array(pops, dtype=float),
+                                     rowsPerClass) * np.array(portions, dtype=float)
+        demandsForPMT = tripRatesPerHour * np.array([distances[odi.distBin] for _, odi in rows])
+        self.tripRate += np.sum(tripRatesPerHour)
+        self.demandForPMT += np.sum(demandsForPMT)
+        self.pop += np.dot(np.array(pops, dtype=float), rowsPerClass)
+
+        slots = np.array([transitionMatrices.slot(odi) for _, odi in rows], dtype=int)
+        newTransitionMatrix = microtypes.emptyTransitionMatrix()
+        newTransitionMatrix.addAndMultiply(transitionMatrices.weightedSum(slots, tripRatesPerHour), 1.0)
+
+        modeSets = dict()
+        initialModeSplits = dict()
+        for odi in set(odi for _, odi in rows):
+            trip = trips[odi]
+            common_modes = [microtypes[trip.odIndex.o].mode_names, microtypes[trip.odIndex.d].mode_names]
+            modeSets[odi] = set.intersection(*common_modes)
+            initialModeSplits[odi] = {mode: 1.0 if mode == "auto" else 0.0 for mode in modeSets[odi]}
+        self.__modeSplit.initialize(rows, [modeSets[odi] for _, odi in rows],
+                                    [initialModeSplits[odi] for _, odi in rows], tripRatesPerHour, demandsForPMT)
+        self.indexRows(microtypes, slots)
         microtypes.transitionMatrix.updateMatrix(newTransitionMatrix * (1.0 / self.tripRate))
 
+    def indexRows(self, microtypes: MicrotypeCollection, slots: np.ndarray):
+        """
+        Precomputes, for every mode split row, the origin and destination microtype, the transition matrix slot,
+        (for each non-auto mode) which microtypes the trip passes through, and where its choice characteristics and
+        choice parameters sit in the batched logit inputs
+        """
+        self.__microtypeIDs = microtypes.microtypeNames()
+        microtypeToIdx = {microtypeID: idx for idx, microtypeID in enumerate(self.__microtypeIDs)}
+        odIndices = self.__modeSplit.odIndices
+        self.__originIdx = np.array([microtypeToIdx[odi.o] for odi in odIndices], dtype=int)
+        self.__destinationIdx = np.array([microtypeToIdx[odi.d] for odi in odIndices], dtype=int)
+        self.__slots = slots
+        self.__odIndices = list(dict.fromkeys(odIndices))
+        odToPosition = {odi: idx for idx, odi in enumerate(self.__odIndices)}
+        self.__odPosition = np.array([odToPosition[odi] for odi in odIndices], dtype=int)
+        self.__classIdx = np.array([self.__population.classIndex(di) for di in self.__modeSplit.demandIndices],
+                                   dtype=int)
+        self.__choiceParams = self.__population.choiceParams(self.__modeSplit.modes)
+        distances = np.array([self.__distanceBins[odi.distBin] for odi in odIndices])
+        self.__throughIncidence = dict()
+        for mode in self.__modeSplit.modes:
+            if mode == "auto":
+                continue
+            rowIdx = []
+            microtypeIdx = []
+            allocations = dict()
+            for row, odi in enumerate(odIndices):
+                if odi not in allocations:
+                    allocations[odi] = [microtypeToIdx[k] for k in
+                                        filterAllocation(mode, self.__trips[odi].allocation, microtypes).keys()]
+                rowIdx.extend([row] * len(allocations[odi]))
+                microtypeIdx.extend(allocations[odi])
+            self.__throughIncidence[mode] = csr_matrix(
+                (distances[rowIdx], (microtypeIdx, rowIdx)), shape=(len(self.__microtypeIDs), len(odIndices)))
+
     def updateMFD(self, microtypes: MicrotypeCollection, nIters=3):
         for microtypeID, microtype in microtypes:
             microtype.resetDemand()
-        newTransitionMatrix = microtypes.emptyTransitionMatrix()
-        totalDemandForTrips = 0.0
-        for (di, odi), ms in self.__modeSplit.items():
-            # assert (isinstance(ms, ModeSplit))
-            # assert (isinstance(odi, ODindex))
-            # assert (isinstance(di, DemandIndex))
-            for mode, split in ms:
-                microtypes[odi.o].addModeStarts(mode, ms.demandForTripsPerHour * split)
-                microtypes[odi.d].addModeEnds(mode, ms.demandForTripsPerHour * split)
-                if mode == "auto":
-                    newTransitionMatrix.addAndMultiply(self.__transitionMatrices[odi], ms.demandForTripsPerHour * split)
-                    totalDemandForTrips += ms.demandForTripsPerHour * split
-                else:
-                    newAllocation = filterAllocation(mode, self.__trips[odi].allocation, microtypes)
-                    for k, portion in newAllocation.items():
-                        microtypes[k].addModeDemandForPMT(mode, ms.demandForTripsPerHour * split,
-                                                          self.__distanceBins[odi.distBin])
-        microtypes.transitionMatrix = newTransitionMatrix * (1.0 / totalDemandForTrips)
-
+        modeSplits = self.__modeSplit
+        flows = modeSplits.flows()
+        nMicrotypes = len(self.__microtypeIDs)
+        for modeIdx, mode in enumerate(modeSplits.modes):
+            available = modeSplits.available[:, modeIdx]
+            starts = np.bincount(self.__originIdx, weights=flows[:, modeIdx], minlength=nMicrotypes)
+            ends = np.bincount(self.__destinationIdx, weights=flows[:, modeIdx], minlength=nMicrotypes)
+            hasStarts = np.bincount(self.__originIdx, weights=available, minlength=nMicrotypes) > 0
+            hasEnds = np.bincount(self.__destinationIdx, weights=available, minlength=nMicrotypes) > 0
+            if mode == "auto":
+                throughPMT = np.zeros(nMicrotypes)
+            else:
+                # Each microtype a trip passes through sees the full trip distance
+                throughPMT = self.__throughIncidence[mode] @ flows[:, modeIdx]
+            for idx, microtypeID in enumerate(self.__microtypeIDs):
+                if hasStarts[idx]:
+                    microtypes[microtypeID].addModeStarts(mode, starts[idx])
+                if hasEnds[idx]:
+                    microtypes[microtypeID].addModeEnds(mode, ends[idx])
+                if throughPMT[idx] > 0:
+                    microtypes[microtypeID].addModeDemandForPMT(mode, throughPMT[idx], 1.0)
+        if "auto" in modeSplits.modes:
+            autoFlows = flows[:, modeSplits.modeIdx("auto")]
+            totalDemandForTrips = np.sum(autoFlows)
+            newTransitionMatrix = microtypes.emptyTransitionMatrix()
+            newTransitionMatrix.addAndMultiply(self.__transitionMatrices.weightedSum(self.__slots, autoFlows), 1.0)
+            microtypes.transitionMatrix = newTransitionMatrix * (1.0 / totalDemandForTrips)
+
+        instrumentation = getInstrumentation()
         for it in range(nIters):
-            microtypes.transitionMatrixMFD(self.timePeriodDuration)
+            out = microtypes.transitionMatrixMFD(self.timePeriodDuration)
+            instrumentation.count("mfdIterations")
+            instrumentation.count("mfdSteps", out["steps"])
             for microtypeID, microtype in microtypes:
                 microtype.updateNetworkSpeeds(1)
 
+    def logitSplits(self, collectedChoiceCharacteristics: CollectedChoiceCharacteristics) -> np.ndarray:
+        """Mode splits of every (demand class, OD) row implied by the current choice characteristics, unblended"""
+        modeSplits = self.__modeSplit
+        characteristics = collectedChoiceCharacteristics.toArray(self.__odIndices, modeSplits.modes)
+        return logitProbabilities(characteristics[self.__odPosition], self.__choiceParams, self.__classIdx,
+                                  modeSplits.available)
+
     def updateModeSplit(self, collectedChoiceCharacteristics: CollectedChoiceCharacteristics,
                         originDestination: OriginDestination, oldModeSplit: ModeSplit):
-        for demandIndex, utilityParams in self.__population:
-            od = originDestination[demandIndex]
-            for odi, portion in od.items():
-                # dg = self.__population[demandIndex]
-                ms = self.__population[demandIndex].updateModeSplit(collectedChoiceCharacteristics[odi])
-                self[demandIndex, odi].updateMapping(ms)
-                self[demandIndex, odi] *= oldModeSplit
+        modeSplits = self.__modeSplit
+        newSplits = self.logitSplits(collectedChoiceCharacteristics)
+        modeSplits.blend(newSplits, oldModeSplit)
         newModeSplit = self.getTotalModeSplit()
-        print(newModeSplit)
+        logEvent(logger, logging.DEBUG, "modeSplit", "%s", newModeSplit, modeSplit=newModeSplit)
         diff = oldModeSplit - newModeSplit
         return diff
 
     def getTotalModeSplit(self, userClass=None, microtypeID=None, distanceBin=None, otherModeSplit=None) -> ModeSplit:
-        demandForTrips = 0
-        demandForDistance = 0
+        modeSplits = self.__modeSplit
+        relevant = modeSplits.rowMask(userClass, microtypeID, distanceBin)
+        demandForTrips = np.sum(modeSplits.demandForTripsPerHour[relevant])
+        demandForDistance = np.sum(modeSplits.demandForPmtPerHour[relevant])
+        tripsByMode = np.sum(modeSplits.flows()[relevant, :], axis=0)
+        present = np.any(modeSplits.available[relevant, :], axis=0)
         trips = dict()
-        for (di, odi), ms in self.__modeSplit.items():
-            relevant = ((userClass is None) or (di.populationGroupType == userClass)) & (
-                    (microtypeID is None) or (di.homeMicrotype == microtypeID)) & (
-                               (distanceBin is None) or (odi.distBin == distanceBin))
-            if relevant:
-                for mode, split in ms:
-                    new_demand = trips.setdefault(mode, 0) + split * ms.demandForTripsPerHour
-                    trips[mode] = new_demand
-                demandForTrips += ms.demandForTripsPerHour
-                demandForDistance += ms.demandForPmtPerHour
-        for mode in trips.keys():
-            if otherModeSplit is not None:
-                trips[mode] /= (demandForTrips * 2.)
-                trips[mode] += otherModeSplit[mode] / 2.
-            else:
-                trips[mode] /= demandForTrips
+        for modeIdx, mode in enumerate(modeSplits.modes):
+            if present[modeIdx]:
+                if otherModeSplit is not None:
+                    trips[mode] = tripsByMode[modeIdx] / (demandForTrips * 2.) + otherModeSplit[mode] / 2.
+                else:
+                    trips[mode] = tripsByMode[modeIdx] / demandForTrips
         return ModeSplit(trips, demandForTrips, demandForDistance)
 
     def getUserCosts(self, collectedChoiceCharacteristics: CollectedChoiceCharacteristics,
                      originDestination: OriginDestination, modes=None) -> CollectedTotalUserCosts:
         out = CollectedTotalUserCosts()
-        for demandIndex, utilityParams in self.__population:
-            totalCost = 0.
-            totalCostDefault = 0.
-            totalDemandForTripsPerHour = 0.
-            totalDemandForPMTPerHour = 0.
-            totalInVehicle = 0.
-            totalOutVehicle = 0.
-            od = originDestination[demandIndex]
-            demandClass = self.__population[demandIndex]
-            for odi, portion in od.items():
-                ms = self[(demandIndex, odi)]
-                mcc = collectedChoiceCharacteristics[odi]
-                for mode in ms.keys():
-                    cost, inVehicle, outVehicle, demandForTripsPerHour, distance = demandClass.getCostPerCapita(mcc, ms,
-                                                                                                                [mode])
-                    if demandForTripsPerHour > 0:
-                        out[demandIndex, mode] = TotalUserCosts(cost * demandForTripsPerHour, 0.0,
-                                                                inVehicle * demandForTripsPerHour,
-                                                                outVehicle * demandForTripsPerHour,
-                                                                demandForTripsPerHour,
-                                                                demandForTripsPerHour * distance)
-                # cost, inVehicle, outVehicle, demandForTripsPerHour, distance = demandClass.getCostPerCapita(mcc, ms,
-                #                                                                                             modes)
-                # # costDefault = demandClass.getCostPerCapita(mcc, ms, modes) * ms.demandForTripsPerHour  # TODO: Add default
-                # totalCost -= cost * demandForTripsPerHour
-                # totalInVehicle += inVehicle * demandForTripsPerHour
-                # totalOutVehicle += outVehicle * demandForTripsPerHour
-                # totalCostDefault -= 0.0
-                # totalDemandForTripsPerHour += demandForTripsPerHour
-                # totalDemandForPMTPerHour += distance * demandForTripsPerHour
-            # out[demandIndex] = TotalUserCosts(totalCost, totalCostDefault, totalInVehicle, totalOutVehicle,
-            # totalDemandForTripsPerHour, totalDemandForPMTPerHour)
+        modeSplits = self.__modeSplit
+        flows = modeSplits.flows()
+        rows, modeIdxs = np.nonzero(flows > 0)
+        characteristics = collectedChoiceCharacteristics.fieldArray(self.__odIndices, modeSplits.modes)
+        for row, modeIdx in zip(rows.tolist(), modeIdxs.tolist()):
+            demandIndex = modeSplits.demandIndices[row]
+            mode = modeSplits.modes[modeIdx]
+            split = modeSplits.splits[row, modeIdx]
+            demandForTripsPerHour = flows[row, modeIdx]
+            costPerTrip, inVehicle, outVehicle, distance = self.__population[
+                demandIndex].getModeCostPerTripFromFields(mode, characteristics[self.__odPosition[row], modeIdx])
+            out[demandIndex, mode] = TotalUserCosts(costPerTrip * split * demandForTripsPerHour, 0.0,
+                                                    inVehicle * split * demandForTripsPerHour,
+                                                    outVehicle * split * demandForTripsPerHour,
+                                                    demandForTripsPerHour,
+                                                    demandForTripsPerHour * distance * split)
         return out
 
     def __str__(self):
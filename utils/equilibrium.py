@@ -0,0 +1,198 @@
+import numpy as np
+from scipy.optimize import newton_krylov
+
+try:
+    from scipy.optimize import NoConvergence
+except ImportError:  # scipy < 1.8
+    from scipy.optimize.nonlin import NoConvergence
+
+from .instrumentation import getInstrumentation
+
+
+class EquilibriumResult:
+    """
+    Outcome of solving for the equilibrium mode splits of one time period
+
+    Attributes
+    ----------
+    method : str
+        Name of the solver in SOLVERS
+    iterations : int
+        Outer iterations of the solver (MSA or Anderson steps, Newton steps)
+    evaluations : int
+        Evaluations of the supply/demand fixed-point map, each of which updates the MFD and choice characteristics
+    residual : float
+        Final residual. For MSA this is the norm of the change in the aggregate mode split, as before; otherwise it is
+        the largest change in any individual mode split under the fixed-point map
+    converged : bool
+        Whether the residual is below the tolerance
+    """
+
+    def __init__(self, method: str, iterations: int, evaluations: int, residual: float, converged: bool):
+        self.method = method
+        self.iterations = iterations
+        self.evaluations = evaluations
+        self.residual = residual
+        self.converged = converged
+
+    def __str__(self):
+        return self.method + ': ' + str(self.iterations) + ' iterations, ' + str(
+            self.evaluations) + ' evaluations, residual ' + str(self.residual)
+
+
+class EquilibriumProblem:
+    """
+    Fixed-point formulation of one time period's equilibrium on the flattened vector x of available mode splits:
+    x maps to the logit mode splits implied by the network performance that results from x.
+
+    Attributes
+    ----------
+    demand : Demand
+    microtypes : MicrotypeCollection
+    choice : CollectedChoiceCharacteristics
+    trips : TripCollection
+    originDestination : OriginDestination
+    aggregateModeSplit : callable
+        Returns the current aggregate ModeSplit, which the MSA update blends against
+    evaluations : int
+        Number of evaluations of the fixed-point map so far
+
+    Methods
+    ----------
+    state():
+        Flattened vector of available mode splits
+    setState(x):
+        Write a flattened vector back to the mode split store
+    project(x):
+        Clip to nonnegative splits that sum to one over each row's available modes
+    fixedPointMap(x):
+        Logit mode splits given the network performance resulting from x
+    msaStep():
+        One iteration of the method of successive averages, returning the change in aggregate mode split
+    """
+
+    def __init__(self, demand, microtypes, choice, trips, originDestination, aggregateModeSplit):
+        self.demand = demand
+        self.microtypes = microtypes
+        self.choice = choice
+        self.trips = trips
+        self.originDestination = originDestination
+        self.aggregateModeSplit = aggregateModeSplit
+        self.evaluations = 0
+        self.__mask = demand.modeSplits.available.copy()
+        self.__rows = np.nonzero(self.__mask)[0]
+
+    def state(self) -> np.ndarray:
+        return self.demand.modeSplits.splits[self.__mask]
+
+    def setState(self, x: np.ndarray):
+        splits = np.zeros(self.__mask.shape)
+        splits[self.__mask] = x
+        self.demand.modeSplits.splits = splits
+
+    def project(self, x: np.ndarray) -> np.ndarray:
+        x = np.clip(x, 0.0, None)
+        totals = np.bincount(self.__rows, weights=x, minlength=self.__mask.shape[0])
+        totals[totals <= 0] = 1.0
+        return x / totals[self.__rows]
+
+    def fixedPointMap(self, x: np.ndarray) -> np.ndarray:
+        instrumentation = getInstrumentation()
+        self.setState(x)
+        self.evaluations += 1
+        with instrumentation.stage("updateMFD"):
+            self.demand.updateMFD(self.microtypes)
+        with instrumentation.stage("updateChoiceCharacteristics"):
+            self.choice.updateChoiceCharacteristics(self.microtypes, self.trips)
+        with instrumentation.stage("updateModeSplit"):
+            return self.demand.logitSplits(self.choice)[self.__mask]
+
+    def msaStep(self) -> float:
+        instrumentation = getInstrumentation()
+        ms = self.aggregateModeSplit()
+        self.evaluations += 1
+        with instrumentation.stage("updateMFD"):
+            self.demand.updateMFD(self.microtypes)
+        with instrumentation.stage("updateChoiceCharacteristics"):
+            self.choice.updateChoiceCharacteristics(self.microtypes, self.trips)
+        with instrumentation.stage("updateModeSplit"):
+            return self.demand.updateModeSplit(self.choice, self.originDestination, ms)
+
+
+def solveMSA(problem: EquilibriumProblem, tolerance=1e-4, maxIterations=20) -> EquilibriumResult:
+    """Method of successive averages, with the new splits given weight 1/counter"""
+    diff = 1000.
+    i = 0
+    while (diff > tolerance) & (i < maxIterations):
+        diff = problem.msaStep()
+        getInstrumentation().endIteration(residual=diff)
+        i += 1
+    return EquilibriumResult("msa", i, problem.evaluations, diff, diff <= tolerance)
+
+
+def solveAnderson(problem: EquilibriumProblem, tolerance=1e-4, maxIterations=20, memory=5,
+                  mixing=1.0) -> EquilibriumResult:
+    """
+    Anderson acceleration of the fixed-point iteration: each step extrapolates from the last `memory` iterates the
+    combination whose residual is smallest in the least-squares sense
+    """
+    x = problem.state()
+    xs, fs = [], []
+    residual = np.inf
+    i = 0
+    while i < maxIterations:
+        g = problem.fixedPointMap(x)
+        f = g - x
+        residual = np.max(np.abs(f)) if len(f) else 0.0
+        getInstrumentation().endIteration(residual=residual)
+        i += 1
+        if residual <= tolerance:
+            break
+        xs.append(x)
+        fs.append(f)
+        if len(xs) > memory + 1:
+            xs.pop(0)
+            fs.pop(0)
+        if len(xs) > 1:
+            dX = np.diff(np.array(xs), axis=0).T
+            dF = np.diff(np.array(fs), axis=0).T
+            gamma = np.linalg.lstsq(dF, f, rcond=None)[0]
+            x = x + mixing * f - (dX + mixing * dF) @ gamma
+        else:
+            x = x + mixing * f
+        x = problem.project(x)
+    return EquilibriumResult("anderson", i, problem.evaluations, residual, residual <= tolerance)
+
+
+def solveNewtonKrylov(problem: EquilibriumProblem, tolerance=1e-4, maxIterations=20, innerMaxIterations=10,
+                      finiteDifferenceStep=1e-6) -> EquilibriumResult:
+    """
+    Jacobian-free Newton-Krylov on the residual G(x) - x, with Jacobian-vector products from finite differences of
+    the fixed-point map. The relative finite difference step is kept well above machine precision because the MFD
+    integration makes the map only smooth to a few digits.
+    """
+    iterations = [0]
+
+    def residual(x):
+        f = problem.fixedPointMap(problem.project(x)) - x
+        getInstrumentation().endIteration(residual=np.max(np.abs(f)) if len(f) else 0.0)
+        return f
+
+    def callback(x, f):
+        iterations[0] += 1
+
+    x0 = problem.state()
+    try:
+        x = newton_krylov(residual, x0, f_tol=tolerance, maxiter=maxIterations, inner_maxiter=innerMaxIterations,
+                          rdiff=finiteDifferenceStep, callback=callback)
+    except NoConvergence as e:
+        x = e.args[0]
+    x = problem.project(x)
+    f = problem.fixedPointMap(x) - x
+    getInstrumentation().endIteration(residual=np.max(np.abs(f)) if len(f) else 0.0)
+    finalResidual = np.max(np.abs(f)) if len(f) else 0.0
+    return EquilibriumResult("newton-krylov", iterations[0], problem.evaluations, finalResidual,
+                             finalResidual <= tolerance)
+
+
+SOLVERS = {"msa": solveMSA, "anderson": solveAnderson, "newton-krylov": solveNewtonKrylov}
@@ -0,0 +1,86 @@
+import json
+import sqlite3
+
+import numpy as np
+
+EVALUATION_CACHE_VERSION = 2
+
+
+class EvaluationCache:
+    """
+    SQLite store of Optimizer evaluations, shared between runs and worker processes. Entries are keyed by a
+    fingerprint of the scenario and optimizer setup plus the exact decision vector. If a resolution is set, the vector
+    is rounded to a multiple of it instead, so vectors closer together than the resolution share one evaluation; this
+    makes the cached objective piecewise constant, which finite-difference gradients with smaller steps see as flat.
+
+    Attributes
+    ----------
+    path : str
+        File path to the SQLite database
+    scenario : str
+        Fingerprint of everything besides the decision vector that the objective depends on
+    resolution : float | np.ndarray | None
+        Quantization step of the decision vector, either one value or one per element, or None for exact keys
+
+    Methods
+    -------
+    key(x):
+        Quantized form of x used as the key
+    get(x):
+        Return the stored costs (and mode splits, if stored) for x, or None
+    put(x, userCosts, operatorCosts, dedicationCosts, modeSplits=None):
+        Store an evaluation of x
+    """
+
+    def __init__(self, path: str, scenario: str, resolution=None):
+        self.path = path
+        self.scenario = scenario
+        self.resolution = resolution
+        self.__connection = None
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self.__connection is None:
+            self.__connection = sqlite3.connect(self.path, timeout=60.)
+            self.__connection.execute("PRAGMA journal_mode=WAL")
+            self.__connection.execute(
+                "CREATE TABLE IF NOT EXISTS evaluations (scenario TEXT, key TEXT, x TEXT, userCosts REAL, "
+                "operatorCosts REAL, dedicationCosts REAL, modeSplits TEXT, PRIMARY KEY (scenario, key))")
+            self.__connection.commit()
+        return self.__connection
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_EvaluationCache__connection"] = None
+        return state
+
+    def close(self):
+        if self.__connection is not None:
+            self.__connection.close()
+            self.__connection = None
+
+    def key(self, x: np.ndarray) -> str:
+        if self.resolution is None:
+            return json.dumps(np.asarray(x, dtype=float).tolist())
+        return json.dumps(np.round(np.asarray(x, dtype=float) / self.resolution).astype(np.int64).tolist())
+
+    def get(self, x: np.ndarray):
+        row = self.connection.execute(
+            "SELECT userCosts, operatorCosts, dedicationCosts, modeSplits FROM evaluations WHERE scenario = ? AND "
+            "key = ?", (self.scenario, self.key(x))).fetchone()
+        if row is None:
+            return None
+        return {"userCosts": row[0], "operatorCosts": row[1], "dedicationCosts": row[2],
+                "modeSplits": None if row[3] is None else json.loads(row[3])}
+
+    def put(self, x: np.ndarray, userCosts: float, operatorCosts: float, dedicationCosts: float, modeSplits=None):
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO evaluations VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (self.scenario, self.key(x), json.dumps(np.asarray(x, dtype=float).tolist()), float(userCosts),
+                 float(operatorCosts), float(dedicationCosts),
+                 None if modeSplits is None else json.dumps(modeSplits, default=float)))
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM evaluations WHERE scenario = ?",
+                                       (self.scenario,)).fetchone()[0]
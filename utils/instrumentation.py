@@ -0,0 +1,187 @@
+import json
+import time
+from contextlib import nullcontext
+
+import pandas as pd
+
+from .log import EventHandler, enableLogging, disableLogging
+
+
+class Instrumentation:
+    """
+    Recorder for timings and counters inside the equilibrium loop. Stage wall times and counts accumulate into the
+    current iteration until endIteration is called, which closes it as one record tagged with the current context
+    (e.g. time period and solver). Records are kept in memory and optionally written as JSON lines to a sink.
+
+    Install a recorder with setInstrumentation, or use it as a context manager:
+
+        with Instrumentation("run.jsonl") as recorder:
+            model.collectAllCosts()
+        recorder.toDataFrame()
+
+    If eventLevel is set, the recorder also receives the structured events logged by the model at that level or
+    above (see utils.log) while it is installed as a context manager, and keeps them in events.
+
+    Attributes
+    ----------
+    records : list
+        One dict per closed iteration
+    totals : dict
+        Running totals of every counter and stage time across all records
+    context : dict
+        Fields added to every record
+    events : list
+        One dict per logged event, tagged with the current context
+
+    Methods
+    ----------
+    stage(name):
+        Context manager adding the wall time of its body to stage `name`
+    count(name, n=1):
+        Increment counter `name`
+    setContext(**fields):
+        Set fields added to subsequent records, starting a new iteration count
+    endIteration(**fields):
+        Close the current iteration as a record, with any extra fields (e.g. residual)
+    event(name, fields):
+        Keep a structured event, e.g. from utils.log.EventHandler
+    toDataFrame():
+        Records as a DataFrame
+    """
+
+    enabled = True
+
+    def __init__(self, sink=None, eventLevel=None):
+        self.records = []
+        self.totals = dict()
+        self.context = dict()
+        self.events = []
+        self.eventLevel = eventLevel
+        self.__eventHandler = None
+        self.__current = dict()
+        self.__iteration = 0
+        self.__previous = None
+        if isinstance(sink, str):
+            self.__sink = open(sink, "a")
+            self.__ownsSink = True
+        else:
+            self.__sink = sink
+            self.__ownsSink = False
+
+    def __enter__(self):
+        self.__previous = setInstrumentation(self)
+        if self.eventLevel is not None:
+            self.__eventHandler = enableLogging(self.eventLevel, handler=EventHandler(self.event, self.eventLevel))
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.__eventHandler is not None:
+            disableLogging(self.__eventHandler)
+            self.__eventHandler = None
+        setInstrumentation(self.__previous)
+        self.close()
+
+    def close(self):
+        if self.__ownsSink and (self.__sink is not None):
+            self.__sink.close()
+            self.__sink = None
+
+    def stage(self, name: str):
+        return _Stage(self, name)
+
+    def addTime(self, name: str, seconds: float):
+        self.__current[name] = self.__current.get(name, 0.0) + seconds
+        self.totals[name] = self.totals.get(name, 0.0) + seconds
+
+    def count(self, name: str, n=1):
+        self.__current[name] = self.__current.get(name, 0) + n
+        self.totals[name] = self.totals.get(name, 0) + n
+
+    def setContext(self, **fields):
+        self.context = fields
+        self.__iteration = 0
+
+    def endIteration(self, **fields):
+        record = {**self.context, "iteration": self.__iteration, **self.__current, **fields}
+        self.records.append(record)
+        if self.__sink is not None:
+            self.__sink.write(json.dumps(record, default=_toJson) + "\n")
+            self.__sink.flush()
+        self.__current = dict()
+        self.__iteration += 1
+        return record
+
+    def event(self, name: str, fields: dict):
+        event = {**self.context, "event": name, **fields}
+        self.events.append(event)
+        if self.__sink is not None:
+            self.__sink.write(json.dumps(event, default=_toJson) + "\n")
+            self.__sink.flush()
+        return event
+
+    def toDataFrame(self) -> pd.DataFrame:
+        return pd.DataFrame(self.records)
+
+
+class NullInstrumentation:
+    """Default recorder, which does nothing"""
+
+    enabled = False
+    __stage = nullcontext()
+
+    def stage(self, name: str):
+        return self.__stage
+
+    def addTime(self, name: str, seconds: float):
+        pass
+
+    def count(self, name: str, n=1):
+        pass
+
+    def setContext(self, **fields):
+        pass
+
+    def endIteration(self, **fields):
+        pass
+
+    def event(self, name: str, fields: dict):
+        pass
+
+
+class _Stage:
+    __slots__ = ("recorder", "name", "start")
+
+    def __init__(self, recorder: Instrumentation, name: str):
+        self.recorder = recorder
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.recorder.addTime(self.name, time.perf_counter() - self.start)
+
+
+def _toJson(obj):
+    if hasattr(obj, "toDict"):
+        return obj.toDict()
+    if hasattr(obj, "tolist"):
+        return obj.tolist()
+    return str(obj)
+
+
+_recorder = NullInstrumentation()
+
+
+def getInstrumentation():
+    return _recorder
+
+
+def setInstrumentation(recorder):
+    """Install recorder (or disable instrumentation if it is None) and return the one it replaces"""
+    global _recorder
+    previous = _recorder
+    _recorder = NullInstrumentation() if recorder is None else recorder
+    return previous
@@ -0,0 +1,89 @@
+import logging
+import sys
+
+ROOT_LOGGER = "gesm"
+
+logging.getLogger(ROOT_LOGGER).addHandler(logging.NullHandler())
+
+# Handlers added by enableLogging, and the package logger's level before the first of them
+_handlers = []
+_previousLevel = logging.NOTSET
+
+
+def getLogger(name: str) -> logging.Logger:
+    """Logger for a module of the model, under the package logger, which is silent unless a handler is added"""
+    return logging.getLogger(ROOT_LOGGER + "." + name)
+
+
+def logEvent(logger: logging.Logger, level: int, event: str, message: str, *args, **fields):
+    """
+    Log a structured event. Nothing is formatted, and the fields are not copied, unless some handler takes records
+    of this level, so this is cheap enough for hot paths. The fields travel with the record as record.fields, for
+    EventHandler; message is formatted lazily with args, as usual for logging.
+    """
+    if logger.isEnabledFor(level):
+        if sys.version_info >= (3, 8):
+            logger.log(level, message, *args, extra={"event": event, "fields": fields}, stacklevel=2)
+        else:
+            logger.log(level, message, *args, extra={"event": event, "fields": fields})
+
+
+class EventHandler(logging.Handler):
+    """
+    Handler passing the structured events from logEvent to a sink, such as Instrumentation.event or any callable
+    sink(event, fields). Records not logged through logEvent are passed as "message" events.
+
+    Attributes
+    ----------
+    sink : callable
+        Called with the event name and a dict of its fields, plus the logger name, level and message
+    """
+
+    def __init__(self, sink, level=logging.DEBUG):
+        super().__init__(level)
+        self.sink = sink
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            fields = dict(getattr(record, "fields", dict()))
+            fields.update(logger=record.name, level=record.levelname, message=record.getMessage())
+            self.sink(getattr(record, "event", "message"), fields)
+        except Exception:
+            self.handleError(record)
+
+
+def enableLogging(level=logging.INFO, stream=None, handler=None) -> logging.Handler:
+    """
+    Turn on console output (or another handler) for the model's loggers at the given level, e.g. logging.INFO for
+    progress messages as data is loaded and periods are solved, or logging.DEBUG for every equilibrium iteration.
+    The level is set on the handler, so handlers enabled at different levels each only get their own records; the
+    package logger is lowered just enough to pass the most verbose of them. Returns the handler so it can be removed
+    again with disableLogging.
+    """
+    global _previousLevel
+    if handler is None:
+        handler = logging.StreamHandler(sys.stdout if stream is None else stream)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+    handler.setLevel(level)
+    logger = logging.getLogger(ROOT_LOGGER)
+    if not _handlers:
+        _previousLevel = logger.level
+    _handlers.append(handler)
+    logger.addHandler(handler)
+    _updateLevel()
+    return handler
+
+
+def disableLogging(handler: logging.Handler):
+    """Remove a handler added by enableLogging, restoring the package logger's level once none are left"""
+    logging.getLogger(ROOT_LOGGER).removeHandler(handler)
+    if handler in _handlers:
+        _handlers.remove(handler)
+    _updateLevel()
+
+
+def _updateLevel():
+    levels = [h.level for h in _handlers]
+    if _previousLevel != logging.NOTSET:
+        levels.append(_previousLevel)
+    logging.getLogger(ROOT_LOGGER).setLevel(min(levels) if _handlers else _previousLevel)
@@ -0,0 +1,267 @@
+import inspect
+
+import numpy as np
+from scipy.integrate import solve_ivp
+from scipy.linalg import expm
+from scipy.sparse import issparse, identity, diags
+from scipy.sparse.linalg import expm_multiply, spsolve
+
+from .log import getLogger
+
+logger = getLogger(__name__)
+
+
+def speed(n, v_0, n_0, n_other, minspeed=0.1):
+    """Speed of each microtype's auto network given its accumulation, floored at minspeed and capped at v_0"""
+    n_eff = n + n_other
+    v = v_0 * (1. - n_eff / n_0)
+    v = np.where(v < minspeed, minspeed, v)
+    return np.where(v > v_0, v_0, v)
+
+
+def accumulationDerivative(n, demand, L, X, v_0, n_0, n_other):
+    """
+    Rate of change of accumulation: trip starts plus vehicles transferring in from other microtypes (through the
+    transposed transition matrix X, either a dense array or a scipy sparse matrix) minus vehicles leaving
+    """
+    outflow = speed(n, v_0, n_0, n_other, 1.0) * n / L
+    return demand + X @ outflow - outflow
+
+
+def recordedSteps(nSteps, record):
+    """Indices of the steps kept in a trajectory recorded every `record` steps, always including the last one"""
+    if not record:
+        return np.array([], dtype=int)
+    steps = np.arange(0, nSteps, int(record))
+    if (nSteps > 0) and (steps[-1] != nSteps - 1):
+        steps = np.append(steps, nSteps - 1)
+    return steps
+
+
+def integrateEuler(n_init, demand, L, X, v_0, n_0, n_other, durationInHours, dt=0.02 * 3600., record=None):
+    """
+    Explicit Euler integration with a fixed time step. Accumulation exceeding the jam accumulation is reset to
+    the jam accumulation after each step.
+
+    Only running aggregates (mean and final speed, final and maximum accumulation, time spent jammed) are kept unless
+    record is set, in which case the trajectory is stored every `record` steps.
+    """
+    ts = np.arange(0, durationInHours * 3600., dt)
+    kept = recordedSteps(np.size(ts), record)
+    ns = np.zeros((len(n_init), np.size(kept)))
+    vs = np.zeros((len(n_init), np.size(kept)))
+    n_t = n_init.copy()
+    v_t = speed(n_t, v_0, n_0, n_other)
+    vSum = np.zeros_like(v_t)
+    n_max = n_t.copy()
+    timeJammed = np.zeros_like(n_t)
+    jamAccumulation = n_0 - n_other
+
+    col = 0
+    for i in range(np.size(ts)):
+        dn = accumulationDerivative(n_t, demand, L, X, v_0, n_0, n_other) * dt
+        n_t += dn
+        jammed = n_t > jamAccumulation
+        n_t[jammed] = n_0[jammed]
+        v_t = speed(n_t, v_0, n_0, n_other)
+        vSum += v_t
+        np.maximum(n_max, n_t, out=n_max)
+        timeJammed[jammed] += dt
+        if (col < np.size(kept)) and (kept[col] == i):
+            ns[:, col] = n_t
+            vs[:, col] = v_t
+            col += 1
+
+    return {"t": ts[kept] if record else None, "n": ns if record else None, "v": vs if record else None,
+            "v_av": vSum / np.size(ts), "n_final": n_t, "v_final": v_t, "n_max": n_max, "time_jammed": timeJammed,
+            "steps": np.size(ts)}
+
+
+def integrateAdaptive(n_init, demand, L, X, v_0, n_0, n_other, durationInHours, method="RK45",
+                      stiffMethod="LSODA", rtol=1e-6, atol=1e-3, maxRestarts=None, record=None):
+    """
+    Adaptive integration with scipy's solve_ivp, by default with an embedded Runge-Kutta (RK45) scheme, falling back
+    to stiffMethod if it fails. The time integral of speed is carried as extra state so the average speed is exact
+    for the chosen tolerances. Reaching the jam accumulation in a microtype is a terminal event: integration restarts
+    from there with that microtype held at the jam accumulation until its net inflow turns negative.
+
+    As with integrateEuler, the trajectory is only kept (every `record` accepted steps) if record is set.
+    """
+    nMicrotypes = len(n_init)
+    duration = durationInHours * 3600.
+    jamAccumulation = n_0 - n_other
+    if maxRestarts is None:
+        maxRestarts = 10 * nMicrotypes + 10
+
+    def rhs(t, y):
+        n = y[:nMicrotypes]
+        dn = accumulationDerivative(n, demand, L, X, v_0, n_0, n_other)
+        dn = np.where((n >= jamAccumulation) & (dn > 0), 0.0, dn)
+        return np.concatenate([dn, speed(n, v_0, n_0, n_other)])
+
+    def jamEvent(idx):
+        def event(t, y):
+            return jamAccumulation[idx] - y[idx]
+
+        event.terminal = True
+        event.direction = -1
+        return event
+
+    y0 = np.concatenate([np.minimum(n_init, jamAccumulation), np.zeros(nMicrotypes)])
+    ts = [0.0]
+    ns = [y0[:nMicrotypes]]
+    n_max = y0[:nMicrotypes].copy()
+    timeJammed = np.zeros(nMicrotypes)
+    t0 = 0.0
+    steps = 0
+    restarts = 0
+    while (t0 < duration) & (restarts <= maxRestarts):
+        # Microtypes already at the jam accumulation are held there by rhs and need no event
+        free = np.flatnonzero(y0[:nMicrotypes] < jamAccumulation)
+        events = [jamEvent(idx) for idx in free]
+        sol = solve_ivp(rhs, (t0, duration), y0, method=method, rtol=rtol, atol=atol, events=events)
+        if (sol.status == -1) & (stiffMethod is not None):
+            sol = solve_ivp(rhs, (t0, duration), y0, method=stiffMethod, rtol=rtol, atol=atol, events=events)
+        steps += len(sol.t) - 1
+        n = np.minimum(sol.y[:nMicrotypes, :], jamAccumulation[:, None])
+        atJam = n >= jamAccumulation[:, None] * (1. - 1e-9)
+        timeJammed += np.sum((atJam[:, 1:] & atJam[:, :-1]) * np.diff(sol.t), axis=1)
+        np.maximum(n_max, np.max(n, axis=1), out=n_max)
+        if record:
+            ts.extend(sol.t[1:])
+            ns.extend(n[:, 1:].T)
+        if sol.status == -1:
+            logger.warning("|  MFD integration failed: %s", sol.message)
+            break
+        y0 = sol.y[:, -1].copy()
+        y0[:nMicrotypes] = n[:, -1]
+        if sol.status == 1:
+            jammed = [free[idx] for idx, tEvent in enumerate(sol.t_events) if len(tEvent) > 0]
+            y0[jammed] = jamAccumulation[jammed]
+            n_max[jammed] = np.maximum(n_max[jammed], jamAccumulation[jammed])
+            if record:
+                ns[-1] = y0[:nMicrotypes]
+        if sol.t[-1] <= t0:
+            break
+        t0 = sol.t[-1]
+        restarts += 1
+
+    n_final = y0[:nMicrotypes]
+    v_final = speed(n_final, v_0, n_0, n_other)
+    out = {"t": None, "n": None, "v": None, "v_av": y0[nMicrotypes:] / t0 if t0 > 0 else v_final,
+           "n_final": n_final, "v_final": v_final, "n_max": n_max, "time_jammed": timeJammed, "steps": steps}
+    if record:
+        kept = recordedSteps(len(ts), record)
+        out["t"] = np.array(ts)[kept]
+        out["n"] = np.array(ns).T[:, kept]
+        out["v"] = speed(out["n"], v_0[:, None], n_0[:, None], n_other[:, None])
+    return out
+
+
+def steadyStateJacobian(n, L, X, v_0, n_0, n_other):
+    """
+    Outflow of each microtype on the uncongested branch of the MFD, together with the Jacobian of the net
+    accumulation rate (X - I) * diag(d outflow / dn)
+    """
+    outflow = v_0 * n / L * (1. - (n + n_other) / n_0)
+    dOutflow = v_0 / L * (1. - (2. * n + n_other) / n_0)
+    if issparse(X):
+        J = (X - identity(len(n), format="csr")) @ diags(dOutflow)
+    else:
+        J = X * dOutflow[None, :] - np.diag(dOutflow)
+    return outflow, J.tocsc() if issparse(J) else J
+
+
+def solveLinear(A, b):
+    return spsolve(A, b) if issparse(A) else np.linalg.solve(A, b)
+
+
+def propagate(J, t, v):
+    """exp(J t) v, through the dense matrix exponential for dense J and its action alone for sparse J"""
+    return expm_multiply(J * t, v) if issparse(J) else expm(J * t) @ v
+
+
+def propagateOnGrid(J, dt, nSteps, v):
+    """exp(J t) v at t = 0, dt, ..., (nSteps - 1) dt, as columns"""
+    if issparse(J):
+        return expm_multiply(J, v, start=0.0, stop=dt * (nSteps - 1), num=nSteps, endpoint=True).T
+    step = expm(J * dt)
+    out = np.zeros((len(v), nSteps))
+    out[:, 0] = v
+    for i in range(1, nSteps):
+        out[:, i] = step @ out[:, i - 1]
+    return out
+
+
+def solveSteadyState(n_init, demand, L, X, v_0, n_0, n_other, tol=1e-9, maxIter=50):
+    """
+    Newton iteration for the accumulations at which demand + X * outflow(n) = outflow(n), restricted to the stable
+    (uncongested) branch of the MFD. Returns the accumulations, the Jacobian there and the number of iterations, or
+    None for the accumulations if there is no stable steady state.
+    """
+    criticalAccumulation = (n_0 - n_other) / 2.
+    n = np.clip(n_init, 0.0, criticalAccumulation * 0.99)
+    scale = np.max(np.abs(demand)) + 1e-12
+    for it in range(maxIter):
+        outflow, J = steadyStateJacobian(n, L, X, v_0, n_0, n_other)
+        F = demand + X @ outflow - outflow
+        if np.max(np.abs(F)) < tol * scale:
+            return n, J, it
+        try:
+            step = solveLinear(J, -F)
+        except np.linalg.LinAlgError:
+            break
+        if not np.all(np.isfinite(step)):
+            break
+        # Damp the step so the iterate stays on the stable branch
+        with np.errstate(divide="ignore", invalid="ignore"):
+            limits = np.where(step > 0, (criticalAccumulation - n) * 0.99 / step,
+                              np.where(step < 0, -n * 0.99 / step, np.inf))
+        n = n + step * min(1.0, np.min(limits))
+    return None, None, maxIter
+
+
+def integrateSteadyState(n_init, demand, L, X, v_0, n_0, n_other, durationInHours, dt=0.02 * 3600., record=None,
+                         settleFraction=0.5, settleTolerance=1e-3, fallback=integrateEuler, coarseSteps=16):
+    """
+    Steady-state shortcut. The steady-state accumulations are found by Newton iteration, and the approach to them is
+    reconstructed from the system linearized there, n(t) = n_ss + exp(J t) (n_init - n_ss), which can be averaged in
+    closed form. This is only used if the linearized transient has decayed to within settleTolerance of the steady
+    state by settleFraction of the period; otherwise (or if there is no stable steady state) the period is integrated
+    with fallback, which is passed dt only if it takes one.
+
+    The maximum accumulation is taken over coarseSteps points of the transient up to the settling time, unless record
+    is set, in which case it is taken over the recorded trajectory.
+    """
+    duration = durationInHours * 3600.
+    n_ss, J, iterations = solveSteadyState(n_init, demand, L, X, v_0, n_0, n_other)
+    criticalAccumulation = (n_0 - n_other) / 2.
+    fallbackOptions = {"dt": dt} if "dt" in inspect.signature(fallback).parameters else {}
+    if (n_ss is None) or np.any(n_init > criticalAccumulation) or (duration <= 0):
+        return fallback(n_init, demand, L, X, v_0, n_0, n_other, durationInHours, record=record, **fallbackOptions)
+    delta = n_init - n_ss
+    settleTime = settleFraction * duration
+    settled = propagate(J, settleTime, delta)
+    if np.any(np.abs(settled) > settleTolerance * np.maximum(n_ss, 1.0)):
+        return fallback(n_init, demand, L, X, v_0, n_0, n_other, durationInHours, record=record, **fallbackOptions)
+
+    n_final = n_ss + propagate(J, duration, delta)
+    n_av = n_ss + solveLinear(J, n_final - n_ss - delta) / duration
+    if record:
+        ts = np.arange(0, duration, dt * int(record))
+        ns = n_ss[:, None] + propagateOnGrid(J, ts[1] - ts[0] if len(ts) > 1 else 0.0, len(ts), delta)
+    else:
+        ts = None
+        ns = n_ss[:, None] + propagateOnGrid(J, settleTime / (coarseSteps - 1), coarseSteps, delta)
+    out = {"t": None, "n": None, "v": None, "v_av": speed(n_av, v_0, n_0, n_other),
+           "n_final": n_final, "v_final": speed(n_final, v_0, n_0, n_other),
+           "n_max": np.maximum(np.max(ns, axis=1), n_final), "time_jammed": np.zeros_like(n_final),
+           "steps": iterations + 2}
+    if record:
+        out["t"] = ts
+        out["n"] = ns
+        out["v"] = speed(ns, v_0[:, None], n_0[:, None], n_other[:, None])
+    return out
+
+
+INTEGRATORS = {"euler": integrateEuler, "adaptive": integrateAdaptive, "steady": integrateSteadyState}
@@ -1,13 +1,19 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import logging
+
 import numpy as np
 import pandas as pd
 
 from .OD import TransitionMatrix
 from .choiceCharacteristics import ChoiceCharacteristics
+from .log import getLogger, logEvent
+from .mfd import INTEGRATORS
 from .network import Network, NetworkCollection, Costs, TotalOperatorCosts, CollectedNetworkStateData
 
+logger = getLogger(__name__)
+
 
 class CollectedTotalOperatorCosts:
     def __init__(self):
@@ -107,11 +113,31 @@ class Microtype:
     def getModeMeanDistance(self, mode: str):
         return self.networks.demands.getAverageDistance(mode)
 
-    def getThroughTimeCostWait(self, mode: str, distanceInMiles: float) -> ChoiceCharacteristics:
+    def getSpeedMilesPerHour(self, mode: str) -> float:
         speedMilesPerHour = np.max([self.getModeSpeed(mode), 0.01]) * 2.23694
         if np.isnan(speedMilesPerHour):
             speedMilesPerHour = self.getModeSpeed("auto")
-        timeInHours = distanceInMiles / speedMilesPerHour
+        return speedMilesPerHour
+
+    def getStartWait(self, mode: str) -> float:
+        if mode in ['bus', 'rail']:
+            # TODO: Something better than average of start and end
+            return self.networks.modes['bus'].headwayInSec / 3600. / 4.
+        else:
+            return 0.
+
+    def getEndWait(self, mode: str) -> float:
+        if mode == 'bus':
+            return self.networks.modes['bus'].headwayInSec / 3600. / 4.
+        else:
+            return 0.
+
+    def getWalkAccessTime(self, mode: str) -> float:
+        return self.networks.modes[mode].getAccessDistance() * self.networks.modes[
+            'walk'].speedInMetersPerSecond / 3600.0
+
+    def getThroughTimeCostWait(self, mode: str, distanceInMiles: float) -> ChoiceCharacteristics:
+        timeInHours = distanceInMiles / self.getSpeedMilesPerHour(mode)
         cost = distanceInMiles * self.networks.modes[mode].perMile
         wait = 0.
         accessTime = 0.
@@ -119,27 +145,23 @@ class Microtype:
         return ChoiceCharacteristics(timeInHours, cost, wait, accessTime, protectedDistance, distanceInMiles)
 
     def getStartTimeCostWait(self, mode: str) -> ChoiceCharacteristics:
-        time = 0.
-        cost = self.networks.modes[mode].perStart
-        if mode in ['bus', 'rail']:
-            wait = self.networks.modes[
-                       'bus'].headwayInSec / 3600. / 4.  # TODO: Something better than average of start and end
-        else:
-            wait = 0.
-        walkAccessTime = self.networks.modes[mode].getAccessDistance() * self.networks.modes[
-            'walk'].speedInMetersPerSecond / 3600.0
-        return ChoiceCharacteristics(time, cost, wait, walkAccessTime)
+        return ChoiceCharacteristics(0., self.networks.modes[mode].perStart, self.getStartWait(mode),
+                                     self.getWalkAccessTime(mode))
 
     def getEndTimeCostWait(self, mode: str) -> ChoiceCharacteristics:
-        time = 0.
-        cost = self.networks.modes[mode].perEnd
-        if mode == 'bus':
-            wait = self.networks.modes['bus'].headwayInSec / 3600. / 4.
-        else:
-            wait = 0.
-        walkEgressTime = self.networks.modes[mode].getAccessDistance() * self.networks.modes[
-            'walk'].speedInMetersPerSecond / 3600.0
-        return ChoiceCharacteristics(time, cost, wait, walkEgressTime)
+        return ChoiceCharacteristics(0., self.networks.modes[mode].perEnd, self.getEndWait(mode),
+                                     self.getWalkAccessTime(mode))
+
+    def getChoiceInputs(self, mode: str) -> np.ndarray:
+        """
+        Per-microtype inputs of getThroughTimeCostWait, getStartTimeCostWait and getEndTimeCostWait for a mode,
+        ordered as CHOICE_INPUTS: speed in miles per hour, cost per mile, portion of distance dedicated, cost and
+        wait per start, cost and wait per end and walk access time in hours
+        """
+        modeObject = self.networks.modes[mode]
+        return np.array([self.getSpeedMilesPerHour(mode), modeObject.perMile, modeObject.getPortionDedicated(),
+                         modeObject.perStart, self.getStartWait(mode), modeObject.perEnd, self.getEndWait(mode),
+                         self.getWalkAccessTime(mode)], dtype=float)
 
     def getFlows(self):
         return [mode.getPassengerFlow() for mode in self.networks.modes.values()]
@@ -177,6 +199,8 @@ class MicrotypeCollection:
         self.modeData = modeData
         self.transitionMatrix = None
         self.collectedNetworkStateData = CollectedNetworkStateData()
+        self.mfdIntegrator = "euler"
+        self.sparseTransitionMatrix = None
 
     def __setitem__(self, key: str, value: Microtype):
         self.__microtypes[key] = value
@@ -220,10 +244,11 @@ class MicrotypeCollection:
                 networkCollection = NetworkCollection(subNetworkToModes, modeToModeData, microtypeID)
                 self[microtypeID] = Microtype(microtypeID, networkCollection)
                 self.collectedNetworkStateData.addMicrotype(self[microtypeID])
-                print("|  Loaded ", len(subNetworkData.loc[subNetworkData["MicrotypeID"] == microtypeID].index),
-                      " subNetworks in microtype ", microtypeID)
+                logger.info("|  Loaded %s subNetworks in microtype %s",
+                            np.sum(subNetworkData["MicrotypeID"] == microtypeID), microtypeID)
 
-    def transitionMatrixMFD(self, durationInHours, collectedNetworkStateData=None, tripStartRate=None):
+    def transitionMatrixMFD(self, durationInHours, collectedNetworkStateData=None, tripStartRate=None,
+                            integrator=None, record=None):
         if collectedNetworkStateData is None:
             collectedNetworkStateData = self.collectedNetworkStateData
             writeData = True
@@ -233,25 +258,6 @@ class MicrotypeCollection:
         if tripStartRate is None:
             tripStartRate = self.getModeStartRatePerSecond("auto")
 
-        def v(n, v_0, n_0, n_other, minspeed=0.1):
-            n_eff = n + n_other
-            v = v_0 * (1. - n_eff / n_0)
-            v[v < minspeed] = minspeed
-            v[v > v_0] = v_0[v > v_0]
-            return v
-
-        def outflow(n, L, v_0, n_0, n_other):
-            return v(n, v_0, n_0, n_other, 1.0) * n / L
-
-        def inflow(n, X, L, v_0, n_0, n_other):
-            os = X @ (v(n, v_0, n_0, n_other, 1.0) * n / L)
-            return os
-
-        def dn_dt(n, demand, L, X, v_0, n_0, n_other):
-            inflowval = inflow(n, X, L, v_0, n_0, n_other)
-            outflowval = outflow(n, L, v_0, n_0, n_other)
-            return demand + inflow(n, X, L, v_0, n_0, n_other) - outflow(n, L, v_0, n_0, n_other)
-
         # print(tripStartRate)
         characteristicL = np.zeros((len(self)))
         V_0 = np.zeros((len(self)))
@@ -274,36 +280,33 @@ class MicrotypeCollection:
                     n_init[idx] = networkStateData.initialAccumulation
         #            tripStartRate[idx] = microtype.getModeStartRate("auto") / 3600.
 
-        X = np.transpose(self.transitionMatrix.matrix.values)
-
-        dt = 0.02 * 3600.
-        ts = np.arange(0, durationInHours * 3600., dt)
-        ns = np.zeros((len(self), np.size(ts)))
-        vs = np.zeros((len(self), np.size(ts)))
-        n_t = n_init.copy()
+        X = self.transitionMatrix.transitionOperator(self.sparseTransitionMatrix)
 
-        for i, ti in enumerate(ts):
-            dn = dn_dt(n_t, tripStartRate, characteristicL, X, V_0, N_0, n_other) * dt
-            n_t += dn
-            n_t[n_t > (N_0 - n_other)] = N_0[n_t > (N_0 - n_other)]
-            pct = n_t / N_0
-            ns[:, i] = np.squeeze(n_t)
-            vs[:, i] = np.squeeze(v(n_t, V_0, N_0, n_other))
+        if integrator is None:
+            integrator = self.mfdIntegrator
+        out = INTEGRATORS[integrator](n_init, tripStartRate, characteristicL, X, V_0, N_0, n_other, durationInHours,
+                                      record=record)
 
         # self.transitionMatrix.setAverageSpeeds(np.mean(vs, axis=1))
-        averageSpeeds = np.mean(vs, axis=1)
-        print(averageSpeeds)
+        averageSpeeds = out["v_av"]
+        logEvent(logger, logging.DEBUG, "mfdSpeeds", "%s", averageSpeeds, averageSpeeds=averageSpeeds,
+                 steps=out["steps"])
         if writeData:
             for microtypeID, microtype in self:
                 idx = self.transitionMatrix.idx(microtypeID)
                 for modes, autoNetwork in microtype.networks:
                     if "auto" in autoNetwork:
                         networkStateData = collectedNetworkStateData[(microtypeID, modes)]
-                        networkStateData.finalAccumulation = ns[idx, -1]
-                        networkStateData.finalSpeed = vs[idx, -1]
+                        networkStateData.finalAccumulation = out["n_final"][idx]
+                        networkStateData.finalSpeed = out["v_final"][idx]
                         networkStateData.averageSpeed = averageSpeeds[idx]
-        return {"t": np.transpose(ts), "v": np.transpose(vs), "n": np.transpose(ns), "v_av": averageSpeeds,
-                "max_accumulation": N_0}
+        if record:
+            trajectories = {"t": np.transpose(out["t"]), "v": np.transpose(out["v"]), "n": np.transpose(out["n"])}
+        else:
+            trajectories = {"t": None, "v": None, "n": None}
+        return {**trajectories, "v_av": averageSpeeds, "max_accumulation": N_0, "n_final": out["n_final"],
+                "steps": out["steps"],
+                "v_final": out["v_final"], "max_density": out["n_max"] / N_0, "time_jammed": out["time_jammed"]}
 
     def __iter__(self) -> (str, Microtype):
         return iter(self.__microtypes.items())
@@ -328,11 +331,17 @@ class MicrotypeCollection:
         for mID, microtype in self:
             networkStateData.adoptPreviousMicrotypeState(microtype)
 
+    def refreshParams(self):
+        """Re-read network and mode parameters after the scenario tables were modified"""
+        for mID, microtype in self:
+            microtype.networks.refreshParams()
+
     def updateTransitionMatrix(self, transitionMatrix: TransitionMatrix):
         if self.transitionMatrix.names == transitionMatrix.names:
             self.transitionMatrix = transitionMatrix
         else:
-            print("MICROTYPE NAMES IN TRANSITION MATRIX DON'T MATCH")
+            logger.error("Microtype names in transition matrix %s don't match %s", transitionMatrix.names,
+                         self.transitionMatrix.names)
 
     def emptyTransitionMatrix(self):
         return TransitionMatrix(self.transitionMatrix.names)
@@ -2,6 +2,10 @@ from collections import OrderedDict
 
 import pandas as pd
 
+from .log import getLogger
+
+logger = getLogger(__name__)
+
 
 class TimePeriods:
     """
@@ -25,7 +29,7 @@ class TimePeriods:
         for row in df.itertuples():
             self[row.Index] = row.DurationInHours
             self.__ids[row.Index] = row.TimePeriodID
-        print("|  Loaded ", len(df), " time periods")
+        logger.info("|  Loaded %s time periods", len(df))
 
     def __contains__(self, item):
         if item in self.__timePeriods:
@@ -54,4 +58,4 @@ class DistanceBins:
     def importDistanceBins(self, df: pd.DataFrame):
         for row in df.itertuples():
             self[row.DistanceBinID] = row.MeanDistanceInMiles
-        print("|  Loaded ", len(df), " distance bins")
+        logger.info("|  Loaded %s distance bins", len(df))
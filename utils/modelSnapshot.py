@@ -0,0 +1,79 @@
+import gzip
+import os
+import pickle
+import tempfile
+import zlib
+
+SNAPSHOT_VERSION = 1
+
+
+class ModelSnapshot:
+    """
+    Compressed file holding a fully initialized Model, including the mode splits, MSA counters and network state of
+    any time periods it has already solved. Restoring one skips reading the input tables and building the trips,
+    demand and choice structures of every time period.
+
+    The file is a gzip stream of a small header (format version, input directory and a hash of its csv content)
+    followed by the pickled model, so the header can be checked without unpickling the model. Snapshots are not
+    portable across code versions: the model classes are pickled as they are.
+
+    Attributes
+    ----------
+    snapshotPath : str
+        File path to the snapshot, e.g. input-data.model.gz
+    compressLevel : int
+        gzip compression level. The default favors write speed over size
+
+    Methods
+    -------
+    header():
+        Return the header of an existing snapshot
+    save(model, path, scenarioHash):
+        Write a snapshot of model, initialized from the input data at path
+    load(scenarioHash=None):
+        Return the model from the snapshot, checking that its input data had the given hash
+    """
+
+    def __init__(self, snapshotPath: str, compressLevel=1):
+        self.snapshotPath = snapshotPath
+        self.compressLevel = compressLevel
+
+    def header(self) -> dict:
+        try:
+            with gzip.open(self.snapshotPath, "rb") as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            raise
+        except (OSError, EOFError, pickle.UnpicklingError, zlib.error) as e:  # OSError includes gzip.BadGzipFile
+            raise ValueError("Unreadable model snapshot " + str(self.snapshotPath) + ": " + str(e))
+
+    def save(self, model, path: str, scenarioHash: str):
+        header = {"version": SNAPSHOT_VERSION, "path": path, "scenario": scenarioHash}
+        # A unique temporary file, so processes saving the same snapshot do not write into each other's
+        handle, tmpPath = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.snapshotPath)),
+                                           prefix=os.path.basename(self.snapshotPath) + ".", suffix=".tmp")
+        try:
+            with os.fdopen(handle, "wb") as raw, gzip.GzipFile(fileobj=raw, mode="wb",
+                                                             compresslevel=self.compressLevel) as f:
+                pickle.dump(header, f, protocol=pickle.HIGHEST_PROTOCOL)
+                pickle.dump(model, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmpPath, self.snapshotPath)
+        finally:
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+
+    def load(self, scenarioHash=None):
+        try:
+            with gzip.open(self.snapshotPath, "rb") as f:
+                header = pickle.load(f)
+                if header.get("version") != SNAPSHOT_VERSION:
+                    raise ValueError("Model snapshot " + str(self.snapshotPath) + " has format version " + str(
+                        header.get("version")) + ", expected " + str(SNAPSHOT_VERSION))
+                if (scenarioHash is not None) and (header.get("scenario") != scenarioHash):
+                    raise ValueError("Model snapshot " + str(self.snapshotPath) + " was made from different input "
+                                                                                  "data than " + str(header["path"]))
+                return pickle.load(f)
+        except FileNotFoundError:
+            raise
+        except (OSError, EOFError, pickle.UnpicklingError, zlib.error) as e:  # OSError includes gzip.BadGzipFile
+            raise ValueError("Unreadable model snapshot " + str(self.snapshotPath) + ": " + str(e))
@@ -1,17 +1,210 @@
-from math import sqrt, cosh, sinh, cos, sin
 from typing import List, Dict
 
 import numpy as np
 import pandas as pd
-from scipy.optimize import minimize
+from scipy.optimize import brentq
 
+from utils.instrumentation import getInstrumentation
+from utils.log import getLogger
 from utils.supply import TravelDemand, TravelDemands
 
+logger = getLogger(__name__)
+
 np.seterr(all='ignore')
 
 mph2mps = 1609.34 / 3600
 
 
+def nefClosedForm(Q, L, jamDensity, freeFlowSpeed, N_init, t=3 * 3600., L_0=10 * 1609.34):
+    """
+    Closed-form solution of the accumulation on a batch of road networks with a triangular-free MFD, all arguments
+    broadcast against each other. Networks whose inflow Q is below capacity follow the stable (cosh/sinh) solution,
+    the others the unstable (cos/sin) one.
+
+    :param Q: total inflow in meters per second
+    :param L: length available to vehicles in meters
+    :param jamDensity: jam density in vehicles per meter
+    :param freeFlowSpeed: free flow speed in meters per second
+    :param N_init: initial accumulation
+    :param t: time horizon in seconds
+    :param L_0: average trip length in meters
+    :return: N_final, V_init, V_final, V_steadyState and the mean speed, one value per network
+    """
+    Q, L, jamDensity, V_0, N_init = np.broadcast_arrays(*[np.asarray(a, dtype=float) for a in
+                                                         (Q, L, jamDensity, freeFlowSpeed, N_init)])
+    N_0 = jamDensity * L
+    discriminant = N_0 ** 2. / 4. - N_0 * Q / V_0
+    stable = discriminant >= 0
+    A = np.sqrt(np.abs(discriminant))
+    var = A * V_0 * t / (N_0 * L_0)
+    offset = N_0 / 2 - N_init
+    N_final = np.where(stable,
+                       N_0 / 2 - A * (offset * np.cosh(var) + A * np.sinh(var)) / (
+                               offset * np.sinh(var) + A * np.cosh(var)),
+                       N_0 / 2 - A * (offset * np.cos(var) + A * np.sin(var)) / (
+                               offset * np.sin(var) + A * np.cos(var)))
+    V_init = V_0 * (1. - N_init / N_0)
+    V_final = V_0 * (1. - N_final / N_0)
+    V_steadyState = np.where(stable, V_0 * (1. - (N_0 / 2 - A) / N_0), 0.)
+    V_mean = np.maximum(0.1, (V_init + V_final) / 2.0)  # TODO: Actually take the integral
+    return N_final, V_init, V_final, V_steadyState, V_mean
+
+
+def evaluateNEF(networks, flows=None, modeIgnored=None, overrideMatrix=False, writeState=True) -> np.ndarray:
+    """
+    Network speeds for a list of networks in one closed-form evaluation, equivalent to calling Network.NEF on each
+
+    :param networks: list of Network
+    :param flows: optional inflow of modeIgnored on each network in meters per second, replacing its current VMT
+    :param modeIgnored: mode whose VMT is replaced by flows
+    :param overrideMatrix: evaluate the MFD even on networks whose speed comes from the transition matrix model
+    :param writeState: store the resulting accumulation and speeds in each network's state data
+    :return: array of speeds in meters per second
+    """
+    getInstrumentation().count("nef", len(networks))
+    speeds = np.zeros(len(networks))
+    analytic = []
+    for idx, n in enumerate(networks):
+        if n.type != 'Road':
+            speeds[idx] = n.freeFlowSpeed
+        elif 'auto' in n.getModeNames() and not overrideMatrix:
+            speeds[idx] = n.getNetworkStateData().averageSpeed
+        else:
+            Qtot = n.getInflow(None if flows is None else flows[idx], modeIgnored)
+            if Qtot == 0:
+                speeds[idx] = n.freeFlowSpeed
+            else:
+                analytic.append((idx, n, Qtot))
+    if analytic:
+        N_final, V_init, V_final, V_steadyState, V_mean = nefClosedForm(
+            [Qtot for _, _, Qtot in analytic], [n.L - n.getBlockedDistance() for _, n, _ in analytic],
+            [n.jamDensity for _, n, _ in analytic], [n.freeFlowSpeed for _, n, _ in analytic],
+            [n._N_init for _, n, _ in analytic])
+        for j, (idx, n, Qtot) in enumerate(analytic):
+            speeds[idx] = V_mean[j]
+            if writeState:
+                n._Q_curr = Qtot
+                n.getNetworkStateData().N_final = N_final[j]
+                n.getNetworkStateData().V_init = V_init[j]
+                n.getNetworkStateData().V_final = V_final[j]
+                n.getNetworkStateData().V_steadyState = V_steadyState[j]
+                if overrideMatrix:
+                    n.base_speed = V_mean[j]
+    return speeds
+
+
+def equalSpeedAllocation(speedOfFlows, totalFlow: float, nNetworks: int, maxFlows=None, rtol=1e-10,
+                         maxIter=200) -> np.ndarray:
+    """
+    Splits a flow over parallel networks so that they all run at the same speed (user equilibrium), and networks
+    left empty are no faster than that. Each network's speed must be non-increasing in its own flow up to maxFlows.
+    Since a network's speed only depends on its own flow, the speeds are linearized network by network, from secant
+    slopes, and the common speed and flows of the linear system are solved exactly at each step. That usually takes a
+    handful of calls to speedOfFlows. If it doesn't converge, the common speed is found by a bracketed root find on
+    the total flow, with the flow each network carries at a given speed found by bisection.
+
+    :param speedOfFlows: function mapping an array of per-network flows to an array of speeds
+    :param totalFlow: flow to split
+    :param nNetworks: number of networks
+    :param maxFlows: optional flow each network can take before its speed stops being monotonic (e.g. capacity)
+    :return: portion of totalFlow assigned to each network
+    """
+    getInstrumentation().count("speedAllocations")
+    uniform = np.full(nNetworks, 1. / nNetworks)
+    if (totalFlow <= 0) | (nNetworks < 2):
+        return uniform
+    if maxFlows is None:
+        maxFlows = np.full(nNetworks, np.inf)
+    maxFlows = np.maximum(np.asarray(maxFlows, dtype=float), 0.0)
+    if np.sum(maxFlows) < totalFlow:  # Oversaturated, so load every network in proportion to what it can take
+        return maxFlows / np.sum(maxFlows) if np.sum(maxFlows) > 0 else uniform
+    upper = np.minimum(maxFlows * (1. - rtol), totalFlow)  # Speeds at maxFlows itself may be undefined
+    freeSpeeds = speedOfFlows(np.zeros(nNetworks))
+    flows = np.minimum(upper / np.sum(upper) * totalFlow, upper)
+    speeds = speedOfFlows(flows)
+    if np.all(freeSpeeds == speeds):  # Speeds don't respond to flow, so any split is an equilibrium
+        return uniform
+    usable = upper > 0
+    previousFlows, previousSpeeds = np.zeros(nNetworks), freeSpeeds
+    slopes = np.full(nNetworks, np.nan)
+    for it in range(50):
+        step = flows - previousFlows
+        newSlopes = (speeds - previousSpeeds) / np.where(step != 0, step, 1.)
+        slopes = np.where((step != 0) & (newSlopes < 0), newSlopes, slopes)
+        if isEqualSpeed(flows, speeds, freeSpeeds, upper, rtol):
+            return flows / np.sum(flows)
+        if not np.all(np.isfinite(slopes[usable]) & (slopes[usable] < 0)):
+            break
+        # Flows at which the linearized speeds speeds + slopes * (newFlows - flows) are equal, leaving out networks
+        # that would need a negative flow and capping those that would go over their upper flow
+        newFlows, free = np.zeros(nNetworks), usable.copy()
+        for _ in range(nNetworks):
+            inverseSlopes = 1. / slopes[free]
+            commonSpeed = (totalFlow - np.sum(newFlows[~free]) - np.sum(flows[free]) +
+                           np.sum(speeds[free] * inverseSlopes)) / np.sum(inverseSlopes)
+            newFlows[free] = flows[free] + (commonSpeed - speeds[free]) / slopes[free]
+            tooSlow = free & (newFlows < 0)
+            tooFast = free & (newFlows > upper)
+            if not (np.any(tooSlow) or np.any(tooFast)) or (np.sum(free & ~tooSlow & ~tooFast) == 0):
+                break
+            newFlows[tooSlow], free[tooSlow] = 0., False
+            newFlows[tooFast], free[tooFast] = upper[tooFast], False
+        newFlows = np.clip(newFlows, 0., upper)
+        if not np.isclose(np.sum(newFlows), totalFlow, rtol=1e-9):
+            break
+        if np.max(np.abs(newFlows - flows)) <= rtol * totalFlow:
+            return newFlows / np.sum(newFlows)
+        newSpeeds = speedOfFlows(newFlows)
+        for _ in range(30):  # Back off a step that overshoots into flows where the speed isn't defined
+            if np.all(np.isfinite(newSpeeds)):
+                break
+            newFlows = (flows + newFlows) / 2.
+            newSpeeds = speedOfFlows(newFlows)
+        previousFlows, previousSpeeds = flows, speeds
+        flows, speeds = newFlows, newSpeeds
+
+    def flowsAtSpeed(v):
+        low = np.zeros(nNetworks)
+        high = upper.copy()
+        for it in range(maxIter):
+            mid = (low + high) / 2.
+            fastEnough = speedOfFlows(mid) >= v
+            low = np.where(fastEnough, mid, low)
+            high = np.where(fastEnough, high, mid)
+            if np.max(high - low) <= rtol * totalFlow:
+                break
+        return low
+
+    loadedSpeeds = speedOfFlows(upper)
+    vLow = np.min(np.where(np.isfinite(loadedSpeeds), loadedSpeeds, 0.))
+    vHigh = np.nanmax(freeSpeeds)
+    if not vLow < vHigh:
+        return uniform
+    speed = brentq(lambda v: np.sum(flowsAtSpeed(v)) - totalFlow, vLow, vHigh, rtol=rtol)
+    flows = flowsAtSpeed(speed)
+    if np.sum(flows) <= 0:
+        return uniform
+    return flows / np.sum(flows)
+
+
+def isEqualSpeed(flows, speeds, freeSpeeds, upper, rtol=1e-10) -> bool:
+    """Whether networks carrying flow all have the same speed, and none of the others would be faster"""
+    tolerance = rtol * np.max(freeSpeeds)
+    loaded = flows > 0
+    if not np.any(loaded):
+        return False
+    partlyLoaded = loaded & (flows < upper)
+    common = np.max(speeds[partlyLoaded]) if np.any(partlyLoaded) else np.min(speeds[loaded])
+    return (np.ptp(speeds[partlyLoaded]) <= tolerance if np.any(partlyLoaded) else True) and np.all(
+        freeSpeeds[(flows == 0) & (upper > 0)] <= common + tolerance) and np.all(
+        speeds[loaded & ~partlyLoaded] >= common - tolerance)
+
+
+def updateBaseSpeeds(networks, override=False):
+    for n, speed in zip(networks, evaluateNEF(networks, overrideMatrix=override)):
+        n.base_speed = speed
+
+
 class TotalOperatorCosts:
     def __init__(self):
         self.__costs = dict()
@@ -83,6 +276,7 @@ class Mode:
         self._VMT_tot = 0.0
         self._VMT = dict()
         self._speed = dict()
+        self._paramValues = None
         self.__bad = False
         if networks is not None:
             for n in networks:
@@ -99,25 +293,35 @@ class Mode:
     #         inds[column] = [(self.params.index.get_loc(idx), self.params.columns.get_loc(column))]
     #     return inds
 
+    def refreshParams(self):
+        """Snapshot this mode's row of the mode data, so properties don't need a DataFrame lookup"""
+        if self.params is not None:
+            self._paramValues = {column: self.params.at[self._idx, column] for column in self.params.columns}
+
+    def param(self, column: str):
+        if self._paramValues is None:
+            self.refreshParams()
+        return self._paramValues[column]
+
     @property
     def relativeLength(self):
         # return self.params.to_numpy()[self._inds["VehicleSize"]]
-        return self.params.at[self._idx, "VehicleSize"]
+        return self.param("VehicleSize")
 
     @property
     def perStart(self):
         # return self.params.to_numpy()[self._inds["PerStartCost"]]
-        return self.params.at[self._idx, "PerStartCost"]
+        return self.param("PerStartCost")
 
     @property
     def perEnd(self):
         # return self.params.to_numpy()[self._inds["PerEndCost"]]
-        return self.params.at[self._idx, "PerEndCost"]
+        return self.param("PerEndCost")
 
     @property
     def perMile(self):
         # return self.params.to_numpy()[self._inds["PerMileCost"]]
-        return self.params.at[self._idx, "PerMileCost"]
+        return self.param("PerMileCost")
 
     def updateDemand(self, travelDemand=None):
         if travelDemand is None:
@@ -140,10 +344,6 @@ class Mode:
     #     self._N_tot += n
     #     self.allocateVehicles()
 
-    def getSpeedDifference(self, allocation: list):
-        speeds = np.array([n.NEF(a * self._VMT_tot * mph2mps, self.name) for n, a in zip(self.networks, allocation)])
-        return np.linalg.norm(speeds - np.mean(speeds))
-
     def assignVmtToNetworks(self):
         Ltot = sum([n.L for n in self.networks])
         for n in self.networks:
@@ -225,7 +425,7 @@ class WalkMode(Mode):
     @property
     def speedInMetersPerSecond(self):
         # return self.params.to_numpy()[self._inds["PerEndCost"]]
-        return self.params.at[self._idx, "SpeedInMetersPerSecond"]
+        return self.param("SpeedInMetersPerSecond")
 
     def getSpeed(self):
         return self.speedInMetersPerSecond
@@ -251,7 +451,7 @@ class BikeMode(Mode):
     @property
     def speedInMetersPerSecond(self):
         # return self.params.to_numpy()[self._inds["PerEndCost"]]
-        return self.params.at[self._idx, "SpeedInMetersPerSecond"]
+        return self.param("SpeedInMetersPerSecond")
 
     def getSpeed(self):
         return self.speedInMetersPerSecond
@@ -295,32 +495,32 @@ class RailMode(Mode):
 
     @property
     def routeAveragedSpeed(self):
-        return self.params.at[self._idx, "SpeedInMetersPerSecond"]
+        return self.param("SpeedInMetersPerSecond")
 
     @property
     def vehicleOperatingCostPerHour(self):
         # return self.params.to_numpy()[self._inds["VehicleOperatingCostsPerHour"]]
-        return self.params.at[self._idx, "VehicleOperatingCostsPerHour"]
+        return self.param("VehicleOperatingCostsPerHour")
 
     @property
     def fare(self):
         # return self.params.to_numpy()[self._inds["PerStartCost"]]
-        return self.params.at[self._idx, "PerStartCost"]
+        return self.param("PerStartCost")
 
     @property
     def headwayInSec(self):
         # return self.params.to_numpy()[self._inds["Headway"]]
-        return self.params.at[self._idx, "Headway"]
+        return self.param("Headway")
 
     @property
     def stopSpacingInMeters(self):
         # return self.params.to_numpy()[self._inds["StopSpacing"]]
-        return self.params.at[self._idx, "StopSpacing"]
+        return self.param("StopSpacing")
 
     @property
     def portionAreaCovered(self):
         # return self.params.to_numpy()[self._inds["CoveragePortion"]]
-        return self.params.at[self._idx, "CoveragePortion"]
+        return self.param("CoveragePortion")
 
     def updateDemand(self, travelDemand=None):
         if travelDemand is not None:
@@ -375,20 +575,11 @@ class AutoMode(Mode):
 
     @property
     def relativeLength(self):
-        return self.params.at[self._idx, "VehicleSize"]
+        return self.param("VehicleSize")
 
     def getSpeed(self):
         return self.networks[0].getNetworkStateData().averageSpeed
 
-    def x0(self):
-        return np.array([1. / len(self.networks)] * len(self.networks))
-
-    def constraints(self):
-        return dict(type='eq', fun=lambda x: sum(x) - 1.0, jac=lambda x: [1.0] * len(x))
-
-    def bounds(self):
-        return [(0.0, 1.0)] * len(self.networks)
-
     def updateDemand(self, travelDemand=None):  # TODO: Why did I add this?
         if travelDemand is None:
             travelDemand = self.travelDemand
@@ -413,15 +604,19 @@ class AutoMode(Mode):
                 self._N_eff[n] = n.getNetworkStateData().finalAccumulation * self.relativeLength  # TODO: take avg
                 n.setN(self.name, self._N_eff[n])
         elif len(self.networks) > 1:
-            res = minimize(self.getSpeedDifference, self.x0(), constraints=self.constraints(), bounds=self.bounds())
-            for n, a in zip(self.networks, res.x):
+            # With speeds from the transition matrix model, which don't depend on the split, this stays even
+            allocation = equalSpeedAllocation(
+                lambda flows: evaluateNEF(self.networks, flows * mph2mps, self.name, self.override, writeState=False),
+                self._VMT_tot, len(self.networks),
+                np.array([n.getStableInflow(self.name, self.override) for n in self.networks]) / mph2mps)
+            for n, a in zip(self.networks, allocation):
                 self._VMT[n] = a * self._VMT_tot
-                self._speed[n] = n.NEF(a * self._VMT_tot * mph2mps, self.name)
+                self._speed[n] = n.NEF(a * self._VMT_tot * mph2mps, self.name, self.override)
                 n.setVMT(self.name, self._VMT[n])
                 self._N_eff[n] = self._VMT[n] / self._speed[n]
                 n.setN(self.name, self._N_eff[n])
         else:
-            print("OH NO!")
+            logger.error("No networks to assign %s VMT to", self.name)
 
     # def allocateVehicles(self):
     #     """for constant car speed"""
@@ -481,31 +676,31 @@ class BusMode(Mode):
 
     @property
     def headwayInSec(self):
-        return self.params.at[self._idx, "Headway"]
+        return self.param("Headway")
 
     @property
     def passengerWaitInSec(self):
-        return self.params.at[self._idx, "PassengerWait"]
+        return self.param("PassengerWait")
 
     @property
     def passengerWaitInSecDedicated(self):
-        return self.params.at[self._idx, "PassengerWaitDedicated"]
+        return self.param("PassengerWaitDedicated")
 
     @property
     def stopSpacingInMeters(self):
-        return self.params.at[self._idx, "StopSpacing"]
+        return self.param("StopSpacing")
 
     @property
     def minStopTimeInSec(self):
-        return self.params.at[self._idx, "MinStopTime"]
+        return self.param("MinStopTime")
 
     @property
     def fare(self):
-        return self.params.at[self._idx, "PerStartCost"]
+        return self.param("PerStartCost")
 
     @property
     def vehicleOperatingCostPerHour(self):
-        return self.params.at[self._idx, "VehicleOperatingCostPerHour"]
+        return self.param("VehicleOperatingCostPerHour")
 
     @property
     def routeDistanceToNetworkDistance(self) -> float:
@@ -513,7 +708,7 @@ class BusMode(Mode):
         Changed January 2021: Removed need for car-only subnnetworks.
         Now buses only run on a fixed portion of the bus/car subnetwork
         """
-        return self.params.at[self._idx, "CoveragePortion"]
+        return self.param("CoveragePortion")
 
     def updateDemand(self, travelDemand=None):
         if travelDemand is not None:
@@ -645,7 +840,7 @@ class BusMode(Mode):
                 n.setN(self.name, self._N_eff[n])
                 n.getNetworkStateData().nonAutoAccumulation += self._N_eff[n]
             else:
-                print("BAD WHY IS THIS SPEED NEGATIVE")
+                logger.warning("Negative %s speed %s", self.name, speeds[ind])
         self.updateCommercialSpeed()
 
     def updateCommercialSpeed(self):
@@ -676,6 +871,8 @@ class Network:
         self.data = data
         self.microtypeID = microtypeID
         self._idx = idx
+        self.__params = dict()
+        self.refreshParams()
         self.L_blocked = dict()
         self._modes = dict()
         self.base_speed = self.freeFlowSpeed
@@ -698,25 +895,30 @@ class Network:
         else:
             self.__diameter = diameter
 
+    def refreshParams(self):
+        """Snapshot this network's row of the subnetwork data, so properties don't need a DataFrame lookup"""
+        self.__params = {column: self.data.at[self._idx, column] for column in
+                         ("Type", "avgLinkLength", "vMax", "densityMax", "Length")}
+
     @property
     def type(self):
-        return self.data.at[self._idx, "Type"]
+        return self.__params["Type"]
 
     @property
     def avgLinkLength(self):
-        return self.data.at[self._idx, "avgLinkLength"]
+        return self.__params["avgLinkLength"]
 
     @property
     def freeFlowSpeed(self):
-        return self.data.at[self._idx, "vMax"]
+        return self.__params["vMax"]
 
     @property
     def jamDensity(self):
-        return self.data.at[self._idx, "densityMax"]
+        return self.__params["densityMax"]
 
     @property
     def L(self):
-        return self.data.at[self._idx, "Length"]
+        return self.__params["Length"]
 
     @property
     def diameter(self):
@@ -754,8 +956,7 @@ class Network:
         self._N_eff[mode] = N
 
     def updateBaseSpeed(self, override=False):
-        out = self.NEF(overrideMatrix=override)
-        self.base_speed = self.NEF(overrideMatrix=override)
+        updateBaseSpeeds([self], override)
 
     def getSpeedFromMFD(self, N):
         L_tot = self.L - self.getBlockedDistance()
@@ -768,53 +969,28 @@ class Network:
         else:
             return self.freeFlowSpeed
 
+    def getInflow(self, Q=None, modeIgnored=None) -> float:
+        """Total inflow in meters per second, with the VMT of modeIgnored replaced by Q if given"""
+        if Q is None:
+            return sum([VMT for VMT in self._VMT.values()]) * mph2mps
+        Qtot = Q
+        for mode, Qmode in self._VMT.items():
+            if mode != modeIgnored:
+                Qtot += Qmode * mph2mps
+        return Qtot
+
+    def getStableInflow(self, modeIgnored=None, overrideMatrix=False) -> float:
+        """
+        Largest inflow of modeIgnored in meters per second for which NEF stays on its stable branch, infinite if the
+        speed doesn't come from the closed-form MFD
+        """
+        if (self.type != 'Road') or ('auto' in self.getModeNames() and not overrideMatrix):
+            return np.inf
+        N_0 = self.jamDensity * (self.L - self.getBlockedDistance())
+        return N_0 * self.freeFlowSpeed / 4. - self.getInflow(0.0, modeIgnored)
+
     def NEF(self, Q=None, modeIgnored=None, overrideMatrix=False) -> float:
-        if self.type == 'Road':
-            if 'auto' in self.getModeNames() and not overrideMatrix:
-                return self._networkStateData.averageSpeed
-            else:
-                if Q is None:
-                    Qtot = sum([VMT for VMT in self._VMT.values()]) * mph2mps
-                else:
-                    Qtot = Q
-                    for mode, Qmode in self._VMT.items():
-                        if mode != modeIgnored:
-                            Qtot += Qmode * mph2mps
-                if Qtot == 0:
-                    return self.freeFlowSpeed
-                self._Q_curr = Qtot
-                L_tot = self.L - self.getBlockedDistance()
-                L_0 = 10 * 1609.34  # TODO: Get average distance, don't hardcode
-                t = 3 * 3600.  # TODO: Add timestep duration in seconds
-                N_0 = self.jamDensity * L_tot
-                V_0 = self.freeFlowSpeed
-                N_init = self._N_init
-                if N_0 ** 2. / 4. >= N_0 * Qtot / V_0:
-                    # Stable state
-                    A = sqrt(N_0 ** 2. / 4. - N_0 * Qtot / V_0)
-                    var = A * V_0 * t / (N_0 * L_0)
-                    N_final = N_0 / 2 - A * ((N_0 / 2 - N_init) * cosh(var) + A * sinh(var)) / (
-                            (N_0 / 2 - N_init) * sinh(var) + A * cosh(var))
-                    V_init = self.getSpeedFromMFD(N_init)
-                    V_final = self.getSpeedFromMFD(N_final)
-                    V_steadyState = self.getSpeedFromMFD(N_0 / 2 - A)
-                else:
-                    Aprime = sqrt(N_0 * Qtot / V_0 - N_0 ** 2. / 4.)
-                    var = Aprime * V_0 * t / (N_0 * L_0)
-                    N_final = N_0 / 2 - Aprime * ((N_0 / 2 - N_init) * cos(var) + Aprime * sin(var)) / (
-                            (N_0 / 2 - N_init) * sin(var) + Aprime * cos(var))
-                    V_init = self.getSpeedFromMFD(N_init)
-                    V_final = self.getSpeedFromMFD(N_final)
-                    V_steadyState = 0
-                self._networkStateData.N_final = N_final
-                self._networkStateData.V_init = V_init
-                self._networkStateData.V_final = V_final
-                self._networkStateData.V_steadyState = V_steadyState
-                if overrideMatrix:
-                    self.base_speed = max([0.1, (V_init + V_final) / 2.0])
-                return max([0.1, (V_init + V_final) / 2.0])  # TODO: Actually take the integral
-        else:
-            return self.freeFlowSpeed
+        return evaluateNEF([self], None if Q is None else [Q], modeIgnored, overrideMatrix)[0]
 
     def getBaseSpeed(self):
         if self.base_speed > 0.01:
@@ -891,7 +1067,7 @@ class NetworkCollection:
                         self.modeToNetwork[modeName] = [network]
 
         else:
-            print('Bad NetworkCollection Input')
+            logger.error("Cannot build a NetworkCollection from %s", type(networksAndModes))
         for (modeName, networks) in self.modeToNetwork.items():
             assert (isinstance(modeName, str))
             assert (isinstance(networks, List))
@@ -907,7 +1083,7 @@ class NetworkCollection:
             elif modeName == "rail":
                 RailMode(networks, params, microtypeID)
             else:
-                print("BAD!")
+                logger.error("Unknown mode %s", modeName)
                 Mode(networks, params, microtypeID, "bad")
 
     def isJammed(self):
@@ -937,8 +1113,7 @@ class NetworkCollection:
                 n.getNetworkStateData().resetNonAutoAccumulation()
             for m in self.modes.values():  # uniqueModes:
                 m.assignVmtToNetworks()
-                for n in m.networks:
-                    n.updateBaseSpeed()
+                updateBaseSpeeds(m.networks)
                 m.updateModeBlockedDistance()
                 # m.updateCommercialSpeed()
                 # self.getModeSpeeds()
@@ -946,7 +1121,7 @@ class NetworkCollection:
             # self.updateNetworks()
             # self.updateMFD()
             if self.verbose:
-                print(str(self))
+                logger.debug("%s", self)
             # if np.any([n.isJammed for n in self._networks]):
             #     break
             newSpeeds = self.getModeSpeeds()
@@ -977,6 +1152,12 @@ class NetworkCollection:
     def getModeSpeeds(self) -> np.array:
         return np.array([m.getSpeed() for m in self.modes.values()])
 
+    def refreshParams(self):
+        for n in self._networks.values():
+            n.refreshParams()
+            for m in n.getModeValues():
+                m.refreshParams()
+
     def getModeOperatingCosts(self):
         out = TotalOperatorCosts()
         for name, mode in self.modes.items():
@@ -4,7 +4,47 @@ import numpy as np
 import pandas as pd
 
 from utils.OD import DemandIndex
-from utils.choiceCharacteristics import ModalChoiceCharacteristics
+from utils.choiceCharacteristics import ModalChoiceCharacteristics, CHARACTERISTIC_FIELDS
+from utils.log import getLogger
+
+logger = getLogger(__name__)
+
+CHOICE_PARAMS = ("Intercept", "BetaTravelTime", "BetaWaitTime", "BetaWaitTimeSquared", "BetaAccessTime", "VOM",
+                 "ProtectedPreference")
+PROTECTED_MODES = ("bike",)
+
+
+def logitProbabilities(characteristics: np.ndarray, params: np.ndarray, classIdx=None, available=None,
+                       k=1.0) -> np.ndarray:
+    """
+    Multinomial logit mode choice probabilities for a batch of keys
+
+    :param characteristics: (nKeys x nModes x nAttributes) array, attributes ordered as CHOICE_ATTRIBUTES
+    :param params: (nClasses x nModes x nParams) array, parameters ordered as CHOICE_PARAMS
+    :param classIdx: demand class of each key, an index into the first axis of params (default: key i uses class i)
+    :param available: (nKeys x nModes) boolean mask of the modes each key can choose
+    :param k: scale of the utilities
+    :return: (nKeys x nModes) array of probabilities, zero for unavailable modes
+    """
+    if classIdx is not None:
+        params = params[classIdx]
+    travelTime = characteristics[:, :, 0] * 60.0
+    waitTime = characteristics[:, :, 1] * 60.0
+    accessTime = characteristics[:, :, 2] * 60.0
+    cost = characteristics[:, :, 3]
+    protectedShare = characteristics[:, :, 4]
+    utils = params[:, :, 0] + travelTime * params[:, :, 1] + waitTime * params[:, :, 2] + \
+        waitTime ** 2.0 * params[:, :, 3] + accessTime * params[:, :, 4] + cost * params[:, :, 5] - \
+        travelTime * params[:, :, 1] * params[:, :, 6] * protectedShare
+    utils *= k
+    if available is None:
+        available = np.ones(utils.shape, dtype=bool)
+    utils = np.where(available, utils, -np.inf)
+    maxUtils = np.max(utils, axis=1, keepdims=True)
+    maxUtils[~np.isfinite(maxUtils)] = 0.0
+    expUtils = np.exp(utils - maxUtils)
+    totals = np.sum(expUtils, axis=1, keepdims=True)
+    return np.divide(expUtils, totals, out=np.zeros_like(expUtils), where=totals > 0)
 
 
 class PopulationGroup:
@@ -14,44 +54,148 @@ class PopulationGroup:
         self.population = population
 
 
+class DemandClassParameters:
+    """
+    Dense array of the choice parameters of every demand class, indexed by (population group, trip purpose, mode,
+    parameter). Parameters do not depend on the home microtype, so all demand classes sharing a group and purpose
+    reference the same slice.
+
+    Attributes
+    ----------
+    groups : list
+        Population group type IDs along the first axis
+    purposes : list
+        Trip purpose IDs along the second axis
+    modes : list
+        Modes along the third axis
+    params : list
+        Parameter names along the last axis
+    values : np.ndarray
+        (nGroups x nPurposes x nModes x nParams) parameter values, zero where not provided
+
+    Methods
+    -------
+    importParameters(populationGroups):
+        Fill the array from a table with one row per (group, purpose, mode)
+    index(groupId, tripPurpose):
+        Return the integer (group, purpose) reference of a demand class
+    choiceArray(modes):
+        Return the (nGroups * nPurposes x nModes x nChoiceParams) array used by logitProbabilities
+    """
+
+    def __init__(self):
+        self.groups = []
+        self.purposes = []
+        self.modes = []
+        self.params = []
+        self.values = np.zeros((0, 0, 0, 0))
+        self.__groupToIdx = dict()
+        self.__purposeToIdx = dict()
+        self.__modeToIdx = dict()
+        self.__paramToIdx = dict()
+        self.__choiceArrays = dict()
+
+    @classmethod
+    def fromModeTable(cls, params: pd.DataFrame):
+        """Parameters of a single demand class given as a Mode-indexed table"""
+        df = params.reset_index().rename(columns={params.index.name or "index": "Mode"})
+        df["PopulationGroupTypeID"] = ""
+        df["TripPurposeID"] = ""
+        out = cls()
+        out.importParameters(df)
+        return out
+
+    def importParameters(self, populationGroups: pd.DataFrame):
+        df = populationGroups.set_index(["PopulationGroupTypeID", "TripPurposeID", "Mode"]).select_dtypes("number")
+        groupCodes, self.groups = pd.factorize(df.index.get_level_values(0), sort=True)
+        purposeCodes, self.purposes = pd.factorize(df.index.get_level_values(1), sort=True)
+        modeCodes, self.modes = pd.factorize(df.index.get_level_values(2), sort=True)
+        self.groups, self.purposes, self.modes = list(self.groups), list(self.purposes), list(self.modes)
+        self.params = list(df.columns)
+        self.__groupToIdx = {groupId: idx for idx, groupId in enumerate(self.groups)}
+        self.__purposeToIdx = {tripPurpose: idx for idx, tripPurpose in enumerate(self.purposes)}
+        self.__modeToIdx = {mode: idx for idx, mode in enumerate(self.modes)}
+        self.__paramToIdx = {param: idx for idx, param in enumerate(self.params)}
+        self.values = np.zeros((len(self.groups), len(self.purposes), len(self.modes), len(self.params)))
+        self.values[groupCodes, purposeCodes, modeCodes, :] = df.to_numpy(dtype=float)
+        self.__choiceArrays = dict()
+
+    def index(self, groupId, tripPurpose) -> (int, int):
+        return self.__groupToIdx[groupId], self.__purposeToIdx[tripPurpose]
+
+    def classIndex(self, groupIdx: int, purposeIdx: int) -> int:
+        """Position of a (group, purpose) pair along the first axis of choiceArray"""
+        return groupIdx * len(self.purposes) + purposeIdx
+
+    def value(self, groupIdx: int, purposeIdx: int, mode: str, param: str) -> float:
+        if (mode in self.__modeToIdx) & (param in self.__paramToIdx):
+            return self.values[groupIdx, purposeIdx, self.__modeToIdx[mode], self.__paramToIdx[param]]
+        else:
+            return 0.0
+
+    def choiceArray(self, modes) -> np.ndarray:
+        """
+        (nGroups * nPurposes x nModes x nParams) array of choice parameters, ordered as CHOICE_PARAMS. The protected
+        lane preference only applies to PROTECTED_MODES.
+        """
+        modes = tuple(modes)
+        if modes not in self.__choiceArrays:
+            out = np.zeros((len(self.groups), len(self.purposes), len(modes), len(CHOICE_PARAMS)))
+            for modeIdx, mode in enumerate(modes):
+                if mode not in self.__modeToIdx:
+                    continue
+                for paramIdx, param in enumerate(CHOICE_PARAMS):
+                    if (param in self.__paramToIdx) & ((param != "ProtectedPreference") | (mode in PROTECTED_MODES)):
+                        out[:, :, modeIdx, paramIdx] = self.values[:, :, self.__modeToIdx[mode],
+                                                                   self.__paramToIdx[param]]
+            out = out.reshape((len(self.groups) * len(self.purposes), len(modes), len(CHOICE_PARAMS)))
+            out.flags.writeable = False
+            self.__choiceArrays[modes] = out
+        return self.__choiceArrays[modes]
+
+
 class DemandClass:
-    def __init__(self, params: pd.DataFrame):
-        self.__params = params.to_dict(orient="index")
+    """
+    Choice parameters of one (home microtype, population group, trip purpose) demand class. Holds only a reference
+    into a shared DemandClassParameters array; a Mode-indexed parameter table can be passed instead.
+    """
+
+    def __init__(self, params: pd.DataFrame = None, parameters: DemandClassParameters = None, groupIdx=0,
+                 purposeIdx=0):
+        if parameters is None:
+            parameters = DemandClassParameters.fromModeTable(params)
+        self.__parameters = parameters
+        self.groupIdx = groupIdx
+        self.purposeIdx = purposeIdx
 
     def __getitem__(self, item) -> float:
         item1, item2 = item
-        if item1 in self.__params:
-            return self.__params[item1].setdefault(item2, 0.0)
-        else:
-            return 0.0
+        return self.__parameters.value(self.groupIdx, self.purposeIdx, item1, item2)
+
+    @property
+    def classIndex(self) -> int:
+        return self.__parameters.classIndex(self.groupIdx, self.purposeIdx)
+
+    def paramArray(self, modes) -> np.ndarray:
+        """(nModes x nParams) array of choice parameters, ordered as CHOICE_PARAMS"""
+        return self.__parameters.choiceArray(modes)[self.classIndex]
 
     def updateModeSplit(self, mcc: ModalChoiceCharacteristics) -> Dict[str, float]:
-        k = 1.0
         modes = mcc.modes()
-        utils = np.zeros(len(modes), dtype=float)
-        for idx, mode in enumerate(modes):
-            util = 0.
-            util += self[mode, "Intercept"]
-            util += (mcc[mode].travel_time * 60.0) * self[mode, "BetaTravelTime"]
-            util += (mcc[mode].wait_time * 60.0) * self[mode, "BetaWaitTime"]
-            util += (mcc[mode].wait_time * 60.0) ** 2.0 * self[mode, "BetaWaitTimeSquared"]
-            util += (mcc[mode].access_time * 60.0) * self[mode, "BetaAccessTime"]
-            util += mcc[mode].cost * self[mode, "VOM"]
-            if mode == "bike":
-                util -= (mcc[mode].travel_time * 60.0) * self[mode, "BetaTravelTime"] * self[
-                    mode, "ProtectedPreference"] * (mcc[mode].protected_distance / mcc.distanceInMiles)
-            utils[idx] = util
-            # utils = np.append(utils, util)
-        exp_utils = np.exp(utils * k)
-        probabilities = exp_utils / np.sum(exp_utils)
-        mode_split = dict()
-        for ind in range(np.size(probabilities)):
-            mode_split[modes[ind]] = probabilities[ind]
-        return mode_split
+        probabilities = logitProbabilities(mcc.toArray(modes)[None, :, :], self.paramArray(modes)[None, :, :])
+        return dict(zip(modes, probabilities[0, :]))
 
     def getModeCostPerTrip(self, mcc: ModalChoiceCharacteristics, mode, params=None):
         if mode not in mcc:
             return np.nan, np.nan, np.nan, np.nan
+        cc = mcc[mode]
+        return self.getModeCostPerTripFromFields(mode, [getattr(cc, field) for field in CHARACTERISTIC_FIELDS],
+                                                 params)
+
+    def getModeCostPerTripFromFields(self, mode, fields, params=None):
+        """Cost, in- and out-of-vehicle time and distance per trip from choice characteristics ordered as
+        CHARACTERISTIC_FIELDS"""
+        travel_time, cost, wait_time, access_time, protected_distance, distance = fields
         if params is not None:
             params = DemandClass(params)
         else:
@@ -59,16 +203,14 @@ class DemandClass:
         costPerTrip = 0.0
         inVehicleTime = 0.0
         outVehicleTime = 0.0
-        distance = 0.0
         costPerTrip += params[mode, "Intercept"]
-        costPerTrip += (mcc[mode].travel_time * 60.0) * params[mode, "BetaTravelTime"]
-        costPerTrip += (mcc[mode].wait_time * 60.0) * params[mode, "BetaWaitTime"]
-        costPerTrip += (mcc[mode].wait_time * 60.0) ** 2.0 * params[mode, "BetaWaitTimeSquared"]
-        costPerTrip += (mcc[mode].access_time * 60.0) * self[mode, "BetaAccessTime"]
-        costPerTrip += mcc[mode].cost * params[mode, "VOM"]
-        inVehicleTime += mcc[mode].travel_time * 60.0
-        outVehicleTime += mcc[mode].wait_time * 60.0 + mcc[mode].access_time * 60.0
-        distance += mcc[mode].distance
+        costPerTrip += (travel_time * 60.0) * params[mode, "BetaTravelTime"]
+        costPerTrip += (wait_time * 60.0) * params[mode, "BetaWaitTime"]
+        costPerTrip += (wait_time * 60.0) ** 2.0 * params[mode, "BetaWaitTimeSquared"]
+        costPerTrip += (access_time * 60.0) * self[mode, "BetaAccessTime"]
+        costPerTrip += cost * params[mode, "VOM"]
+        inVehicleTime += travel_time * 60.0
+        outVehicleTime += wait_time * 60.0 + access_time * 60.0
         return costPerTrip, inVehicleTime, outVehicleTime, distance
 
     def getCostPerCapita(self, mcc: ModalChoiceCharacteristics, modeSplit, modes=None, params=None) -> (float, float):
@@ -99,6 +241,7 @@ class Population:
         self.__populationGroups = dict()
         self.__demandClasses = dict()
         self.__totalCosts = dict()
+        self.parameters = DemandClassParameters()
         self.totalPopulation = 0
 
     def __setitem__(self, key: DemandIndex, value: DemandClass):
@@ -111,7 +254,7 @@ class Population:
         if (homeMicrotypeID, populationGroupType) in self.__populationGroups:
             return self.__populationGroups[homeMicrotypeID, populationGroupType].population
         else:
-            print("OH NO, no population group ", populationGroupType, " in microtype ", homeMicrotypeID)
+            logger.warning("No population group %s in microtype %s", populationGroupType, homeMicrotypeID)
             return 0
 
     def importPopulation(self, populations: pd.DataFrame, populationGroups: pd.DataFrame):
@@ -122,12 +265,25 @@ class Population:
                                                                                             populationGroupType,
                                                                                             row.Population)
             self.totalPopulation += row.Population
+        self.parameters.importParameters(populationGroups)
+        demandClasses = populationGroups.groupby(['PopulationGroupTypeID', 'TripPurposeID']).size().index
         for homeMicrotypeID in populations["MicrotypeID"].unique():
-            for (groupId, tripPurpose), group in populationGroups.groupby(['PopulationGroupTypeID', 'TripPurposeID']):
+            for groupId, tripPurpose in demandClasses:
                 demandIndex = DemandIndex(homeMicrotypeID, groupId, tripPurpose)
-                out = DemandClass(group.set_index("Mode").drop(columns=['PopulationGroupTypeID', 'TripPurposeID']))
-                self[demandIndex] = out
-        print("|  Loaded ", len(populations), " population groups")
+                groupIdx, purposeIdx = self.parameters.index(groupId, tripPurpose)
+                self[demandIndex] = DemandClass(parameters=self.parameters, groupIdx=groupIdx, purposeIdx=purposeIdx)
+        logger.info("|  Loaded %s population groups", len(populations))
 
     def __iter__(self):
         return iter(self.__demandClasses.items())
+
+    def paramTensor(self, demandIndices, modes) -> np.ndarray:
+        """(nClasses x nModes x nParams) array of choice parameters for the given demand classes"""
+        return self.choiceParams(modes)[[self.classIndex(demandIndex) for demandIndex in demandIndices]]
+
+    def choiceParams(self, modes) -> np.ndarray:
+        """Shared (nGroups * nPurposes x nModes x nParams) choice parameter array, indexed by classIndex"""
+        return self.parameters.choiceArray(modes)
+
+    def classIndex(self, demandIndex: DemandIndex) -> int:
+        return self[demandIndex].classIndex
@@ -0,0 +1,118 @@
+import hashlib
+import os
+import pickle
+import tempfile
+
+from .log import getLogger
+
+logger = getLogger(__name__)
+
+CACHE_VERSION = 1
+
+
+class ScenarioCache:
+    """
+    Binary snapshot of the parsed input tables of a scenario, stored next to the input directory.
+
+    The cache file holds a small header (format version and a fingerprint of every input csv) followed by the
+    pickled data dict, so validity can be checked without unpickling the tables. A file whose size or mtime changed
+    is re-hashed, and the snapshot is only discarded if its content actually differs; otherwise it is rewritten with
+    the new sizes and mtimes so the file is not re-hashed again on every load.
+
+    Attributes
+    ----------
+    path : str
+        File path to input data
+    cachePath : str
+        File path to the snapshot, e.g. input-data-cache.pkl for input-data/
+
+    Methods
+    -------
+    load():
+        Return the cached data dict, or None if the snapshot is missing or stale
+    save(data):
+        Write a new snapshot of data
+    fingerprint():
+        Return size, mtime and content hash for every input csv
+    scenarioHash():
+        Return a single hash of the content of every input csv, independent of file times
+    """
+
+    def __init__(self, path: str, cachePath=None):
+        self.path = os.path.normpath(path)
+        if cachePath is None:
+            cachePath = self.path + "-cache.pkl"
+        self.cachePath = cachePath
+
+    def inputFiles(self) -> list:
+        files = []
+        for root, _, fileNames in os.walk(self.path):
+            for fileName in fileNames:
+                if fileName.endswith(".csv"):
+                    files.append(os.path.relpath(os.path.join(root, fileName), self.path))
+        return sorted(files)
+
+    def fileSignature(self, relativePath: str) -> (int, int):
+        stat = os.stat(os.path.join(self.path, relativePath))
+        return stat.st_size, stat.st_mtime_ns
+
+    def fileHash(self, relativePath: str) -> str:
+        with open(os.path.join(self.path, relativePath), "rb") as f:
+            return hashlib.sha1(f.read()).hexdigest()
+
+    def fingerprint(self) -> dict:
+        return {f: self.fileSignature(f) + (self.fileHash(f),) for f in self.inputFiles()}
+
+    def scenarioHash(self) -> str:
+        contentHash = hashlib.sha1()
+        for f in self.inputFiles():
+            contentHash.update(f.encode())
+            contentHash.update(self.fileHash(f).encode())
+        return contentHash.hexdigest()
+
+    def signatureChanged(self, header: dict) -> bool:
+        return any(self.fileSignature(f) != (size, mtime) for f, (size, mtime, _) in header["files"].items())
+
+    def isValid(self, header: dict) -> bool:
+        if header.get("version") != CACHE_VERSION:
+            return False
+        cachedFiles = header.get("files", dict())
+        if sorted(cachedFiles.keys()) != self.inputFiles():
+            return False
+        for f, (size, mtime, contentHash) in cachedFiles.items():
+            if self.fileSignature(f) != (size, mtime):
+                if self.fileHash(f) != contentHash:
+                    return False
+        return True
+
+    def load(self):
+        if not os.path.isfile(self.cachePath):
+            return None
+        try:
+            with open(self.cachePath, "rb") as f:
+                header = pickle.load(f)
+                if not self.isValid(header):
+                    return None
+                data = pickle.load(f)
+        except Exception as e:  # e.g. truncated, or pickled by another Python or pandas version
+            logger.warning("|  Ignoring unreadable scenario cache %s: %s", self.cachePath, e)
+            return None
+        if self.signatureChanged(header):
+            self.save(data)
+        return data
+
+    def save(self, data: dict):
+        header = {"version": CACHE_VERSION, "files": self.fingerprint()}
+        tmpPath = None
+        try:
+            # A unique temporary file, since several processes may write the cache of the same scenario at once
+            handle, tmpPath = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.cachePath)),
+                                               prefix=os.path.basename(self.cachePath) + ".", suffix=".tmp")
+            with os.fdopen(handle, "wb") as f:
+                pickle.dump(header, f, protocol=pickle.HIGHEST_PROTOCOL)
+                pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmpPath, self.cachePath)
+        except OSError as e:
+            logger.warning("|  Could not write scenario cache %s: %s", self.cachePath, e)
+            if (tmpPath is not None) and os.path.exists(tmpPath):
+                os.remove(tmpPath)
@@ -1,4 +1,7 @@
 # -*- coding: utf-8 -*-
+from .log import getLogger
+
+logger = getLogger(__name__)
 
 
 class TravelDemand:
@@ -40,28 +43,28 @@ class TravelDemands:
         if mode in self._demands:
             return self._demands[mode].tripEndRatePerHour
         else:
-            print("Should this really be happening?")
+            logger.warning("No travel demand for mode %s", mode)
             return 0.0
 
     def getStartRate(self, mode: str):
         if mode in self._demands:
             return self._demands[mode].tripStartRatePerHour
         else:
-            print("Should this really be happening?")
+            logger.warning("No travel demand for mode %s", mode)
             return 0.0
 
     def getRateOfPMT(self, mode: str):
         if mode in self._demands:
             return self._demands[mode].rateOfPmtPerHour
         else:
-            print("Should this really be happening?")
+            logger.warning("No travel demand for mode %s", mode)
             return 0.0
 
     def getAverageDistance(self, mode: str):
         if mode in self._demands:
             return self._demands[mode].averageDistanceInSystemInMiles
         else:
-            print("Should this really be happening?")
+            logger.warning("No travel demand for mode %s", mode)
             return 0.0
 
     def resetDemand(self):
@@ -0,0 +1,57 @@
+from collections import OrderedDict
+
+import numpy as np
+
+# Solvers that need fewer fixed-point evaluations from a nearby converged state. MSA is not among them: restarted
+# with weight 1 on the first new response, it discards the warm splits after one step, and a later start of its
+# damping schedule only slows it down, so it runs to the iteration cap either way.
+WARM_START_METHODS = ("anderson", "newton-krylov")
+
+
+class WarmStartStore:
+    """
+    Converged equilibrium states of recently evaluated decision vectors, from which a new evaluation can start. The
+    least recently used state is dropped once more than capacity are stored.
+
+    Attributes
+    ----------
+    capacity : int
+        Maximum number of stored states
+    scale : float | np.ndarray
+        Scale of each element of the decision vector in the distance used to find the nearest stored vector
+
+    Methods
+    -------
+    add(x, state):
+        Store the state reached at decision vector x
+    nearest(x):
+        Return (distance, state) of the stored vector closest to x, or (inf, None) if nothing is stored
+    """
+
+    def __init__(self, capacity=20, scale=1.0):
+        self.capacity = capacity
+        self.scale = scale
+        self.__states = OrderedDict()
+
+    def __len__(self):
+        return len(self.__states)
+
+    @staticmethod
+    def key(x: np.ndarray) -> tuple:
+        return tuple(np.asarray(x, dtype=float).tolist())
+
+    def add(self, x: np.ndarray, state: dict):
+        key = self.key(x)
+        self.__states[key] = state
+        self.__states.move_to_end(key)
+        while len(self.__states) > self.capacity:
+            self.__states.popitem(last=False)
+
+    def nearest(self, x: np.ndarray) -> (float, dict):
+        if not self.__states:
+            return np.inf, None
+        keys = list(self.__states.keys())
+        distances = np.linalg.norm((np.array(keys) - np.asarray(x, dtype=float)[None, :]) / self.scale, axis=1)
+        best = keys[int(np.argmin(distances))]
+        self.__states.move_to_end(best)
+        return distances.min(), self.__states[best]